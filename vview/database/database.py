@@ -1,6 +1,7 @@
-import asyncio, sqlite3, threading, traceback, time, logging
-from contextlib import contextmanager
+import asyncio, os, sqlite3, threading, traceback, time, logging
+from contextlib import contextmanager, nullcontext
 from ..util import misc
+from .query_stats import QueryStats, TimedCursor
 
 log = logging.getLogger(__name__)
 
@@ -69,10 +70,36 @@ def transaction(conn):
         else:
             _transactions[conn] = count
 
+class _Connection(sqlite3.Connection):
+    """
+    A database connection, which remembers whether it's a read-only connection and
+    where to record query statistics.
+    """
+    read_only = False
+    query_stats = None
+    schema_generation = 0
+
 class Database:
     """
     A base class for our databases.
     """
+    # The maximum number of read-only connections to keep open.  If they're all in use,
+    # readers wait for one to become available.
+    max_read_connections = 8
+
+    # How long a reader waits for a read-only connection before giving up and opening a
+    # temporary one.  This prevents deadlocks if a thread tries to read while a generator
+    # it's iterating is holding every connection.
+    read_connection_timeout = 1
+
+    # The page cache size and memory-mapped I/O size for each connection, in bytes.
+    cache_size = 16*1024*1024
+    mmap_size = 256*1024*1024
+
+    # Queries that take longer than this many seconds have their query plans logged and
+    # stored in query_stats.
+    slow_query_threshold = 0.1
+
     def __init__(self, db_path, schema):
         self.db_path = db_path
         self.schema = schema
@@ -81,32 +108,77 @@ class Database:
         # anything using this needs to use asyncio.run_coroutine_threadsafe.
         self._event_loop = asyncio.get_running_loop()
 
+        # Idle connections for writing and for reading.  read_connections_open is the number
+        # of pooled read-only connections that exist, including ones that are in use.
         self.connections = []
+        self.read_connections = []
+        self.read_connections_open = 0
+        self.read_connections_in_use = set()
         self.lock = threading.Lock()
-
-        # Open the DB now to create it.
-        with self.connect() as conn:
-            pass
+        self.read_connection_available = threading.Condition(self.lock)
+
+        # This is incremented when we change the schema, such as by running ANALYZE.  Pooled
+        # connections that last saw an older schema reload it before they're used.  See
+        # _reload_schema.
+        self.schema_generation = 0
+
+        # Statistics for each query shape run through cursor().
+        self.query_stats = QueryStats(slow_query_threshold=self.slow_query_threshold)
+
+        # Pool statistics.  These are only for diagnostics.
+        self.read_waits = 0
+        self.read_wait_time = 0
+        self.max_read_wait_time = 0
+        self.read_overflows = 0
+
+        # Open the DB now to create it, and run any migrations.  This is only done once
+        # and not for each connection.
+        conn = self.open_db()
+        self.upgrade(conn=conn)
+        self.connections.append(conn)
+
+        # Interrupt queries on read-only connections if we're shut down.  Write cursors
+        # use CancelTask for this, but that has to round-trip to the event loop, which is
+        # expensive for small reads, so reads are all cancelled by this one task instead.
+        self._interrupt_reads_task = self._event_loop.create_task(self._interrupt_reads_on_shutdown(), name='Database.interrupt_reads')
+
+    def upgrade(self, *, conn):
+        """
+        Create the database and apply migrations.  This is called once when the database
+        is opened.
+        """
+        pass
 
     @contextmanager
-    def connect(self, existing_connection=None, write=False):
+    def connect(self, existing_connection=None, write=False, read_only=False):
         """
         Yield a pooled connection, committing it on completion or rolling back on exception.
 
         If write is true, the connection will be opened with BEGIN IMMEDIATE TRANSACTION
         active.
 
+        If read_only is true, yield a read-only connection instead.  These are pooled separately,
+        and don't open a transaction, so they never wait for writers.
         """
         if existing_connection is not None:
+            assert not (write and existing_connection.read_only), 'Can\'t write to a read-only connection'
             yield existing_connection
             return
 
+        if read_only:
+            assert not write
+            with self._read_connection() as connection:
+                yield connection
+            return
+
         with self.lock:
             if self.connections:
                 connection = self.connections.pop()
             else:
                 connection = self.open_db()
 
+        self._reload_schema(connection)
+
         change_count = connection.total_changes
         if write:
             connection.execute('BEGIN IMMEDIATE TRANSACTION')
@@ -141,26 +213,144 @@ class Database:
                 assert connection not in self.connections
                 self.connections.append(connection)
 
+    @contextmanager
+    def _read_connection(self):
+        """
+        Yield a connection from the read-only pool, waiting for one if they're all in use.
+        """
+        connection = None
+        pooled = True
+        with self.lock:
+            started_at = None
+            while not self.read_connections and self.read_connections_open >= self.max_read_connections:
+                if started_at is None:
+                    started_at = time.time()
+                    self.read_waits += 1
+
+                remaining = started_at + self.read_connection_timeout - time.time()
+                if remaining <= 0:
+                    # Give up and open a temporary connection.
+                    self.read_overflows += 1
+                    pooled = False
+                    break
+
+                self.read_connection_available.wait(remaining)
+
+            if started_at is not None:
+                waited = time.time() - started_at
+                self.read_wait_time += waited
+                self.max_read_wait_time = max(self.max_read_wait_time, waited)
+
+            if pooled:
+                if self.read_connections:
+                    connection = self.read_connections.pop()
+                else:
+                    self.read_connections_open += 1
+
+        try:
+            if connection is None:
+                connection = self._open_read_connection()
+            self._reload_schema(connection)
+        except:
+            if pooled:
+                with self.lock:
+                    self.read_connections_open -= 1
+                    self.read_connection_available.notify()
+            raise
+
+        with self.lock:
+            self.read_connections_in_use.add(connection)
+
+        try:
+            yield connection
+        finally:
+            with self.lock:
+                self.read_connections_in_use.remove(connection)
+                if pooled:
+                    assert connection not in self.read_connections
+                    self.read_connections.append(connection)
+                    self.read_connection_available.notify()
+
+            if not pooled:
+                connection.close()
+
+    async def _interrupt_reads_on_shutdown(self):
+        try:
+            await asyncio.Future()
+        except asyncio.CancelledError:
+            with self.lock:
+                for connection in self.read_connections_in_use:
+                    connection.interrupt()
+            raise
+
+    def _reload_schema(self, connection):
+        """
+        Make connection reload the schema if it's changed since it was last used.
+
+        SQLite normally notices schema changes made by other connections on its own, but
+        with foreign keys and case_sensitive_like both enabled, the first write after the
+        schema changes fails with "no such table".  Reading from the schema first avoids
+        this.
+        """
+        schema_generation = self.schema_generation
+        if connection.schema_generation == schema_generation:
+            return
+
+        connection.execute(f'SELECT 1 FROM {self.schema}.sqlite_master LIMIT 1').fetchall()
+        connection.schema_generation = schema_generation
+
+    def _open_read_connection(self):
+        """
+        Open a read-only connection.
+        """
+        conn = self.open_db()
+        conn.read_only = True
+        conn.execute('PRAGMA query_only = ON')
+
+        # Don't let the sqlite3 module open transactions on its own.  Each query on a
+        # read-only connection runs on its own.
+        conn.isolation_level = None
+        return conn
+
+    def get_pool_stats(self):
+        """
+        Return a dictionary of connection pool statistics.
+        """
+        with self.lock:
+            return {
+                'read_connections': self.read_connections_open,
+                'read_connections_in_use': len(self.read_connections_in_use),
+                'max_read_connections': self.max_read_connections,
+                'read_waits': self.read_waits,
+                'read_wait_time': self.read_wait_time,
+                'max_read_wait_time': self.max_read_wait_time,
+                'read_overflows': self.read_overflows,
+                'idle_write_connections': len(self.connections),
+            }
+
     @contextmanager
     def cursor(self, conn=None, write=False):
         """
         Open a cursor, and yield a transaction.
 
         If write is true and conn is None (we don't already have a transaction), the
-        transaction will be opened with a write lock.
+        transaction will be opened with a write lock.  If neither is set, the cursor uses
+        a read-only connection and can't be used to write.
         """
-        with self.connect(conn, write=write) as conn:
+        with self.connect(conn, write=write, read_only=conn is None and not write) as conn:
             def oncancel():
                 conn.interrupt()
 
             # Use CancelTask to interrupt the connection if we shut down while this is running.
             # This lets us cancel long-running queries if the app is shut down, so we don't prevent
-            # it from exiting.
-            with misc.CancelTask(oncancel=oncancel, event_loop=self._event_loop):
+            # it from exiting.  Read-only connections are interrupted by _interrupt_reads_on_shutdown
+            # instead.
+            with (nullcontext() if conn.read_only else misc.CancelTask(oncancel=oncancel, event_loop=self._event_loop)):
                 assert isinstance(conn, sqlite3.Connection), conn
 
-                with transaction(conn):
-                    cursor = conn.cursor()
+                # Read-only connections don't use transactions.
+                with (nullcontext() if conn.read_only else transaction(conn)):
+                    cursor = conn.cursor(factory=TimedCursor)
                     try:
                         yield cursor
                     finally:
@@ -169,11 +359,13 @@ class Database:
     def open_db(self):
         # Connect to an in-memory database.  We don't use this, but you can't specify the schema
         # for the initial database, and we want to give a schema name to all of our databases.
-        conn = sqlite3.connect(':memory:', check_same_thread=False, timeout=5)
+        conn = sqlite3.connect(':memory:', check_same_thread=False, timeout=5, factory=_Connection)
 
         # Attach our database.
         self.attach(conn)
         conn.row_factory = sqlite3.Row
+        conn.query_stats = self.query_stats
+        conn.schema_generation = self.schema_generation
 
         # Use WAL.  This means commits won't be transactional across all of our databases,
         # but they don't need to be, and WAL is significantly faster.
@@ -191,8 +383,82 @@ class Database:
         # not stall a search.
         conn.execute(f'PRAGMA {self.schema}.read_uncommitted = ON;')
 
+        # Set the page cache size (negative values are in KiB) and use memory-mapped I/O,
+        # which makes small reads much cheaper.
+        conn.execute(f'PRAGMA {self.schema}.cache_size = {-(self.cache_size // 1024)}')
+        conn.execute(f'PRAGMA {self.schema}.mmap_size = {self.mmap_size}')
+
         return conn
 
+    # The number of rows ANALYZE samples from each index.  This keeps ANALYZE fast on large
+    # databases, and gives statistics that are nearly as good.
+    analysis_limit = 1000
+
+    @contextmanager
+    def _maintenance_connection(self):
+        """
+        Yield a new connection with no transaction open, for maintenance commands that can't
+        run inside a transaction.
+        """
+        conn = self.open_db()
+        conn.isolation_level = None
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def optimize(self):
+        """
+        Update the query planner's statistics.  Return a summary of what was done.
+        """
+        started_at = time.time()
+        with self._maintenance_connection() as conn:
+            conn.execute(f'PRAGMA analysis_limit = {self.analysis_limit}')
+            conn.execute(f'ANALYZE {self.schema}')
+            conn.execute(f'PRAGMA {self.schema}.optimize')
+
+            page_count = conn.execute(f'PRAGMA {self.schema}.page_count').fetchone()[0]
+            freelist_count = conn.execute(f'PRAGMA {self.schema}.freelist_count').fetchone()[0]
+
+        # ANALYZE changes the schema, so make pooled connections reload it.
+        with self.lock:
+            self.schema_generation += 1
+
+        return {
+            'time': time.time() - started_at,
+            'pages': page_count,
+            'free_pages': freelist_count,
+        }
+
+    def checkpoint(self, *, min_wal_size=0):
+        """
+        Checkpoint the WAL and truncate it if it's at least min_wal_size bytes.  Return a
+        summary of what was done.
+        """
+        wal_path = str(self.db_path) + '-wal'
+        try:
+            wal_size = os.stat(wal_path).st_size
+        except FileNotFoundError:
+            wal_size = 0
+
+        result = {
+            'wal_size': wal_size,
+            'checkpointed': False,
+            'checkpointed_pages': 0,
+        }
+
+        if wal_size == 0 or wal_size < min_wal_size:
+            return result
+
+        with self._maintenance_connection() as conn:
+            busy, log_pages, checkpointed_pages = conn.execute(f'PRAGMA {self.schema}.wal_checkpoint(TRUNCATE)').fetchone()
+
+        # If busy is set, a reader or writer prevented the checkpoint from completing.  It
+        # still checkpoints as much as it can.
+        result['checkpointed'] = not busy
+        result['checkpointed_pages'] = checkpointed_pages
+        return result
+
     def attach(self, conn):
         conn.execute(f'ATTACH DATABASE "{self.db_path}" AS {self.schema}')
 
@@ -214,7 +480,7 @@ class Database:
                 raise Exception('No info field in db: %s' % self)
 
     def _set_info(self, field, value, *, conn):
-        with self.cursor(conn) as cursor:
+        with self.cursor(conn, write=True) as cursor:
             query = f'''
                 UPDATE {self.schema}.info
                     SET %(field)s = ?
@@ -0,0 +1,282 @@
+# The entries returned by FileIndex.
+#
+# Searches can return hundreds of thousands of entries, so entries don't store a dictionary
+# each.  The column names are shared by every row from the same query, and each entry only
+# holds a list of its values.  Keys that aren't columns are stored in a separate dictionary,
+# which is only created if one is added.
+#
+# FileIndex stores paths as strings, and Library gives entries to the API with BasePath
+# paths.  Opening a path can be expensive, eg. for a file inside a ZIP, so open_paths
+# doesn't open them right away.  Each path is opened the first time it's read.
+import collections.abc, functools, logging
+
+log = logging.getLogger(__name__)
+
+_missing = object()
+
+class FileEntry(collections.abc.MutableMapping):
+    """
+    A file index entry.  This acts like a dictionary.
+    """
+    # _open_path is set by open_paths, and _paths holds the paths it's opened so far.
+    __slots__ = ('_columns', '_values', '_extra', '_open_path', '_paths')
+
+    # Keys that hold paths, which are opened by open_paths.
+    path_keys = ('path', 'parent')
+
+    def __init__(self, data=()):
+        """
+        Create an entry with the keys and values in data, which can be a dictionary or
+        another FileEntry.
+        """
+        if isinstance(data, FileEntry):
+            self._columns = data._columns
+            self._values = list(data._values)
+            self._extra = dict(data._extra) if data._extra else None
+            self._open_path = data._open_path
+            self._paths = dict(data._paths) if data._paths else None
+            return
+
+        data = dict(data)
+        self._columns = self.get_columns(tuple(data.keys()))
+        self._values = list(data.values())
+        self._extra = None
+        self._open_path = None
+        self._paths = None
+
+    @classmethod
+    @functools.lru_cache(maxsize=64)
+    def get_columns(cls, names):
+        """
+        Return the column mapping for a tuple of column names.  This is cached, so entries
+        with the same columns share the same mapping.
+        """
+        return { name: idx for idx, name in enumerate(names) }
+
+    @classmethod
+    def get_columns_for_cursor(cls, cursor):
+        """
+        Return the column mapping for the results of the query last run on cursor.
+        """
+        return cls.get_columns(tuple(column[0] for column in cursor.description))
+
+    @classmethod
+    def from_row(cls, columns, row):
+        """
+        Create an entry from a database row, with columns from get_columns_for_cursor.
+        """
+        entry = cls.__new__(cls)
+        entry._columns = columns
+        entry._values = list(row)
+        entry._extra = None
+        entry._open_path = None
+        entry._paths = None
+        return entry
+
+    def open_paths(self, open_path):
+        """
+        Return paths from this entry as path objects created with open_path, instead of
+        the strings stored in the index.
+
+        Paths aren't opened until they're read.
+        """
+        self._open_path = open_path
+
+    def _get(self, key):
+        idx = self._columns.get(key)
+        if idx is not None:
+            value = self._values[idx]
+        elif self._extra is not None:
+            value = self._extra.get(key, _missing)
+        else:
+            value = _missing
+
+        if self._open_path is not None and key in self.path_keys and value is not _missing:
+            if self._paths is None:
+                self._paths = {}
+
+            path = self._paths.get(key)
+            if path is None:
+                path = self._paths[key] = self._open_path(value)
+            return path
+
+        return value
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        return default if value is _missing else value
+
+    def __contains__(self, key):
+        idx = self._columns.get(key)
+        if idx is not None:
+            return self._values[idx] is not _missing
+        return self._extra is not None and key in self._extra
+
+    def __setitem__(self, key, value):
+        idx = self._columns.get(key)
+        if idx is not None:
+            self._values[idx] = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+        # If paths have been opened, the new value is what's read back, so don't open it
+        # again.
+        if self._open_path is not None and key in self.path_keys:
+            if self._paths is None:
+                self._paths = {}
+            self._paths[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        idx = self._columns.get(key)
+        if idx is not None:
+            self._values[idx] = _missing
+        else:
+            del self._extra[key]
+
+        if self._paths is not None:
+            self._paths.pop(key, None)
+
+    def __iter__(self):
+        for key, idx in self._columns.items():
+            if self._values[idx] is not _missing:
+                yield key
+
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        count = sum(1 for value in self._values if value is not _missing)
+        if self._extra is not None:
+            count += len(self._extra)
+        return count
+
+    def copy(self):
+        return FileEntry(self)
+
+    def __repr__(self):
+        return f'FileEntry({dict(self)!r})'
+
+def test_benchmark(count=100000):
+    """
+    Compare creating count entries and reading the fields the API reads as dictionaries with
+    eagerly opened paths, and as FileEntry.
+    """
+    import gc, sqlite3, time, tracemalloc
+    from ..util.paths import open_path
+
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('''
+        CREATE TABLE files(
+            id INTEGER PRIMARY KEY, path, parent, path_lowercase, is_directory, mtime, ctime,
+            filesystem_mtime, width, height, aspect_ratio, tags, title, comment, mime_type,
+            author, bookmarked, bookmark_tags, bookmark_created_at, bookmark_updated_at,
+            animation, crop, pan, inpaint, inpaint_timestamp, duration
+        )
+    ''')
+    rows = []
+    for idx in range(count):
+        parent = f'/home/user/Pictures/Album {idx // 100}'
+        path = f'{parent}/IMG_{idx:06}.jpg'
+        rows.append((idx + 1, path, parent, path.lower(), False, 10, 10, 10, 1920, 1080, 1920/1080,
+            'tag1 tag2', '', '', 'image/jpeg', '', False, '', 0, 0, False, None, None, None, 0, None))
+    conn.executemany(f'INSERT INTO files VALUES ({", ".join("?" * len(rows[0]))})', rows)
+
+    def read_fields(entry):
+        # The fields api.get_illust_info reads for each file.
+        str(entry['path'])
+        for field in ('is_directory', 'mtime', 'ctime', 'title', 'tags', 'width', 'height', 'author', 'comment', 'duration'):
+            entry[field]
+        for field in ('animation', 'inpaint_timestamp', 'error', 'crop', 'pan', 'inpaint', 'bookmarked'):
+            entry.get(field)
+
+    def load_dicts(cursor):
+        results = []
+        for row in cursor:
+            entry = dict(row)
+            entry['path'] = open_path(entry['path'])
+            entry['parent'] = open_path(entry['parent'])
+            results.append(entry)
+        return results
+
+    def load_entries(cursor):
+        columns = FileEntry.get_columns_for_cursor(cursor)
+        results = []
+        for row in cursor:
+            entry = FileEntry.from_row(columns, row)
+            entry.open_paths(open_path)
+            results.append(entry)
+        return results
+
+    for name, load in (('dict', load_dicts), ('FileEntry', load_entries)):
+        start = time.time()
+        results = load(conn.execute('SELECT * FROM files'))
+        load_time = time.time() - start
+
+        start = time.time()
+        for entry in results:
+            read_fields(entry)
+        read_time = time.time() - start
+        del results
+
+        # Measure memory separately, since tracing allocations slows everything down.  This
+        # includes the paths opened by reading.
+        gc.collect()
+        tracemalloc.start()
+        results = load(conn.execute('SELECT * FROM files'))
+        for entry in results:
+            read_fields(entry)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del results
+
+        log.info(f'{name}: load {load_time*1000:.0f}ms, read {read_time*1000:.0f}ms, {memory / 1024 / 1024:.1f}MB for {count} entries')
+
+def test():
+    entry = FileEntry({ 'path': '/a/b.jpg', 'parent': '/a', 'width': 10 })
+    assert entry['width'] == 10
+    assert entry.get('height') is None
+    assert 'height' not in entry
+    entry['height'] = 20
+    assert entry['height'] == 20 and 'height' in entry
+    assert dict(entry) == { 'path': '/a/b.jpg', 'parent': '/a', 'width': 10, 'height': 20 }
+
+    # Paths are opened when they're read, and only once.
+    opened = []
+    def open_path(path):
+        opened.append(path)
+        return ('opened', path)
+
+    copy = entry.copy()
+    entry.open_paths(open_path)
+    assert opened == []
+    assert entry['path'] == ('opened', '/a/b.jpg')
+    assert entry['path'] == ('opened', '/a/b.jpg')
+    assert opened == ['/a/b.jpg']
+    assert copy['path'] == '/a/b.jpg'
+
+    entry['parent'] = 'new parent'
+    assert entry['parent'] == 'new parent'
+    assert opened == ['/a/b.jpg']
+
+    del entry['width']
+    assert 'width' not in entry and len(entry) == 3
+    try:
+        entry['width']
+        assert False
+    except KeyError:
+        pass
+
+if __name__ == '__main__':
+    test()
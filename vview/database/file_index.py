@@ -2,19 +2,30 @@ import asyncio, os, re, logging
 from enum import Enum
 from pathlib import Path
 from .database import Database, transaction
+from .file_entry import FileEntry
 from pprint import pprint
 from ..util import misc
-from ..util.misc import WithBuilder
 
 log = logging.getLogger(__name__)
 
 # This implements the database storage for library.  It stores similar data to
 # what we get from the Windows index.
 class FileIndex(Database):
-    def __init__(self, db_path, *, schema='files'):
+    def __init__(self, db_path, *, schema='files', keyword_index='table'):
         """
         db_path is the path to the database on the filesystem.
+
+        keyword_index selects how keyword searches are indexed:
+
+        "table": Store one row per keyword in file_keywords, and join it once per search word.
+        "fts": Use an FTS5 index in file_keywords_fts.  This is much faster for multi-word
+        searches on large libraries, but requires SQLite to have FTS5 enabled.
+
+        Only the selected index is kept up to date.  If this is changed, the new index will be
+        rebuilt the next time the database is opened.
         """
+        assert keyword_index in ('table', 'fts'), keyword_index
+        self.keyword_index = keyword_index
         super().__init__(db_path, schema=schema)
 
     def open_db(self):
@@ -31,8 +42,14 @@ class FileIndex(Database):
         # required for the files_path index to be used.
         conn.execute(f'PRAGMA {self.schema}.case_sensitive_like = ON;')
 
-        # Do first-time initialization and any migrations.
-        self.upgrade(conn=conn)
+        # Fire delete triggers for rows removed by INSERT OR REPLACE and UPDATE OR REPLACE,
+        # so the FTS index and bookmark tag counts stay in sync.
+        conn.execute('PRAGMA recursive_triggers = ON;')
+
+        # Python's lower() and misc.shuffle_key, so rename can compute path_lowercase and
+        # shuffle_key in SQL.  SQLite's lower() only handles ASCII.
+        conn.create_function('python_lower', 1, str.lower, deterministic=True)
+        conn.create_function('shuffle_key', 2, misc.shuffle_key, deterministic=True)
 
         return conn
 
@@ -156,7 +173,386 @@ class FileIndex(Database):
                     conn.execute(f'CREATE INDEX {self.schema}.bookmark_tags_file_id on bookmark_tags(file_id)')
                     conn.execute(f'CREATE INDEX {self.schema}.bookmark_tags_tag on bookmark_tags(tag)')
 
-        assert self.get_db_version(conn=conn) == 1
+            if self.get_db_version(conn=conn) == 1:
+                with transaction(conn):
+                    self.set_db_version(2, conn=conn)
+
+                    # Which keyword index is currently populated, "table" or "fts".  See __init__.
+                    conn.execute(f'ALTER TABLE {self.schema}.info ADD COLUMN keyword_index NOT NULL DEFAULT "table"')
+
+                    # Create the FTS keyword index if FTS5 is available.  It starts out empty, and is
+                    # only populated if it's enabled.
+                    #
+                    # The keywords column holds the entry's keywords from get_keywords_for_entry, separated
+                    # by spaces.  We split keywords ourself, so the tokenizer only needs to split them back
+                    # apart.  The "ascii" tokenizer only separates on ASCII non-alphanumeric characters and
+                    # treats all non-ASCII characters as part of tokens, so it tokenizes this the same as
+                    # misc.split_keywords.  The prefix indexes speed up short prefix searches.
+                    if self._fts5_available(conn):
+                        conn.execute(f'''
+                            CREATE VIRTUAL TABLE {self.schema}.file_keywords_fts USING fts5(
+                                keywords,
+                                tokenize = "ascii",
+                                prefix = "2 3"
+                            )
+                        ''')
+
+                        # FTS tables don't support foreign keys, so use a trigger to delete FTS rows
+                        # when files are deleted.
+                        conn.execute(f'''
+                            CREATE TRIGGER {self.schema}.files_delete_keywords_fts AFTER DELETE ON files
+                            BEGIN
+                                DELETE FROM file_keywords_fts WHERE rowid = old.id;
+                            END
+                        ''')
+
+            if self.get_db_version(conn=conn) == 2:
+                with transaction(conn):
+                    self.set_db_version(3, conn=conn)
+
+                    # Precomputed keys for natural sorting.  See misc.natural_sort_key.  These are
+                    # set by add_records, and let natural sorts be done by the index.
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN natural_sort_key')
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN natural_sort_key_reverse_pages')
+
+                    # Fill in the keys for existing records.
+                    rows = []
+                    for row in conn.execute(f'SELECT id, path, is_directory FROM {self.schema}.files'):
+                        keys = self._get_natural_sort_keys(row['path'], row['is_directory'])
+                        rows.append((keys['natural_sort_key'], keys['natural_sort_key_reverse_pages'], row['id']))
+
+                    conn.executemany(f'''
+                        UPDATE {self.schema}.files
+                            SET natural_sort_key = ?, natural_sort_key_reverse_pages = ?
+                            WHERE id = ?
+                    ''', rows)
+
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_natural on files(natural_sort_key, path_lowercase)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_natural_reverse_pages on files(natural_sort_key_reverse_pages, path_lowercase)')
+
+            if self.get_db_version(conn=conn) == 3:
+                with transaction(conn):
+                    self.set_db_version(4, conn=conn)
+
+                    # A hash of the path for seeded shuffles.  See misc.shuffle_key.
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN shuffle_key')
+
+                    rows = [
+                        (misc.shuffle_key(row['path_lowercase'], row['is_directory']), row['id'])
+                        for row in conn.execute(f'SELECT id, path_lowercase, is_directory FROM {self.schema}.files')
+                    ]
+                    conn.executemany(f'UPDATE {self.schema}.files SET shuffle_key = ? WHERE id = ?', rows)
+
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_shuffle on files(shuffle_key, path_lowercase)')
+
+            if self.get_db_version(conn=conn) == 4:
+                with transaction(conn):
+                    self.set_db_version(5, conn=conn)
+
+                    # width*height, for total_pixels searches.  This and aspect_ratio are set by
+                    # add_records, and are stored so range searches on them can use an index instead
+                    # of computing them for every file.
+                    conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN total_pixels')
+
+                    # aspect_ratio was already stored, but wasn't used by searches.  Recompute it
+                    # along with total_pixels, so both match what searches computed before.
+                    conn.execute(f'''
+                        UPDATE {self.schema}.files
+                            SET total_pixels = width*height, aspect_ratio = 1.0*width/height
+                    ''')
+
+                    # These are indexed with the parent, so searches in a directory can look up
+                    # a range directly.  Recursive searches match a path prefix rather than a parent,
+                    # so they're also indexed on their own, which lets searches over a whole mount
+                    # read only the matching range.
+                    conn.execute(f'CREATE INDEX {self.schema}.files_parent_total_pixels on files(parent, total_pixels)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_parent_aspect_ratio on files(parent, aspect_ratio)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_total_pixels on files(total_pixels) WHERE total_pixels IS NOT NULL')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_aspect_ratio on files(aspect_ratio) WHERE aspect_ratio IS NOT NULL')
+
+            if self.get_db_version(conn=conn) == 5:
+                with transaction(conn):
+                    self.set_db_version(6, conn=conn)
+                    self._create_bookmark_tag_counts(conn=conn)
+
+            if self.get_db_version(conn=conn) == 6:
+                with transaction(conn):
+                    self.set_db_version(7, conn=conn)
+
+                    # The mtime and size of each metadata file when it was last imported, by
+                    # the directory it's in.  See get_metadata_file_states.
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.metadata_files(
+                            directory TEXT PRIMARY KEY NOT NULL,
+                            mtime NOT NULL,
+                            size NOT NULL
+                        )
+                    ''')
+
+                    # Importing a metadata file only adds files that aren't in the index, so if a
+                    # file is removed or renamed, its directory's metadata file needs to be
+                    # imported again even if it hasn't changed.
+                    conn.execute(f'''
+                        CREATE TRIGGER {self.schema}.files_delete_metadata_file AFTER DELETE ON files
+                        BEGIN
+                            DELETE FROM metadata_files WHERE directory = old.parent;
+                        END
+                    ''')
+
+                    conn.execute(f'''
+                        CREATE TRIGGER {self.schema}.files_rename_metadata_file AFTER UPDATE OF path ON files
+                        BEGIN
+                            DELETE FROM metadata_files WHERE directory = old.parent;
+                        END
+                    ''')
+
+            if self.get_db_version(conn=conn) == 7:
+                with transaction(conn):
+                    self.set_db_version(8, conn=conn)
+                    self._create_directories(conn=conn)
+                    self._set_file_id_types(conn=conn)
+
+            # If the keyword index we're using has changed, rebuild it.
+            if self.keyword_index == 'fts' and 'file_keywords_fts' not in self.get_tables(conn):
+                log.warn('FTS5 isn\'t available, using the keyword table instead')
+                self.keyword_index = 'table'
+
+            if self._get_info(conn=conn)['keyword_index'] != self.keyword_index:
+                self._rebuild_keyword_index(conn=conn)
+
+        assert self.get_db_version(conn=conn) == 8
+
+    def _create_bookmark_tag_counts(self, *, conn):
+        """
+        Create and populate the bookmark_tag_counts table.
+
+        This holds the number of bookmarks with each tag, with the number of untagged
+        bookmarks under the tag "", so get_all_bookmark_tags doesn't need to count every tag
+        each time.  It's kept up to date by triggers on bookmark_tags and files, so it stays
+        correct no matter how those tables are changed.  check_bookmark_tag_counts compares
+        it against a full count.
+        """
+        conn.execute(f'''
+            CREATE TABLE {self.schema}.bookmark_tag_counts(
+                tag TEXT PRIMARY KEY NOT NULL,
+                count INTEGER NOT NULL
+            )
+        ''')
+
+        # Add delta to the count for tag.  Counts that reach zero are removed, so tags that
+        # are no longer used go away.
+        def adjust(tag, delta):
+            return f'''
+                INSERT INTO bookmark_tag_counts (tag, count) VALUES ({tag}, {delta})
+                    ON CONFLICT(tag) DO UPDATE SET count = count + excluded.count;
+                DELETE FROM bookmark_tag_counts WHERE tag = {tag} AND count = 0;
+            '''
+
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.bookmark_tags_insert_count AFTER INSERT ON bookmark_tags
+            BEGIN
+                {adjust('new.tag', 1)}
+            END
+        ''')
+
+        # This also runs when files are deleted, since bookmark_tags rows are deleted by
+        # their foreign key.
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.bookmark_tags_delete_count AFTER DELETE ON bookmark_tags
+            BEGIN
+                {adjust('old.tag', -1)}
+            END
+        ''')
+
+        # Untagged bookmarks are files and not rows in bookmark_tags, so count them with
+        # triggers on files.
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.files_insert_untagged_count AFTER INSERT ON files
+            WHEN new.bookmarked AND new.bookmark_tags = ''
+            BEGIN
+                {adjust("''", 1)}
+            END
+        ''')
+
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.files_delete_untagged_count AFTER DELETE ON files
+            WHEN old.bookmarked AND old.bookmark_tags = ''
+            BEGIN
+                {adjust("''", -1)}
+            END
+        ''')
+
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.files_update_untagged_count AFTER UPDATE OF bookmarked, bookmark_tags ON files
+            WHEN (old.bookmarked AND old.bookmark_tags = '') != (new.bookmarked AND new.bookmark_tags = '')
+            BEGIN
+                {adjust("''", "CASE WHEN new.bookmarked THEN 1 ELSE -1 END")}
+            END
+        ''')
+
+        self._rebuild_bookmark_tag_counts(conn=conn)
+
+    def _set_file_id_types(self, *, conn):
+        """
+        Recreate file_keywords and bookmark_tags with file_id declared INTEGER.
+
+        file_id had no type, which prevents SQLite from using the file_id indexes to find rows
+        to cascade when a file is deleted, so every deleted file scanned both tables.  SQLite
+        can't change a column's type in place, so copy each table and recreate its indexes
+        and triggers.
+        """
+        tables = {
+            'file_keywords': 'keyword TEXT NOT NULL',
+            'bookmark_tags': 'tag NOT NULL',
+        }
+        for table, columns in tables.items():
+            # Indexes and triggers are dropped with the table, so save them to recreate
+            # afterwards.  Their SQL doesn't include the schema name.
+            recreate = []
+            for row in conn.execute(f'''
+                SELECT type, sql FROM {self.schema}.sqlite_master
+                WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+            ''', [table]):
+                prefix = f'CREATE {row["type"].upper()} '
+                assert row['sql'].startswith(prefix), row['sql']
+                recreate.append(prefix + f'{self.schema}.' + row['sql'][len(prefix):])
+
+            conn.execute(f'''
+                CREATE TABLE {self.schema}.{table}_new(
+                    file_id INTEGER NOT NULL,
+                    {columns},
+                    FOREIGN KEY(file_id) REFERENCES files(id) ON DELETE CASCADE
+                )
+            ''')
+            conn.execute(f'INSERT INTO {self.schema}.{table}_new SELECT * FROM {self.schema}.{table}')
+            conn.execute(f'DROP TABLE {self.schema}.{table}')
+            conn.execute(f'ALTER TABLE {self.schema}.{table}_new RENAME TO {table}')
+
+            for sql in recreate:
+                conn.execute(sql)
+
+    def _create_directories(self, *, conn):
+        """
+        Create the directories table, and index files by the ID of their parent directory.
+
+        Every parent path is stored once in directories, and files refer to it by dir_id.
+        Indexes on the parent use the integer ID instead of the full path string, which makes
+        them much smaller.  dir_id is kept up to date by triggers on files, so it follows
+        parent no matter how it's changed.
+
+        This replaces the indexes on parent, and files_path, which duplicated the index
+        created by path's UNIQUE constraint.
+        """
+        conn.execute(f'''
+            CREATE TABLE {self.schema}.directories(
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL
+            )
+        ''')
+        conn.execute(f'ALTER TABLE {self.schema}.files ADD COLUMN dir_id INTEGER')
+
+        conn.execute(f'INSERT INTO {self.schema}.directories (path) SELECT DISTINCT parent FROM {self.schema}.files')
+        conn.execute(f'''
+            UPDATE {self.schema}.files
+                SET dir_id = (SELECT id FROM {self.schema}.directories WHERE directories.path = files.parent)
+        ''')
+
+        for index in ('files_path', 'files_parent', 'files_parent_total_pixels', 'files_parent_aspect_ratio'):
+            conn.execute(f'DROP INDEX {self.schema}.{index}')
+
+        # Like the indexes they replace, these let searches in a directory look up a range of
+        # total_pixels or aspect_ratio directly.  They also serve lookups by dir_id alone.
+        conn.execute(f'CREATE INDEX {self.schema}.files_dir_total_pixels on files(dir_id, total_pixels)')
+        conn.execute(f'CREATE INDEX {self.schema}.files_dir_aspect_ratio on files(dir_id, aspect_ratio)')
+
+        # Set dir_id from parent, adding the directory if it's new.  This doesn't use INSERT OR
+        # IGNORE, since the outer statement's conflict handling would override it, and INSERT
+        # OR REPLACE into files would replace the directory with a new ID.
+        set_dir_id = '''
+            INSERT INTO directories (path) SELECT new.parent
+                WHERE NOT EXISTS (SELECT 1 FROM directories WHERE path = new.parent);
+            UPDATE files SET dir_id = (SELECT id FROM directories WHERE path = new.parent)
+                WHERE id = new.id AND dir_id IS NOT (SELECT id FROM directories WHERE path = new.parent);
+        '''
+
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.files_insert_directory AFTER INSERT ON files
+            BEGIN
+                {set_dir_id}
+            END
+        ''')
+
+        conn.execute(f'''
+            CREATE TRIGGER {self.schema}.files_update_directory AFTER UPDATE OF parent ON files
+            BEGIN
+                {set_dir_id}
+            END
+        ''')
+
+    def _count_bookmark_tags(self, *, conn):
+        """
+        Count bookmark tags from scratch, returning a dictionary of {tag: count}.  Untagged
+        bookmarks are counted under the tag "".
+        """
+        # Get tag counts:
+        results = {}
+        query = f"""
+            SELECT tag, count(tag) FROM {self.schema}.bookmark_tags
+            GROUP BY tag
+        """
+        for row in conn.execute(query):
+            tag = row['tag']
+            results[tag] = row['count(tag)']
+
+        # Get the number of untagged bookmarks.  This search uses the files_untagged_bookmarks
+        # index.
+        query = f"""
+            SELECT count(*) FROM {self.schema}.files
+            WHERE bookmark_tags == "" AND bookmarked
+        """
+        for row in conn.execute(query):
+            if row['count(*)']:
+                results[''] = row['count(*)']
+
+        return results
+
+    def _rebuild_bookmark_tag_counts(self, *, conn):
+        """
+        Replace the contents of bookmark_tag_counts with a full count.
+        """
+        counts = self._count_bookmark_tags(conn=conn)
+        conn.execute(f'DELETE FROM {self.schema}.bookmark_tag_counts')
+        conn.executemany(f'INSERT INTO {self.schema}.bookmark_tag_counts (tag, count) VALUES (?, ?)', counts.items())
+
+    @classmethod
+    def _fts5_available(cls, conn):
+        """
+        Return true if this SQLite was compiled with FTS5.
+        """
+        for row in conn.execute('PRAGMA compile_options'):
+            if row[0] == 'ENABLE_FTS5':
+                return True
+        return False
+
+    def _rebuild_keyword_index(self, *, conn):
+        """
+        Clear the keyword indexes and repopulate the one we're using.
+        """
+        log.info('Rebuilding keyword index (%s)' % self.keyword_index)
+        with transaction(conn):
+            conn.execute(f'DELETE FROM {self.schema}.file_keywords')
+            if 'file_keywords_fts' in self.get_tables(conn):
+                conn.execute(f'DELETE FROM {self.schema}.file_keywords_fts')
+
+            query = f'''
+                SELECT id, {', '.join(self.keyword_fields)}
+                FROM {self.schema}.files
+            '''
+            cursor = conn.cursor()
+            for row in conn.execute(query):
+                self._set_keywords(cursor, row['id'], self.get_keywords_for_entry(row), new=True)
+
+            self._set_info('keyword_index', self.keyword_index, conn=conn)
 
     @classmethod
     def split_keywords(self, filename):
@@ -187,61 +583,125 @@ class FileIndex(Database):
 
         If a record for this path already exists, it will be replaced.
         """
-        # We're going to read the database and then probably write a record.  Try to open
+        self.add_records([entry], conn=conn)
+        return entry
+
+    # Fields that are never changed when updating an existing record.  These only change
+    # on rename.
+    _invariant_fields = ('id', 'path', 'parent', 'dir_id', 'path_lowercase', 'basename_if_directory_lowercase')
+
+    # The number of entries add_records looks up at once.  This needs to be below SQLite's
+    # limit on the number of query parameters.
+    _add_records_batch_size = 500
+
+    def add_records(self, entries, *, conn=None):
+        """
+        Add or update a list of file records in a single transaction, setting entry['id']
+        in each entry to the new or updated record's ID.
+
+        Existing records are looked up in batches, and only fields that have actually
+        changed are written.  Keywords and bookmark tags are diffed against the existing
+        record, so only added and removed keywords and tags are written.
+        """
+        entries = list(entries)
+        if not entries:
+            return entries
+
+        # We're going to read the database and then probably write records.  Try to open
         # a write transaction from the start, which prevents "database locked" errors if
         # the database is modified between the read and the write.  This won't do anything
         # if we already have a connection.
         with self.cursor(conn, write=True) as cursor:
-            fields = list(entry.keys())
+            for start in range(0, len(entries), self._add_records_batch_size):
+                self._add_records_batch(cursor, entries[start:start+self._add_records_batch_size])
 
-            # These fields are included in the keyword index.
-            keyword_fields = self.keyword_fields
+        return entries
 
-            # See if this file already exists in the database.
-            query = f"""
-                SELECT *
-                FROM {self.schema}.files
-                WHERE path = ?
-                """
-            result = list(cursor.execute(query, (entry['path'],)))
-            existing_record = result[0] if result else None
-
-            if existing_record:
-                # The record already exists.  Update all fields except for path, parent, and
-                # path_lowercase name, which are invariant (except for renames which we don't
-                # do here)  This is much faster than letting INSERT OR REPLACE replace the record.
-                fields.remove('path')
-                fields.remove('parent')
-                fields.remove('path_lowercase')
-                fields.remove('basename_if_directory_lowercase')
-                row = [entry[key] for key in fields]
-                row.append(entry['path'])
-                sets = ['%s = ?' % field for field in fields]
-                query = f'''
-                    UPDATE {self.schema}.files
-                        SET {', '.join(sets)}
-                        WHERE path = ?
-                '''
-                cursor.execute(query, row)
+    def _add_records_batch(self, cursor, entries):
+        # Look up existing records for all paths in this batch at once.
+        paths = list({entry['path'] for entry in entries})
+        query = f"""
+            SELECT *
+            FROM {self.schema}.files
+            WHERE path IN (%s)
+        """ % ', '.join('?'*len(paths))
+        existing_records = {row['path']: dict(row) for row in cursor.execute(query, paths)}
+
+        # Keyword and tag changes are collected and written together at the end of the batch.
+        keywords_to_add = []
+        keywords_to_remove = []
+        tags_to_add = []
+        tags_to_remove = []
+        pending_ids = set()
+
+        def flush():
+            if self.keyword_index == 'fts':
+                cursor.executemany(f'DELETE FROM {self.schema}.file_keywords_fts WHERE rowid = ?', keywords_to_remove)
+                cursor.executemany(f'''
+                    INSERT INTO {self.schema}.file_keywords_fts (rowid, keywords) values (?, ?)
+                ''', keywords_to_add)
+            else:
+                cursor.executemany(f'''
+                    DELETE FROM {self.schema}.file_keywords WHERE file_id = ? AND +keyword = ?
+                ''', keywords_to_remove)
+                cursor.executemany(f'''
+                    INSERT INTO {self.schema}.file_keywords (file_id, keyword) values (?, ?)
+                ''', keywords_to_add)
 
-                # If any field in keyword_fields has changed, we need to update the keyword index.
-                keyword_update_needed = False
-                for keyword_field in keyword_fields:
-                    keyword_update_needed |= existing_record[keyword_field] != entry[keyword_field]
+            # Use "+tag" so this uses the file_id index.  Otherwise, SQLite may use the tag index, which
+            # is very slow for common tags.
+            cursor.executemany(f'DELETE FROM {self.schema}.bookmark_tags WHERE file_id = ? AND +tag = ?', tags_to_remove)
+            cursor.executemany(f'INSERT INTO {self.schema}.bookmark_tags (file_id, tag) values (?, ?)', tags_to_add)
+
+            for pending in (keywords_to_add, keywords_to_remove, tags_to_add, tags_to_remove, pending_ids):
+                pending.clear()
+
+        for entry in entries:
+            existing_record = existing_records.get(entry['path'])
+
+            # Fill in the sort keys if our caller didn't.  These only depend on the path, so
+            # they're already correct if they're present.
+            if 'natural_sort_key' not in entry:
+                entry.update(self._get_natural_sort_keys(entry['path'], entry.get('is_directory')))
+            if 'shuffle_key' not in entry:
+                entry['shuffle_key'] = misc.shuffle_key(entry['path_lowercase'], entry.get('is_directory'))
+
+            # Update the stored dimension fields.  Unlike the sort keys, these are always
+            # recomputed, since the dimensions can change.
+            if 'width' in entry and 'height' in entry:
+                entry.update(self._get_dimension_fields(entry['width'], entry['height']))
+
+            if existing_record is not None:
+                # If the same file appears more than once, write the changes we've collected
+                # so far first, so they're applied in order.
+                if existing_record['id'] in pending_ids:
+                    flush()
+
+                # The record already exists.  Update only the fields that have changed.  This
+                # is much faster than letting INSERT OR REPLACE replace the record, and avoids
+                # writing anything at all if nothing has changed.
+                fields = [
+                    field for field, value in entry.items()
+                    if field not in self._invariant_fields and existing_record.get(field) != value
+                ]
+                if fields:
+                    row = [entry[field] for field in fields]
+                    row.append(existing_record['id'])
+                    query = f'''
+                        UPDATE {self.schema}.files
+                            SET {', '.join('%s = ?' % field for field in fields)}
+                            WHERE id = ?
+                    '''
+                    cursor.execute(query, row)
 
-                # If the tag list changed, we need to update the tag index.
-                tag_update_needed = existing_record['bookmark_tags'] != entry['bookmark_tags']
-                
                 # Set the ID in our caller's entry to the existing ID.
                 entry['id'] = existing_record['id']
+
+                old_record = existing_record
+                new_record = existing_record | dict(entry)
             else:
                 # The record doesn't exist, so create a new one.
-                keyword_update_needed = True
-
-                # If this entry is bookmarked, update its tag index.  Since this is a new entry,
-                # we can skip this if it's not bookmarked.
-                tag_update_needed = entry['bookmarked']
-
+                fields = list(entry.keys())
                 row = [entry[key] for key in fields]
 
                 query = f'''
@@ -253,45 +713,104 @@ class FileIndex(Database):
                     'placeholders': ', '.join('?'*len(fields))
                 }
                 cursor.execute(query, row)
-                rowid = cursor.lastrowid
 
                 # Fill in the ID.
-                entry['id'] = rowid
+                entry['id'] = cursor.lastrowid
+
+                old_record = None
+                new_record = dict(entry)
+
+            file_id = entry['id']
+            existing_records[entry['path']] = new_record
+            pending_ids.add(file_id)
+
+            # Update search keywords if any field in keyword_fields has changed.
+            if old_record is None or any(old_record[field] != new_record[field] for field in self.keyword_fields):
+                keywords = self.get_keywords_for_entry(new_record)
+                old_keywords = self.get_keywords_for_entry(old_record) if old_record is not None else set()
+                if self.keyword_index == 'fts':
+                    # FTS rows can't be edited in place, so replace the whole row if anything
+                    # changed.  Existing records always have a row, even if it's empty.
+                    if old_record is None or keywords != old_keywords:
+                        if old_record is not None:
+                            keywords_to_remove.append((file_id,))
+                        keywords_to_add.append((file_id, ' '.join(keywords)))
+                else:
+                    keywords_to_remove.extend((file_id, keyword) for keyword in old_keywords - keywords)
+                    keywords_to_add.extend((file_id, keyword) for keyword in keywords - old_keywords)
 
-            # Update search keywords if needed.
-            if keyword_update_needed:
-                # Delete old keywords.
-                cursor.execute(f'DELETE FROM {self.schema}.file_keywords WHERE file_id = ?', [entry['id']])
+            # Update bookmark tags if the tag list changed.
+            old_tags = old_record.get('bookmark_tags') if old_record is not None else None
+            if old_tags != new_record.get('bookmark_tags'):
+                tags = self._split_bookmark_tags(new_record.get('bookmark_tags'))
+                old_tags = self._split_bookmark_tags(old_tags)
+                tags_to_remove.extend((file_id, tag) for tag in old_tags - tags)
+                tags_to_add.extend((file_id, tag) for tag in tags - old_tags)
 
-                keywords = self.get_keywords_for_entry(entry)
+        flush()
+
+    @classmethod
+    def _get_dimension_fields(cls, width, height):
+        """
+        Return the total_pixels and aspect_ratio fields for an image with the given size.
 
-                keywords_to_add = []
-                for keyword in keywords:
-                    keywords_to_add.append((entry['id'], keyword.lower()))
+        These are the same as width*height and 1.0*width/height in SQL, which are null if
+        either dimension is null or if the height is 0.  They're also null if the dimensions
+        aren't numbers.
+        """
+        if not isinstance(width, (int, float)) or not isinstance(height, (int, float)):
+            return { 'total_pixels': None, 'aspect_ratio': None }
 
-                cursor.executemany(f'''
-                    INSERT INTO {self.schema}.file_keywords (file_id, keyword) values (?, ?)
-                ''', keywords_to_add)
+        return {
+            'total_pixels': width * height if width is not None and height is not None else None,
+            'aspect_ratio': width / height if width is not None and height else None,
+        }
 
-            # Update bookmark tags if needed.
-            if tag_update_needed:
-                # Delete old tags.
-                cursor.execute(f'DELETE FROM {self.schema}.bookmark_tags WHERE file_id = ?', [entry['id']])
+    @classmethod
+    def _get_natural_sort_keys(cls, path, is_directory):
+        """
+        Return the natural sort key fields for a record.
+        """
+        filename = os.path.basename(path)
+        is_directory = bool(is_directory)
+        return {
+            'natural_sort_key': misc.natural_sort_key(filename, is_directory),
+            'natural_sort_key_reverse_pages': misc.natural_sort_key(filename, is_directory, reverse_pages=True),
+        }
 
-                # Split the tag list.
-                tags = set(entry['bookmark_tags'].split(' '))
-                if '' in tags:
-                    tags.remove('')
+    @classmethod
+    def _split_bookmark_tags(cls, bookmark_tags):
+        """
+        Return the set of tags in a space-separated bookmark_tags string.
+        """
+        tags = set((bookmark_tags or '').split(' '))
+        tags.discard('')
+        return tags
 
-                tags_to_add = []
-                for tag in tags:
-                    tags_to_add.append((entry['id'], tag))
+    def _set_keywords(self, cursor, file_id, keywords, *, new=False):
+        """
+        Replace the keywords for file_id in the keyword index we're using.
 
-                cursor.executemany(f'''
-                    INSERT INTO {self.schema}.bookmark_tags (file_id, tag) values (?, ?)
-                ''', tags_to_add)
+        If new is true, this file has just been added and doesn't have any keywords yet.
+        """
+        if self.keyword_index == 'fts':
+            if not new:
+                cursor.execute(f'DELETE FROM {self.schema}.file_keywords_fts WHERE rowid = ?', [file_id])
 
-        return entry
+            cursor.execute(f'''
+                INSERT INTO {self.schema}.file_keywords_fts (rowid, keywords) values (?, ?)
+            ''', [file_id, ' '.join(keywords)])
+        else:
+            if not new:
+                cursor.execute(f'DELETE FROM {self.schema}.file_keywords WHERE file_id = ?', [file_id])
+
+            keywords_to_add = []
+            for keyword in keywords:
+                keywords_to_add.append((file_id, keyword.lower()))
+
+            cursor.executemany(f'''
+                INSERT INTO {self.schema}.file_keywords (file_id, keyword) values (?, ?)
+            ''', keywords_to_add)
 
     def delete_recursively(self, paths, *, conn=None):
         """
@@ -300,7 +819,7 @@ class FileIndex(Database):
         If this includes directories, all entries for files inside the directory
         will be removed recursively.
         """
-        with self.cursor(conn) as cursor:
+        with self.cursor(conn, write=True) as cursor:
             # If path includes "/path", we need to delete "/path" and files matching
             # "/path/%", but not "/path%".
             path_list = [(str(path), self.escape_like(str(path)) + os.path.sep + '%') for path in paths]
@@ -312,6 +831,14 @@ class FileIndex(Database):
                     files.path LIKE ? ESCAPE "$"
             ''', path_list)
 
+            # Nothing refers to directories inside the deleted paths anymore.
+            cursor.executemany(f'''
+                DELETE FROM {self.schema}.directories
+                WHERE
+                    path = ? OR
+                    path LIKE ? ESCAPE "$"
+            ''', path_list)
+
             deleted = cursor.connection.total_changes - count
             # log.info('Deleted %i (%s)' % (deleted, paths))
 
@@ -321,53 +848,77 @@ class FileIndex(Database):
 
         This is done when we detect a filesystem rename.
         """
-        with self.cursor(conn) as cursor:
-            # Update "path" and "parent" for old_path and all files inside it.
-            log.info('Renaming "%s" -> "%s"' % (old_path, new_path))
-            old_path = Path(old_path)
-            new_path = Path(new_path)
+        old_path = os.fspath(old_path)
+        new_path = os.fspath(new_path)
+        if old_path == new_path:
+            return
 
-            if old_path == new_path:
-                return
-                
-            # Make sure the old path doesn't exist.  We could use UPDATE OR REPLACE
+        log.info('Renaming "%s" -> "%s"' % (old_path, new_path))
+        with self.cursor(conn, write=True) as cursor:
+            # Make sure the new path doesn't exist.  We could use UPDATE OR REPLACE
             # below, but that would only remove conflicting files.  If the new path
             # exists in the database, the entire directory is stale and should be
             # removed.
-            self.delete_recursively([new_path], conn=conn)
-            
-            for entry in self.search(paths=[str(old_path)], conn=conn):
-                # path should always be relative to old_path: this is a path inside
-                # the path we searched for.
-                path = Path(entry['path'])
-                relative_path = path.relative_to(old_path)
-                entry_new_path = new_path / relative_path
-
-                # parent should always be inside old_path, unless this is old_path itself.
-                if path != old_path:
-                    relative_parent = Path(entry['parent']).relative_to(old_path)
-                    entry_new_parent = new_path / relative_parent
-                else:
-                    entry_new_parent = entry['parent']
-
-                entry_new_path_lowercase = str(new_path).lower()
-                basename_if_directory_lowercase = new_path.basename.lower() if new_path.is_dir() else None
+            self.delete_recursively([new_path], conn=cursor.connection)
+
+            # Rename directories inside old_path.  They keep their IDs, so files inside them
+            # don't need to change their dir_id.
+            cursor.execute(f'''
+                UPDATE {self.schema}.directories
+                    SET path = ? || substr(path, ?)
+                    WHERE path = ? OR path LIKE ? ESCAPE "$"
+            ''', [new_path, len(old_path) + 1, old_path, self.escape_like(old_path) + os.path.sep + '%'])
+
+            # Update files inside old_path by replacing the old_path prefix of path and parent.
+            # Files inside it keep their names, so only the columns derived from the full path
+            # change.  path_lowercase and shuffle_key use Python's lower() and shuffle_key,
+            # which are registered by open_db, to match what add_records stores.
+            new_path_expr = '? || substr(path, ?)'
+            cursor.execute(f'''
+                UPDATE {self.schema}.files
+                    SET
+                        path = {new_path_expr},
+                        parent = ? || substr(parent, ?),
+                        path_lowercase = python_lower({new_path_expr}),
+                        shuffle_key = shuffle_key(python_lower({new_path_expr}), is_directory)
+                    WHERE path LIKE ? ESCAPE "$"
+            ''', [
+                new_path, len(old_path) + 1,   # path
+                new_path, len(old_path) + 1,   # parent
+                new_path, len(old_path) + 1,   # path_lowercase
+                new_path, len(old_path) + 1,   # shuffle_key
+                self.escape_like(old_path) + os.path.sep + '%',
+            ])
+
+            # Update old_path itself.  Its name has changed, so its keywords and natural sort
+            # keys need to be updated too.
+            entry = self.get(old_path, conn=cursor.connection)
+            if entry is None:
+                return
 
-                query = f'''
-                    UPDATE OR REPLACE {self.schema}.files
-                        SET path = ?, parent = ?, path_lowercase = ?, basename_if_directory_lowercase = ?
-                        WHERE id = ?
-                ''' % {
-                    'path': '',
-                    'parent': '',
-                }
-                cursor.execute(query, [
-                    str(entry_new_path),              # path
-                    str(entry_new_parent),            # parent
-                    str(entry_new_path_lowercase),    # path_lowercase
-                    str(basename_if_directory_lowercase), # basename_if_directory_lowercase
-                    entry['id'],                      # WHERE id
-                ])
+            entry['path'] = new_path
+            keys = self._get_natural_sort_keys(new_path, entry['is_directory'])
+            basename_lowercase = os.path.basename(new_path).lower()
+            cursor.execute(f'''
+                UPDATE {self.schema}.files
+                    SET
+                        path = ?, parent = ?, path_lowercase = ?, basename_if_directory_lowercase = ?, shuffle_key = ?,
+                        natural_sort_key = ?, natural_sort_key_reverse_pages = ?
+                    WHERE id = ?
+            ''', [
+                new_path,
+                str(Path(new_path).parent),
+                new_path.lower(),
+                basename_lowercase if entry['is_directory'] else None,
+                misc.shuffle_key(new_path.lower(), entry['is_directory']),
+                keys['natural_sort_key'],
+                keys['natural_sort_key_reverse_pages'],
+                entry['id'],
+            ])
+
+            # The filename is part of the keyword index.  Only old_path itself changes its
+            # filename, so that's the only entry whose keywords need to be updated.
+            self._set_keywords(cursor, entry['id'], self.get_keywords_for_entry(entry))
 
     def get(self, path, *, conn=None):
         """
@@ -415,6 +966,11 @@ class FileIndex(Database):
         # An SQL ORDER BY statement to order results.  See library.sort_orders.
         order=None,
 
+        # If set, only return results that sort after a previous result, to resume a search
+        # without reading the results before it.  This is a list of (expression, 'ASC' or 'DESC',
+        # value) for each column in order, with the values from the previous result.
+        after=None,
+
         # By default, all filters must match for us to return a file.  If available_fields
         # is set, it's a list of keys in the entry which are available, and only search
         # filters whose required fields are present will be used.  For example, if
@@ -425,10 +981,6 @@ class FileIndex(Database):
         # loading the file's metadata.
         available_fields=None,
 
-        # If set, this is a (with_statement, params) tuple, which will be used as the
-        # source for the search instead of the database.
-        source=None,
-
         include_files=True, include_dirs=True,
         debug=False,
         conn=None
@@ -448,15 +1000,9 @@ class FileIndex(Database):
         where = []
         params = []
         joins = []
-        with_prefix = ''
+        schema = f'{self.schema}.'
 
         select_columns.append('files.*')
-        if source is None:
-            schema = f'{self.schema}.'
-        else:
-            with_prefix, source_params = source
-            params.extend(source_params)
-            schema = ''
 
         if paths:
             path_conds = []
@@ -470,7 +1016,7 @@ class FileIndex(Database):
                     params.append(path)
                 elif mode == self.SearchMode.Subdir:
                     # Only list files directly inside path.
-                    path_conds.append(f'{schema}files.parent = ?')
+                    path_conds.append(f'{schema}files.dir_id = (SELECT id FROM {schema}directories WHERE path = ?)')
                     params.append(path)
                 elif mode == self.SearchMode.Exact:
                     # Only list path itself.
@@ -495,27 +1041,35 @@ class FileIndex(Database):
             elif media_type == 'images':
                 where.append(f'{schema}mime_type LIKE "image/%"')
 
-        if total_pixels is not None:
-            # Minimum total pixels:
-            if total_pixels[0] is not None:
-                where.append(f'{schema}width*{schema}height >= ?')
-                params.append(total_pixels[0])
-
-            # Maximum total pixels:
-            if total_pixels[1] is not None:
-                where.append(f'{schema}width*{schema}height <= ?')
-                params.append(total_pixels[1])
-
-        if aspect_ratio is not None:
-            # Minimum aspect ratio:
-            if aspect_ratio[0] is not None:
-                where.append(f'1.0 * {schema}width/{schema}height >= ?')
-                params.append(aspect_ratio[0])
-
-            # Maximum aspect ratio:
-            if aspect_ratio[1] is not None:
-                where.append(f'1.0 * {schema}width/{schema}height <= ?')
-                params.append(aspect_ratio[1])
+        # Collect total_pixels and aspect_ratio conditions as (column, operator).
+        dimension_conds = []
+        dimension_params = []
+        for column, value_range in (('total_pixels', total_pixels), ('aspect_ratio', aspect_ratio)):
+            if value_range is None:
+                continue
+
+            # Minimum and maximum:
+            for operator, value in zip(('>=', '<='), value_range):
+                if value is not None:
+                    dimension_conds.append((column, operator))
+                    dimension_params.append(value)
+
+        if dimension_conds:
+            # Search the stored columns, so the search can use their indexes.
+            dimension_where = [f'{schema}files.{column} {operator} ?' for column, operator in dimension_conds]
+
+            if not paths or mode != self.SearchMode.Recursive:
+                where.extend(dimension_where)
+            elif self._should_search_by_dimensions(paths, dimension_where, dimension_params, conn=conn):
+                # Read the matching range of the dimension index and look up each file, rather
+                # than reading every file under the path.  This needs to be a subquery, or
+                # SQLite may still scan an index for the ORDER BY.
+                where.append(f'files.id IN (SELECT id FROM {schema}files WHERE {" AND ".join(dimension_where)})')
+            else:
+                # Use "+" so SQLite reads the files under the path and doesn't use the dimension
+                # index instead.
+                where.extend('+' + cond for cond in dimension_where)
+            params.extend(dimension_params)
 
         if bookmarked is not None:
             if bookmarked:
@@ -540,7 +1094,14 @@ class FileIndex(Database):
                         params.append(tag)
                     where.append('(' + ' OR '.join(tag_match) + ')')
         
-        if substr:
+        if substr and self.keyword_index == 'fts':
+            # Search for all words with a single FTS query, using a prefix match for each word.
+            # Keywords only contain letters and numbers, so they don't need escaping.
+            words = self.split_keywords(substr)
+            if words:
+                where.append(f'files.id IN (SELECT rowid FROM {schema}file_keywords_fts WHERE keywords MATCH ?)')
+                params.append(' AND '.join(f'"{word}"*' for word in words))
+        elif substr:
             for word_idx, word in enumerate(self.split_keywords(substr)):
                 # Each keyword match requires a separate join.
                 alias = 'keyword%i' % word_idx
@@ -550,6 +1111,9 @@ class FileIndex(Database):
                 where.append('%s.keyword GLOB ?' % alias)
                 params.append(word.lower() + '*')
 
+        if after:
+            where.append(self._get_keyset_condition(after, params))
+
         if order is None:
             order = ''
 
@@ -557,7 +1121,6 @@ class FileIndex(Database):
         joins = ('\n'.join(joins)) if joins else ''
 
         query = f"""
-            {with_prefix}
             SELECT {', '.join(select_columns)}
             FROM {schema}files AS files
             {joins}
@@ -572,8 +1135,10 @@ class FileIndex(Database):
                     result = dict(row)
                     log.debug('plan:', result)
 
-            for row in cursor.execute(query, params):
-                result = dict(row)
+            rows = cursor.execute(query, params)
+            columns = FileEntry.get_columns_for_cursor(cursor)
+            for row in rows:
+                result = FileEntry.from_row(columns, row)
                 try:
                     yield result
                 except GeneratorExit:
@@ -581,7 +1146,160 @@ class FileIndex(Database):
                     # the transaction.
                     return
 
-    def entry_matches_search(self, entry, conn=None, incomplete=False, **search_options):
+    # The number of rows _should_search_by_dimensions counts at most for each side.
+    _dimension_search_probe_limit = 10000
+
+    def _should_search_by_dimensions(self, paths, dimension_where, dimension_params, *, conn=None):
+        """
+        Return true if a recursive search with total_pixels or aspect_ratio conditions should
+        read the range of the dimension index, or false if it should read the files under
+        paths.
+
+        SQLite's statistics don't tell it how many files are under a path, so it can't make
+        this choice itself: a narrow range over a whole mount should read the dimension
+        index, but a wide range over a small directory should read the directory.  Count
+        both sides, up to a limit, and only use the dimension index if it's clearly smaller.
+        """
+        limit = self._dimension_search_probe_limit
+        with self.cursor(conn) as cursor:
+            dimension_count = cursor.execute(f'''
+                SELECT count(*) FROM (
+                    SELECT 1 FROM {self.schema}.files
+                    WHERE {' AND '.join(dimension_where)}
+                    LIMIT ?
+                )
+            ''', dimension_params + [limit]).fetchone()[0]
+
+            path_count = 0
+            for path in paths:
+                path_count += cursor.execute(f'''
+                    SELECT count(*) FROM (
+                        SELECT 1 FROM {self.schema}.files
+                        WHERE path LIKE ? ESCAPE "$"
+                        LIMIT ?
+                    )
+                ''', [self.escape_like(path) + os.path.sep + '%', limit]).fetchone()[0]
+
+        return dimension_count < min(path_count, limit)
+
+    @classmethod
+    def _get_keyset_condition(cls, after, params):
+        """
+        Return an SQL condition matching rows that sort after the values in after, and
+        add its parameters to params.  See search().
+
+        SQLite sorts NULL before everything else, so nulls are handled explicitly.
+        """
+        def sorts_after(expr, asc_desc, value):
+            if asc_desc == 'ASC':
+                if value is None:
+                    return f'{expr} IS NOT NULL', []
+                return f'{expr} > ?', [value]
+            else:
+                if value is None:
+                    return None, []
+                return f'({expr} < ? OR {expr} IS NULL)', [value]
+
+        # Match rows with a greater first column, or an equal first column and a greater
+        # second column, and so on.
+        terms = []
+        term_params = []
+        equal_conds = []
+        equal_params = []
+        for expr, asc_desc, value in after:
+            assert asc_desc in ('ASC', 'DESC'), asc_desc
+            cond, cond_params = sorts_after(expr, asc_desc, value)
+            if cond is not None:
+                terms.append(' AND '.join(equal_conds + [cond]))
+                term_params.extend(equal_params + cond_params)
+
+            equal_conds.append(f'{expr} IS ?')
+            equal_params.append(value)
+
+        if not terms:
+            return '0'
+
+        # Add a bound on the first column on its own where possible.  This is redundant, but it
+        # lets SQLite seek to the start of the page in an index instead of scanning from the beginning.
+        expr, asc_desc, value = after[0]
+        conds = []
+        if asc_desc == 'ASC' and value is not None:
+            conds.append(f'{expr} >= ?')
+            params.append(value)
+        elif asc_desc == 'DESC' and value is None:
+            conds.append(f'{expr} IS NULL')
+
+        conds.append('(' + ' OR '.join(f'({term})' for term in terms) + ')')
+        params.extend(term_params)
+        return ' AND '.join(conds)
+
+    def get_many(self, paths, *, conn=None):
+        """
+        Return a dictionary of entries for the given paths, looked up together.  Paths
+        that aren't in the index aren't included.
+        """
+        paths = [str(path) for path in paths]
+        results = {}
+        with self.cursor(conn) as cursor:
+            for start in range(0, len(paths), self._add_records_batch_size):
+                batch = paths[start:start+self._add_records_batch_size]
+                query = f"""
+                    SELECT *
+                    FROM {self.schema}.files
+                    WHERE path IN (%s)
+                """ % ', '.join('?'*len(batch))
+                rows = cursor.execute(query, batch)
+                columns = FileEntry.get_columns_for_cursor(cursor)
+                for row in rows:
+                    results[row['path']] = FileEntry.from_row(columns, row)
+
+        return results
+
+    def get_paths_after(self, after_id, limit, *, conn=None):
+        """
+        Return a list of (id, path) for up to limit records with IDs after after_id, in
+        ID order.  This is used to walk the whole index a piece at a time.
+        """
+        with self.cursor(conn) as cursor:
+            return [
+                (row['id'], row['path'])
+                for row in cursor.execute(f'''
+                    SELECT id, path FROM {self.schema}.files
+                    WHERE id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', [after_id, limit])
+            ]
+
+    def get_metadata_file_states(self, *, conn=None):
+        """
+        Return {directory: (mtime, size)} for metadata files that have been imported.
+
+        Library.quick_refresh uses this to skip metadata files that haven't changed since
+        they were last imported.  A directory's state is removed when a file in it is removed
+        from the index or renamed, so its metadata file is imported again.
+        """
+        with self.cursor(conn) as cursor:
+            return {
+                row['directory']: (row['mtime'], row['size'])
+                for row in cursor.execute(f'SELECT directory, mtime, size FROM {self.schema}.metadata_files')
+            }
+
+    def set_metadata_file_states(self, states, *, conn=None):
+        """
+        Record that metadata files have been imported.  states is a list of (directory, mtime,
+        size).
+        """
+        if not states:
+            return
+
+        with self.cursor(conn, write=True) as cursor:
+            cursor.executemany(f'''
+                INSERT OR REPLACE INTO {self.schema}.metadata_files (directory, mtime, size)
+                VALUES (?, ?, ?)
+            ''', states)
+
+    def entry_matches_search(self, entry, incomplete=False, **search_options):
         """
         Return true if the given entry matches the search options.  The entry doesn't
         need to be in the database.
@@ -589,79 +1307,197 @@ class FileIndex(Database):
         If incomplete is true and entry is unpopulated, do as much filtering as possible
         with the data available.  If a search filter can't be performed because entry
         doesn't have the data yet, we'll assume it matches.
+
+        If you're matching more than one entry against the same search, use compile_search
+        instead, so the search is only compiled once.
         """
-        # Create a WITH statement with the same schema as the "files" and "file_keywords"
-        # table, containing just this record.
-        params = []
-        withs = []
-
-        # If the entry has no ID, it doesn't actually exist in the database. Set a
-        # dummy ID, since if we leave it null, it won't join.
-        if 'id' not in entry:
-            entry = { 'id': 'placeholder-id' } | entry
-
-        # Add the files table.
-        field_names = list(entry.keys())
-        fields = [entry[field] for field in field_names]
-
-        file_with = WithBuilder(*field_names, table_name='files')
-        file_with.add_row(*fields)
-        file_with.get_params(params)
-        withs.append(file_with.get())
-
-        # Add the file_keywords table.
-        keywords = self.get_keywords_for_entry(entry)
-        if keywords:
-            keyword_with = WithBuilder('file_id', 'keyword', table_name='file_keywords')
-        
-            for keyword in keywords:
-                keyword_with.add_row(entry['id'], keyword)
-            keyword_with.get_params(params)
-            withs.append(keyword_with.get())
+        matches = self.compile_search(**search_options)
+        return matches(entry, incomplete=incomplete)
 
-        # Combine the result into a single WITH statement.
-        source = f"""WITH {", ".join(withs)}"""
+    def compile_search(self, *,
+        paths=None,
+        mode=SearchMode.Recursive,
+        substr=None,
+        media_type=None,
+        bookmarked=None,
+        bookmark_tags=None,
+        total_pixels=None,
+        aspect_ratio=None,
+        include_files=True, include_dirs=True,
+    ):
+        """
+        Compile search options into a function that tests whether an entry matches them.
 
-        # If incomplete matches are being allowed, tell search() which fields are
-        # available.
-        if incomplete:
-            available_fields = [field for field in field_names if entry[field] is not None]
-        else:
-            available_fields = None
+        The result is called as matches(entry, incomplete=False), and has the same semantics
+        as search() with the same options.  This lets us filter entries that aren't in the
+        database (or haven't been populated yet) without running a query for each one.
 
-        # Search for the entry using this WITH statement.  If it returns it as a result, it
-        # matches the search parameters.
-        for entry in self.search(source=(source, params), available_fields=available_fields, **search_options, conn=conn):
+        If incomplete is true, filters that need fields that aren't available in the entry
+        (fields that are missing or None) are skipped, like search's available_fields.
+        """
+        # A list of (required_fields, test) tuples.  If incomplete is true and any of
+        # required_fields aren't available, the test is skipped.
+        tests = []
+
+        def add_test(*required_fields):
+            def decorator(func):
+                tests.append((required_fields, func))
+                return func
+            return decorator
+
+        def in_range(value, value_range):
+            # NULL never matches a range comparison in SQL.
+            if value is None:
+                return False
+            if value_range[0] is not None and value < value_range[0]:
+                return False
+            if value_range[1] is not None and value > value_range[1]:
+                return False
             return True
 
-        return False
+        if paths:
+            paths = [str(path) for path in paths]
+            if mode == self.SearchMode.Recursive:
+                prefixes = tuple(path + os.path.sep for path in paths)
+                @add_test()
+                def test_paths(entry):
+                    return entry['path'] in paths or entry['path'].startswith(prefixes)
+            elif mode == self.SearchMode.Subdir:
+                @add_test()
+                def test_paths(entry):
+                    return entry['parent'] in paths
+            elif mode == self.SearchMode.Exact:
+                @add_test()
+                def test_paths(entry):
+                    return entry['path'] in paths
+            else:
+                assert False
+
+        if not include_files:
+            @add_test()
+            def test_include_files(entry):
+                return bool(entry['is_directory'])
+        if not include_dirs:
+            @add_test()
+            def test_include_dirs(entry):
+                return not entry['is_directory']
+
+        if media_type is not None:
+            assert media_type in ('videos', 'images')
+
+            if media_type == 'videos':
+                # Include animation, so searching for videos includes animated GIFs.  This is
+                # the only media type filter that's skipped for incomplete entries.
+                @add_test('animation')
+                def test_media_type(entry):
+                    return (entry.get('mime_type') or '').startswith('video/') or bool(entry.get('animation'))
+            elif media_type == 'images':
+                @add_test()
+                def test_media_type(entry):
+                    return (entry.get('mime_type') or '').startswith('image/')
+
+        if total_pixels is not None and any(value is not None for value in total_pixels):
+            @add_test('width', 'height')
+            def test_total_pixels(entry):
+                if entry.get('width') is None or entry.get('height') is None:
+                    return False
+                return in_range(entry['width'] * entry['height'], total_pixels)
+
+        if aspect_ratio is not None and any(value is not None for value in aspect_ratio):
+            @add_test('width', 'height')
+            def test_aspect_ratio(entry):
+                # SQLite returns NULL for division by zero, which never matches.
+                if entry.get('width') is None or not entry.get('height'):
+                    return False
+                return in_range(entry['width'] / entry['height'], aspect_ratio)
+
+        if bookmarked is not None:
+            if bookmarked:
+                @add_test()
+                def test_bookmarked(entry):
+                    return bool(entry.get('bookmarked'))
+            else:
+                @add_test()
+                def test_bookmarked(entry):
+                    # NULL doesn't match "not bookmarked" either.
+                    return entry.get('bookmarked') is not None and not entry['bookmarked']
+
+            if bookmark_tags is not None:
+                if bookmark_tags == '':
+                    @add_test()
+                    def test_bookmark_tags(entry):
+                        return entry.get('bookmark_tags') == '' and bool(entry.get('bookmarked'))
+                else:
+                    # Match entries with any of the tags.  Empty tags are never stored in the
+                    # bookmark_tags table, so they never match.
+                    wanted_tags = set(bookmark_tags.split(' ')) - {''}
+                    @add_test()
+                    def test_bookmark_tags(entry):
+                        entry_tags = set((entry.get('bookmark_tags') or '').split(' ')) - {''}
+                        return not wanted_tags.isdisjoint(entry_tags)
+
+        if substr:
+            # Each word must prefix match at least one of the entry's keywords.
+            words = self.split_keywords(substr)
+            @add_test()
+            def test_substr(entry):
+                keywords = self.get_keywords_for_entry(entry)
+                for word in words:
+                    if not any(keyword.startswith(word) for keyword in keywords):
+                        return False
+                return True
+
+        def matches(entry, incomplete=False):
+            for required_fields, test in tests:
+                if incomplete and any(entry.get(field) is None for field in required_fields):
+                    continue
+
+                if not test(entry):
+                    return False
+
+            return True
+
+        return matches
 
     def get_all_bookmark_tags(self, *, conn=None):
         """
-        Return a list of all bookmark tags.
+        Return a dictionary of {tag: count} for all bookmark tags.  The number of untagged
+        bookmarks is included as the tag "".
         """
         with self.cursor(conn) as cursor:
-            # Get tag counts:
-            results = {}
-            query = f"""
-                SELECT tag, count(tag) FROM bookmark_tags
-                GROUP BY tag
-            """
-            for row in cursor.execute(query):
-                tag = row['tag']
-                results[tag] = row['count(tag)']
-
-            # Get the number of untagged bookmarks.  This search uses the files_untagged_bookmarks
-            # index.
-            query = f"""
-                SELECT count(*) FROM files
-                WHERE bookmark_tags == "" AND bookmarked
-            """
-            for row in cursor.execute(query):
-                results[''] = row['count(*)']
-
+            results = {
+                row['tag']: row['count']
+                for row in cursor.execute(f'SELECT tag, count FROM {self.schema}.bookmark_tag_counts')
+            }
+            results.setdefault('', 0)
             return results
 
+    def check_bookmark_tag_counts(self, *, fix=False, conn=None):
+        """
+        Compare the stored bookmark tag counts against a full count, returning a dictionary
+        of {tag: (stored_count, actual_count)} for each tag that doesn't match.  If fix is
+        true, replace the stored counts with the full count if they don't match.
+        """
+        # Read both in one transaction, so they see the same data.
+        with self.connect(conn, write=fix) as conn:
+            stored = {
+                row['tag']: row['count']
+                for row in conn.execute(f'SELECT tag, count FROM {self.schema}.bookmark_tag_counts')
+            }
+            actual = self._count_bookmark_tags(conn=conn)
+
+            mismatches = {
+                tag: (stored.get(tag, 0), actual.get(tag, 0))
+                for tag in stored.keys() | actual.keys()
+                if stored.get(tag, 0) != actual.get(tag, 0)
+            }
+
+            if mismatches and fix:
+                log.warn(f'Fixing {len(mismatches)} incorrect bookmark tag counts')
+                self._rebuild_bookmark_tag_counts(conn=conn)
+
+            return mismatches
+
 async def test():
     try:
         os.unlink('test.sqlite')
@@ -750,6 +1586,50 @@ async def test():
     assert Path(new_entry['path']) == Path('f:/test')
     assert Path(new_entry['parent']) == Path('f:/')
 
+    # Test that add_records only updates keywords and tags that changed.
+    entry = path_record(Path('f:/keywords'))
+    entry.update({'title': 'apple banana', 'bookmarked': True, 'bookmark_tags': 'tag1 tag2'})
+    entry2 = path_record(Path('f:/keywords2'))
+    db.add_records([entry, entry2])
+    assert entry['id'] != entry2['id']
+    assert [result['path'] for result in db.search(substr='banana')] == [entry['path']]
+
+    entry = entry.copy()
+    entry.update({'title': 'apple cherry', 'bookmark_tags': 'tag2 tag3'})
+    db.add_records([entry])
+    assert [result['path'] for result in db.search(substr='banana')] == []
+    assert [result['path'] for result in db.search(substr='apple cherry')] == [entry['path']]
+    assert [result['path'] for result in db.search(bookmarked=True, bookmark_tags='tag1')] == []
+    assert [result['path'] for result in db.search(bookmarked=True, bookmark_tags='tag3')] == [entry['path']]
+
+    # Test that bookmark tag counts follow changes to tags, deletes and renames.
+    assert db.get_all_bookmark_tags() == { 'tag2': 1, 'tag3': 1, '': 0 }
+    entry2 = entry2.copy()
+    entry2.update({'bookmarked': True, 'bookmark_tags': ''})
+    db.add_records([entry2])
+    assert db.get_all_bookmark_tags() == { 'tag2': 1, 'tag3': 1, '': 1 }
+    db.rename(entry['path'], str(Path('f:/keywords3')))
+    db.delete_recursively([entry2['path']])
+    assert db.get_all_bookmark_tags() == { 'tag2': 1, 'tag3': 1, '': 0 }
+    assert db.check_bookmark_tag_counts() == {}
+
+    # Test that the consistency check finds and fixes incorrect counts.
+    with db.connect(write=True) as conn:
+        conn.execute(f'UPDATE {db.schema}.bookmark_tag_counts SET count = 5 WHERE tag = "tag2"')
+    assert db.check_bookmark_tag_counts(fix=True) == { 'tag2': (5, 1) }
+    assert db.check_bookmark_tag_counts() == {}
+
+    # Test that metadata file states are discarded when a file in their directory is
+    # removed or renamed.
+    db.add_records([path_record(Path('f:/meta1/a')), path_record(Path('f:/meta2/b')), path_record(Path('f:/meta3/c'))])
+    db.set_metadata_file_states([(str(Path(f'f:/meta{idx}')), 10, 100) for idx in (1, 2, 3)])
+    db.delete_recursively([str(Path('f:/meta1/a'))])
+    db.rename(str(Path('f:/meta2/b')), str(Path('f:/meta2/b2')))
+    assert db.get_metadata_file_states() == { str(Path('f:/meta3')): (10, 100) }
+
+    await test_rename()
+    await test_search_predicates()
+
 #    entry['comment'] = 'foo'
 #    db.add_record(entry)
 #
@@ -761,5 +1641,626 @@ async def test():
     for row in db.conn.execute('select * from file_tags'):
         log.info(row['file_id'], row['tag'])
 
+def _create_test_db(db_path, **kwargs):
+    """
+    Delete the database at db_path left by a previous run, and return a new FileIndex there.
+    """
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.unlink(db_path + suffix)
+        except FileNotFoundError:
+            pass
+
+    return FileIndex(db_path, **kwargs)
+
+def _make_test_entries(count, get_path, **fields):
+    """
+    Return count unpopulated image entries for benchmarks.  get_path(idx) returns the path
+    of each entry, and fields are added to all of them.
+    """
+    entries = []
+    for idx in range(count):
+        path = get_path(idx)
+        entries.append({
+            'populated': False,
+            'path': path,
+            'parent': os.path.dirname(path),
+            'path_lowercase': path.lower(),
+            'basename_if_directory_lowercase': None,
+            'is_directory': False,
+            'mtime': 10,
+            'ctime': 10,
+            'filesystem_mtime': 10,
+            'tags': '',
+            'title': '',
+            'comment': '',
+            'mime_type': 'image/jpeg',
+            'author': '',
+            **fields,
+        })
+    return entries
+
+async def test_search_predicates():
+    """
+    Check that compile_search matches the same entries as FileIndex.search, and compare
+    the per-entry cost of the two.
+    """
+    import itertools, random, time
+
+    db = _create_test_db('test-predicates.sqlite')
+
+    # Create a mix of entries with different media types, sizes, bookmarks and keywords.
+    # Some entries are missing dimensions or animation, like unpopulated entries.
+    random.seed(1)
+    words = ['apple', 'apricot', 'banana', 'cherry', 'blue', 'sky', 'page', '12']
+    mime_types = ['image/jpeg', 'image/png', 'image/gif', 'video/mp4', 'application/folder']
+    with db.connect(write=True) as conn:
+        for idx in range(500):
+            mime_type = random.choice(mime_types)
+            is_directory = mime_type == 'application/folder'
+            parent = os.path.join(os.path.sep + 'root', random.choice(['a', 'b', os.path.join('a', 'c')]))
+            filename = ' '.join(random.sample(words, 2)) + f' {idx}'
+            path = os.path.join(parent, filename)
+            width = random.choice([None, 0, 100, 1000, 3000])
+            height = random.choice([None, 0, 100, 1000, 2000])
+            bookmarked = random.random() < 0.5
+            bookmark_tags = ' '.join(random.sample(['tag1', 'tag2', 'tag3'], random.randint(0, 2))) if bookmarked else ''
+
+            db.add_record({
+                'populated': True,
+                'path': path,
+                'parent': parent,
+                'path_lowercase': path.lower(),
+                'basename_if_directory_lowercase': filename.lower() if is_directory else None,
+                'mtime': 10,
+                'ctime': 10,
+                'filesystem_mtime': 10,
+                'is_directory': is_directory,
+                'width': width,
+                'height': height,
+                'tags': random.choice(['', 'cherry blossom']),
+                'title': '',
+                'comment': '',
+                'author': random.choice(['', 'Someone']),
+                'mime_type': mime_type,
+                'animation': random.choice([None, False, True]),
+                'bookmarked': bookmarked,
+                'bookmark_tags': bookmark_tags,
+            }, conn=conn)
+
+    all_entries = list(db.search())
+
+    option_values = {
+        'substr': [None, 'ap', 'apple sky', 'cherry', 'someone', 'nomatch'],
+        'media_type': [None, 'images', 'videos'],
+        'total_pixels': [None, [100000, None], [None, 100000], [None, None]],
+        'aspect_ratio': [None, [1, None], [0.5, 1.5]],
+        'bookmarked': [None, True, False],
+        'bookmark_tags': [None, '', 'tag1', 'tag2 tag3'],
+        'include_files': [True, False],
+    }
+
+    # Check each combination of options.  Test paths and modes separately, to keep the
+    # number of combinations down.
+    keys = list(option_values.keys())
+    combinations = [dict(zip(keys, values)) for values in itertools.product(*option_values.values())]
+    combinations += [
+        { 'paths': [os.path.join(os.path.sep + 'root', 'a')], 'mode': mode }
+        for mode in FileIndex.SearchMode
+    ]
+
+    # Check recursive dimension searches, which can read either the path or the dimension
+    # index depending on which matches fewer files.
+    combinations += [
+        { 'paths': [os.path.join(os.path.sep + 'root', path)], 'mode': FileIndex.SearchMode.Recursive, **dimensions }
+        for path in ('a', os.path.join('a', 'c'))
+        for dimensions in ({ 'total_pixels': [5000000, None] }, { 'total_pixels': [None, 100000] }, { 'aspect_ratio': [1, None], 'total_pixels': [100000, None] })
+    ]
+
+    checked = 0
+    for search_options in combinations:
+        # bookmark_tags is only used when bookmarked is set.
+        if search_options.get('bookmark_tags') is not None and search_options.get('bookmarked') is None:
+            continue
+
+        matches = db.compile_search(**search_options)
+
+        # Check complete matching against the database search.
+        expected_ids = {entry['id'] for entry in db.search(**search_options)}
+        actual_ids = {entry['id'] for entry in all_entries if matches(entry)}
+        assert expected_ids == actual_ids, (search_options, expected_ids ^ actual_ids)
+
+        # Check incomplete matching.  search() takes a single list of available fields, so
+        # group entries by which fields they have available.
+        groups = {}
+        for entry in all_entries:
+            available_fields = tuple(sorted(key for key, value in entry.items() if value is not None))
+            groups.setdefault(available_fields, set()).add(entry['id'])
+
+        for available_fields, group_ids in groups.items():
+            expected_ids = {entry['id'] for entry in db.search(available_fields=available_fields, **search_options)} & group_ids
+            actual_ids = {entry['id'] for entry in all_entries if entry['id'] in group_ids and matches(entry, incomplete=True)}
+            assert expected_ids == actual_ids, (search_options, available_fields, expected_ids ^ actual_ids)
+
+        checked += 1
+
+    log.info(f'Search predicates match FileIndex.search for {checked} searches')
+
+    # Compare the per-entry cost of running a query per entry against the compiled predicate.
+    search_options = { 'substr': 'apple', 'media_type': 'images', 'total_pixels': [100000, None], 'bookmarked': True }
+    entries = all_entries[:200]
+
+    start = time.time()
+    for entry in entries:
+        for result in db.search(paths=[entry['path']], mode=FileIndex.SearchMode.Exact, **search_options):
+            pass
+    sql_time = (time.time() - start) / len(entries)
+
+    start = time.time()
+    matches = db.compile_search(**search_options)
+    for entry in entries:
+        matches(entry)
+    predicate_time = (time.time() - start) / len(entries)
+
+    log.info(f'Per-entry cost: SQL query {sql_time*1000000:.1f}us, compiled predicate {predicate_time*1000000:.1f}us')
+
+async def test_rename():
+    """
+    Check that rename updates every field derived from the path of the renamed file and
+    the files inside it, and nothing else.
+    """
+    db = _create_test_db('test-rename.sqlite')
+
+    def make_entry(path, is_directory=False, **fields):
+        entry = {
+            'populated': True,
+            'path': path,
+            'parent': str(Path(path).parent),
+            'path_lowercase': path.lower(),
+            'basename_if_directory_lowercase': os.path.basename(path).lower() if is_directory else None,
+            'mtime': 10,
+            'ctime': 10,
+            'filesystem_mtime': 10,
+            'is_directory': is_directory,
+            'tags': '',
+            'title': '',
+            'comment': '',
+            'mime_type': 'application/folder' if is_directory else 'image/jpeg',
+            'author': '',
+            'bookmarked': True,
+            'bookmark_tags': 'tag1',
+        }
+        entry.update(fields)
+        return entry
+
+    root = os.path.join(os.path.sep + 'root')
+    def join(*parts):
+        return os.path.join(root, *parts)
+
+    # The directory being renamed contains LIKE wildcards and non-ASCII characters, and
+    # there are siblings that share its prefix.
+    old = join('Ä 100%_old')
+    db.add_records([
+        make_entry(old, is_directory=True),
+        make_entry(join('Ä 100%_old', 'Image 1.jpg')),
+        make_entry(join('Ä 100%_old', 'Sub'), is_directory=True),
+        make_entry(join('Ä 100%_old', 'Sub', 'Image 2.jpg')),
+        make_entry(join('Ä 100%_old', 'Sub', 'Deeper', 'Image 3.jpg')),
+        make_entry(join('Ä 100%_old2', 'Image 4.jpg')),
+        make_entry(join('Ä 100x_old', 'Image 5.jpg')),
+
+        # Stale entries at the new path, which are replaced.
+        make_entry(join('Moved', 'Ö New', 'Stale.jpg')),
+    ])
+    unrelated = {entry['path']: entry for entry in db.search(paths=[join('Ä 100%_old2'), join('Ä 100x_old')])}
+    ids = {entry['path']: entry['id'] for entry in db.search(paths=[old])}
+    tag_counts = db.get_all_bookmark_tags()
+
+    # Move it to a different parent, changing its name.
+    new = join('Moved', 'Ö New')
+    db.rename(old, new)
+
+    assert list(db.search(paths=[old])) == []
+    assert db.get(join('Moved', 'Ö New', 'Stale.jpg')) is None
+
+    renamed = {entry['path']: entry for entry in db.search(paths=[new])}
+    assert sorted(renamed) == sorted(new + path[len(old):] for path in ids), renamed.keys()
+    for path, entry in renamed.items():
+        # Each renamed entry keeps its ID, and its derived fields match what add_records
+        # would store for the new path.
+        assert entry['id'] == ids[old + path[len(new):]]
+        assert entry['parent'] == str(Path(path).parent), entry
+        assert entry['path_lowercase'] == path.lower(), entry
+        assert entry['shuffle_key'] == misc.shuffle_key(path.lower(), entry['is_directory']), entry
+        assert entry['basename_if_directory_lowercase'] == (os.path.basename(path).lower() if entry['is_directory'] else None), entry
+        for key, value in db._get_natural_sort_keys(path, entry['is_directory']).items():
+            assert entry[key] == value, entry
+
+    # The renamed directory's keywords follow its new name.
+    assert [entry['path'] for entry in db.search(substr='new', paths=[root])] == [new]
+    assert [entry['path'] for entry in db.search(substr='100', paths=[root])] == []
+
+    # Siblings sharing the old prefix are untouched, and bookmarks aren't affected.
+    assert {entry['path']: entry for entry in db.search(paths=[join('Ä 100%_old2'), join('Ä 100x_old')])} == unrelated
+    assert db.get_all_bookmark_tags() == { 'tag1': tag_counts['tag1'] - 1, '': 0 }
+
+    # Rename a file, and rename something that isn't in the index.
+    file_path = join('Ä 100x_old', 'Image 5.jpg')
+    db.rename(file_path, join('Ä 100x_old', 'image 6.JPG'))
+    entry = db.get(join('Ä 100x_old', 'image 6.JPG'))
+    assert entry['path_lowercase'] == entry['path'].lower()
+    assert entry['basename_if_directory_lowercase'] is None
+    assert db.get(file_path) is None
+    db.rename(join('missing'), join('missing2'))
+
+    # Every file's dir_id points to its parent.
+    with db.connect() as conn:
+        mismatched = conn.execute(f'''
+            SELECT files.path FROM {db.schema}.files
+            LEFT JOIN {db.schema}.directories ON directories.id = files.dir_id
+            WHERE directories.path IS NOT files.parent
+        ''').fetchall()
+        assert not mismatched, [row['path'] for row in mismatched]
+
+async def test_rename_benchmark(count=50000):
+    """
+    Measure renaming a directory containing count files in 50 subdirectories, compared
+    to updating each file with its own query.
+    """
+    import time
+
+    db = _create_test_db('test-rename.sqlite')
+
+    folder = os.path.join(os.path.sep + 'root', 'images')
+    db.add_records(_make_test_entries(count, lambda idx: os.path.join(folder, 'dir%i' % (idx % 50), f'image {idx}.jpg')))
+
+    def rename_per_file(old_path, new_path):
+        # This is how rename updated files before: one query per file.
+        with db.connect(write=True) as conn:
+            for entry in list(db.search(paths=[old_path], conn=conn)):
+                path = new_path + entry['path'][len(old_path):]
+                conn.execute(f'''
+                    UPDATE {db.schema}.files
+                        SET path = ?, parent = ?, path_lowercase = ?, shuffle_key = ?
+                        WHERE id = ?
+                ''', [path, str(Path(path).parent), path.lower(), misc.shuffle_key(path.lower(), entry['is_directory']), entry['id']])
+
+    renamed = folder + '2'
+    for name, rename in (('per file', rename_per_file), ('set-based', db.rename)):
+        start = time.time()
+        rename(folder, renamed)
+        took = time.time() - start
+        log.info(f'Rename {count} files, {name}: {took*1000:.0f}ms')
+
+        assert db.get(os.path.join(renamed, 'dir0', 'image 0.jpg')) is not None
+        folder, renamed = renamed, folder
+
+async def test_directory_benchmark(count=200000, collections=10, albums=20):
+    """
+    Measure the database size and subtree operations on a library of count files in
+    collections directories, each with albums subdirectories.
+    """
+    import time
+
+    db = _create_test_db('test-directories.sqlite')
+
+    root = os.path.join(os.path.sep + 'home', 'user', 'Pictures')
+    def get_collection(idx):
+        return os.path.join(root, f'Collection {idx}')
+    def get_album(idx):
+        return os.path.join(get_collection(idx % collections), f'Album {idx // collections}')
+
+    def get_path(idx):
+        return os.path.join(get_album(idx % (collections * albums)), f'IMG_{idx:06}.jpg')
+    db.add_records(_make_test_entries(count, get_path, width=1920, height=1080))
+    db.optimize()
+
+    with db.connect() as conn:
+        page_size = conn.execute(f'PRAGMA {db.schema}.page_size').fetchone()[0]
+        page_count = conn.execute(f'PRAGMA {db.schema}.page_count').fetchone()[0]
+        free_pages = conn.execute(f'PRAGMA {db.schema}.freelist_count').fetchone()[0]
+    log.info(f'{count} files: {(page_count - free_pages) * page_size / 1024 / 1024:.1f}MB')
+
+    def timed(name, func, runs=1):
+        start = time.time()
+        for _ in range(runs):
+            result = func()
+        log.info(f'{name}: {(time.time() - start) / runs * 1000:.1f}ms')
+        return result
+
+    album = get_album(0)
+    collection = get_collection(0)
+    results = timed('Search an album', lambda: list(db.search(paths=[album], mode=FileIndex.SearchMode.Subdir)), runs=10)
+    assert len(results) == count // (collections * albums)
+    results = timed('Search a collection recursively', lambda: list(db.search(paths=[collection])), runs=3)
+    assert len(results) == count // collections
+
+    timed('Rename a collection', lambda: db.rename(collection, collection + ' renamed'))
+    timed('Delete a collection', lambda: db.delete_recursively([collection + ' renamed']))
+    assert list(db.search(paths=[collection + ' renamed'])) == []
+
+async def test_add_records_benchmark(count=100000):
+    """
+    Compare adding entries one at a time with add_record to adding them with add_records.
+    """
+    import time
+
+    def make_entries(prefix):
+        def get_path(idx):
+            return os.path.join(os.path.sep + prefix, 'dir%i' % (idx // 1000), f'image {idx} #{idx % 10}.jpg')
+
+        entries = _make_test_entries(count, get_path, bookmarked=True, bookmark_tags='tag1 tag2')
+        for idx, entry in enumerate(entries):
+            entry['title'] = f'image {idx}'
+        return entries
+
+    for keyword_index in ('table', 'fts'):
+        db = _create_test_db(f'test-add-records-{keyword_index}.sqlite', keyword_index=keyword_index)
+
+        def add_one_at_a_time(entries):
+            with db.connect(write=True) as conn:
+                for entry in entries:
+                    db.add_record(entry, conn=conn)
+
+        def add_together(entries):
+            db.add_records(entries)
+
+        for prefix, add in (('single', add_one_at_a_time), ('batch', add_together)):
+            entries = make_entries(prefix)
+
+            def run(name):
+                start = time.time()
+                add(entries)
+                took = time.time() - start
+                log.info(f'{keyword_index} {prefix}: {name}: {count / took:.0f} entries/sec')
+
+            # Add new entries, re-add them unchanged like a refresh does, then change
+            # a keyword field and bookmark tags.
+            run('insert')
+            run('unchanged')
+            for entry in entries:
+                entry['title'] += ' edited'
+                entry['bookmark_tags'] = 'tag2 tag3'
+            run('update')
+
+async def test_keyword_index_benchmark(count=1000000):
+    """
+    Compare keyword searches using the file_keywords table and the FTS index on a
+    synthetic library of count files.
+    """
+    import random, time
+
+    random.seed(1)
+    vocabulary = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(3, 8))) for _ in range(5000)]
+
+    for keyword_index in ('table', 'fts'):
+        db = _create_test_db(f'test-keywords-{keyword_index}.sqlite', keyword_index=keyword_index)
+
+        # Insert rows directly rather than with add_record, and build the keyword index
+        # in one pass at the end, so setting up a large database doesn't take too long.
+        start = time.time()
+        random.seed(2)
+        with db.connect(write=True) as conn:
+            rows = []
+            for idx in range(count):
+                parent = os.path.join(os.path.sep + 'root', 'dir%i' % (idx // 1000))
+                filename = ' '.join(random.sample(vocabulary, 4)) + f' {idx}.jpg'
+                path = os.path.join(parent, filename)
+                rows.append((path, parent, path.lower(), 10, 10, 10, '', '', '', 'image/jpeg', ''))
+
+            conn.executemany(f'''
+                INSERT INTO {db.schema}.files
+                    (path, parent, path_lowercase, mtime, ctime, filesystem_mtime, tags, title, comment, mime_type, author)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            db._rebuild_keyword_index(conn=conn)
+
+        log.info(f'{keyword_index}: built {count} files in {time.time() - start:.1f}s')
+
+        random.seed(3)
+        for word_count in (1, 2, 3):
+            # Search for prefixes of words from random filenames, so multi-word searches have results.
+            searches = []
+            for _ in range(20):
+                words = random.choice(rows)[0].split(os.path.sep)[-1].split(' ')[0:4]
+                searches.append(' '.join(word[0:4] for word in random.sample(words, word_count)))
+
+            start = time.time()
+            results = 0
+            for substr in searches:
+                results += sum(1 for _ in db.search(substr=substr))
+            took = (time.time() - start) / len(searches)
+            log.info(f'{keyword_index}: {word_count}-word search: {took*1000:.1f}ms per search ({results} results)')
+
+        # Time updating an entry's keywords.
+        entries = list(db.search(paths=[os.path.join(os.path.sep + 'root', 'dir1')], mode=FileIndex.SearchMode.Subdir))
+        start = time.time()
+        with db.connect(write=True) as conn:
+            for entry in entries:
+                entry['title'] = random.choice(vocabulary)
+                entry['bookmarked'] = False
+                db.add_record(entry, conn=conn)
+        took = (time.time() - start) / len(entries)
+        log.info(f'{keyword_index}: keyword update: {took*1000000:.1f}us per entry')
+
+async def test_keyset_benchmark(count=100000, page_size=50):
+    """
+    Compare reading a page of search results deep into a search by skipping the results
+    before it, and by resuming from the previous result with after.
+    """
+    import itertools, time
+
+    db = _create_test_db('test-keyset.sqlite')
+
+    # Insert rows directly, with a directory every 100 files so the normal sort has both.
+    with db.connect(write=True) as conn:
+        rows = []
+        for idx in range(count):
+            is_directory = idx % 100 == 0
+            filename = f'image {idx % 1000} #{idx // 1000}' + ('' if is_directory else '.jpg')
+            path = os.path.join(os.path.sep + 'root', filename)
+            keys = db._get_natural_sort_keys(path, is_directory)
+            rows.append((path, os.path.sep + 'root', path.lower(), filename.lower() if is_directory else None, is_directory,
+                keys['natural_sort_key'], keys['natural_sort_key_reverse_pages'], 10, 10, 10, '', '', '', 'image/jpeg', ''))
+
+        conn.executemany(f'''
+            INSERT INTO {db.schema}.files
+                (path, parent, path_lowercase, basename_if_directory_lowercase, is_directory,
+                 natural_sort_key, natural_sort_key_reverse_pages, mtime, ctime, filesystem_mtime, tags, title, comment, mime_type, author)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+    # These are the same as library.sort_orders.
+    orders = {
+        'normal': [('basename_if_directory_lowercase', 'DESC'), ('path_lowercase', 'ASC')],
+        '-normal': [('basename_if_directory_lowercase', 'ASC'), ('path_lowercase', 'DESC')],
+        'natural': [('natural_sort_key', 'ASC'), ('path_lowercase', 'ASC')],
+        '-natural': [('natural_sort_key', 'DESC'), ('path_lowercase', 'DESC')],
+    }
+
+    for name, columns in orders.items():
+        order = 'ORDER BY ' + ', '.join('%s %s' % (expr, asc_desc) for expr, asc_desc in columns)
+        search_paths = [os.path.sep + 'root']
+        for offset in (page_size, count // 10, count // 2, count - page_size):
+            start = time.time()
+            results = db.search(paths=search_paths, order=order)
+            skipped = list(itertools.islice(results, offset - 1, offset + page_size))
+            results.close()
+            skip_time = time.time() - start
+
+            # Resume after the result before the page.
+            previous = skipped[0]
+            after = [(expr, asc_desc, previous[expr]) for expr, asc_desc in columns]
+            start = time.time()
+            results = db.search(paths=search_paths, order=order, after=after)
+            resumed = list(itertools.islice(results, page_size))
+            results.close()
+            resume_time = time.time() - start
+
+            assert [entry['path'] for entry in resumed] == [entry['path'] for entry in skipped[1:]]
+            log.info(f'{name}: page at {offset}: skipping {skip_time*1000:.1f}ms, resuming {resume_time*1000:.1f}ms')
+
+async def test_read_benchmark(count=10000, reads=20000, threads=(1, 4, 8)):
+    """
+    Measure small reads from several threads using read-only connections, and using
+    pooled connections with a transaction for each read.
+    """
+    import random, time
+    from concurrent.futures import ThreadPoolExecutor
+
+    db = _create_test_db('test-read.sqlite')
+
+    entries = _make_test_entries(count, lambda idx: os.path.join(os.path.sep + 'root', f'image {idx}.jpg'))
+    db.add_records(entries)
+
+    random.seed(1)
+    paths = [random.choice(entries)['path'] for _ in range(reads)]
+
+    def read_only(path):
+        return db.get_many([path])
+
+    def read_in_transaction(path):
+        with db.connect() as conn:
+            return db.get_many([path], conn=conn)
+
+    for read in (read_in_transaction, read_only):
+        for thread_count in threads:
+            def run():
+                with ThreadPoolExecutor(thread_count) as executor:
+                    start = time.time()
+                    for result in executor.map(read, paths):
+                        assert len(result) == 1
+                    return time.time() - start
+
+            total = await asyncio.to_thread(run)
+            log.info(f'{read.__name__}, {thread_count} threads: {reads / total:.0f} reads/sec')
+
+    log.info(f'Pool: {db.get_pool_stats()}')
+
+async def test_dimension_search_benchmark(count=1000000, search_count=20):
+    """
+    Compare total_pixels and aspect_ratio searches using the indexed columns with
+    computing them from width and height, within a directory and recursively.
+    """
+    import random, time
+
+    db = _create_test_db('test-dimensions.sqlite')
+
+    # Insert rows directly, in 1000 directories.
+    random.seed(1)
+    start = time.time()
+    with db.connect(write=True) as conn:
+        rows = []
+        for idx in range(count):
+            parent = os.path.join(os.path.sep + 'root', 'dir%i' % (idx // 1000))
+            path = os.path.join(parent, f'image {idx}.jpg')
+            width = random.randint(100, 4000)
+            height = random.randint(100, 4000)
+            fields = db._get_dimension_fields(width, height)
+            rows.append((path, parent, path.lower(), width, height, fields['total_pixels'], fields['aspect_ratio'],
+                10, 10, 10, '', '', '', 'image/jpeg', ''))
+
+        conn.executemany(f'''
+            INSERT INTO {db.schema}.files
+                (path, parent, path_lowercase, width, height, total_pixels, aspect_ratio,
+                 mtime, ctime, filesystem_mtime, tags, title, comment, mime_type, author)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    log.info(f'Built {count} files in {time.time() - start:.1f}s')
+
+    db.optimize()
+
+    # The conditions searches used before total_pixels and aspect_ratio were stored.
+    computed = {
+        'total_pixels': ('width*height >= ?', 'width*height <= ?'),
+        'aspect_ratio': ('1.0 * width/height >= ?', '1.0 * width/height <= ?'),
+    }
+    searches = [
+        ('total_pixels', [15000000, None]),
+        ('aspect_ratio', [3, 4]),
+        ('aspect_ratio', [0.5, 2]),
+    ]
+
+    root = os.path.sep + 'root'
+    random.seed(2)
+    directories = [os.path.join(root, 'dir%i' % random.randrange(count // 1000)) for _ in range(search_count)]
+    order = 'ORDER BY natural_sort_key ASC, path_lowercase ASC'
+
+    for field, value_range in searches:
+        for mode, search_paths in (
+            (FileIndex.SearchMode.Subdir, directories),
+            (FileIndex.SearchMode.Recursive, directories),
+            (FileIndex.SearchMode.Recursive, [root] * 3),
+        ):
+            # Search with the same query search() used to build.
+            start = time.time()
+            expected = []
+            with db.cursor() as cursor:
+                for path in search_paths:
+                    if mode == FileIndex.SearchMode.Subdir:
+                        where = [f'dir_id = (SELECT id FROM {db.schema}.directories WHERE path = ?)']
+                        params = [path]
+                    else:
+                        where = ['(path LIKE ? ESCAPE "$" OR path = ?)']
+                        params = [db.escape_like(path) + os.path.sep + '%', path]
+
+                    for cond, value in zip(computed[field], value_range):
+                        if value is not None:
+                            where.append(cond)
+                            params.append(value)
+
+                    query = f'SELECT * FROM {db.schema}.files AS files WHERE {" AND ".join(where)} {order}'
+                    expected.append([dict(row)['id'] for row in cursor.execute(query, params)])
+            computed_time = (time.time() - start) / len(search_paths)
+
+            start = time.time()
+            actual = [[entry['id'] for entry in db.search(paths=[path], mode=mode, order=order, **{field: value_range})] for path in search_paths]
+            indexed_time = (time.time() - start) / len(search_paths)
+
+            assert actual == expected
+            results = sum(len(ids) for ids in actual) // len(search_paths)
+            where = 'root' if search_paths[0] == root else 'directory'
+            log.info(f'{field} {value_range}, {mode.name} {where}: computed {computed_time*1000:.1f}ms, indexed {indexed_time*1000:.1f}ms ({results} results)')
+
 if __name__ == '__main__':
     asyncio.run(test())
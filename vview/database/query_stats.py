@@ -0,0 +1,276 @@
+# Query statistics for Database.
+#
+# Every query run through Database.cursor is timed and counted by its shape: the SQL with
+# whitespace collapsed, literals replaced with placeholders and lists of parameters
+# collapsed, so the same query with different parameters is counted together.  Time is
+# counted while SQLite is running the query, including fetching rows, but not while the
+# caller is processing results between rows.
+#
+# When a query takes longer than slow_query_threshold, the query plan is captured with
+# EXPLAIN QUERY PLAN, so slow queries can be diagnosed without reproducing them.
+import bisect, functools, logging, re, sqlite3, threading, time
+
+log = logging.getLogger(__name__)
+
+# The upper bounds of the timing histogram buckets, in seconds.  The last bucket counts
+# everything slower.
+histogram_buckets = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3)
+
+class QueryStats:
+    # The maximum number of query shapes to track.  Queries with other shapes are counted
+    # together.
+    max_shapes = 1000
+
+    def __init__(self, *, slow_query_threshold=0.1):
+        """
+        Queries taking longer than slow_query_threshold seconds have their query plans
+        captured.
+        """
+        self.slow_query_threshold = slow_query_threshold
+
+        # shape -> stats dictionary.  This is protected by lock, since queries are run from
+        # many threads.
+        self.lock = threading.Lock()
+        self.shapes = {}
+
+    _whitespace = re.compile(r'\s+')
+    _string_literal = re.compile(r"'(?:[^']|'')*'")
+    _number_literal = re.compile(r'\b\d+(\.\d+)?\b')
+    _parameter_list = re.compile(r'\?(\s*,\s*\?)+')
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def get_shape(cls, sql):
+        """
+        Return the normalized shape of a query.  This is cached, since the same queries
+        are run over and over.
+        """
+        shape = cls._whitespace.sub(' ', sql).strip()
+        shape = cls._string_literal.sub('?', shape)
+        shape = cls._number_literal.sub('N', shape)
+        shape = cls._parameter_list.sub('?, ...', shape)
+        return shape
+
+    def wants_plan(self, shape, duration):
+        """
+        Return true if a query plan should be captured for a query of this shape that took
+        duration seconds.
+        """
+        if duration < self.slow_query_threshold:
+            return False
+
+        with self.lock:
+            stats = self.shapes.get(shape)
+            return stats is None or duration > stats['max_plan_time']
+
+    def record(self, shape, duration, rows, *, plan=None):
+        """
+        Record a query that took duration seconds and returned or changed rows rows.
+
+        If plan is set, it's the query plan for this query, which is kept if this is the
+        slowest planned query of this shape.
+        """
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                if len(self.shapes) >= self.max_shapes:
+                    shape = '(other)'
+                    stats = self.shapes.get(shape)
+
+                if stats is None:
+                    stats = self.shapes[shape] = {
+                        'count': 0,
+                        'total_time': 0,
+                        'max_time': 0,
+                        'rows': 0,
+                        'max_rows': 0,
+                        'slow_count': 0,
+                        'histogram': [0] * (len(histogram_buckets) + 1),
+                        'plan': None,
+                        'max_plan_time': 0,
+                    }
+
+            stats['count'] += 1
+            stats['total_time'] += duration
+            stats['max_time'] = max(stats['max_time'], duration)
+            stats['rows'] += rows
+            stats['max_rows'] = max(stats['max_rows'], rows)
+
+            stats['histogram'][bisect.bisect_left(histogram_buckets, duration)] += 1
+
+            if duration >= self.slow_query_threshold:
+                stats['slow_count'] += 1
+
+            if plan is not None and duration > stats['max_plan_time']:
+                if stats['plan'] is None:
+                    log.info('Slow query (%.0fms): %s\n%s' % (duration * 1000, shape, plan))
+                stats['plan'] = plan
+                stats['max_plan_time'] = duration
+
+    def get_slowest(self, count=20, *, order='total_time'):
+        """
+        Return stats for the count query shapes with the highest value of order, which is
+        "total_time", "max_time" or "mean_time".
+        """
+        assert order in ('total_time', 'max_time', 'mean_time'), order
+
+        with self.lock:
+            results = []
+            for shape, stats in self.shapes.items():
+                result = dict(stats)
+                result['shape'] = shape
+                result['mean_time'] = stats['total_time'] / stats['count']
+                result['histogram'] = list(stats['histogram'])
+                del result['max_plan_time']
+                results.append(result)
+
+        results.sort(key=lambda result: result[order], reverse=True)
+        return results[:count]
+
+    def clear(self):
+        with self.lock:
+            self.shapes.clear()
+
+    @classmethod
+    def get_histogram_buckets(cls):
+        """
+        Return the upper bounds of the histogram buckets in stats, in seconds.  The last
+        bucket has no upper bound.
+        """
+        return list(histogram_buckets) + [None]
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    A cursor that records each query it runs in its connection's QueryStats.
+
+    A query is recorded when the next query is run or the cursor is closed, so rows
+    fetched after executing it are included.
+    """
+    _shape = None
+
+    def execute(self, sql, parameters=()):
+        self._finish_query()
+        self._start_query(sql, parameters)
+
+        started_at = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._duration += time.perf_counter() - started_at
+
+    def executemany(self, sql, parameters):
+        self._finish_query()
+
+        # Keep the first set of parameters for EXPLAIN QUERY PLAN if we can do it without
+        # consuming an iterator.
+        if isinstance(parameters, (list, tuple)):
+            self._start_query(sql, parameters[0] if parameters else None)
+        else:
+            self._start_query(sql, None)
+
+        started_at = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._duration += time.perf_counter() - started_at
+
+    def __next__(self):
+        started_at = time.perf_counter()
+        try:
+            row = super().__next__()
+        finally:
+            self._duration += time.perf_counter() - started_at
+
+        self._rows += 1
+        return row
+
+    def fetchone(self):
+        started_at = time.perf_counter()
+        try:
+            row = super().fetchone()
+        finally:
+            self._duration += time.perf_counter() - started_at
+
+        if row is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            rows = super().fetchmany(*args, **kwargs)
+        finally:
+            self._duration += time.perf_counter() - started_at
+
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        started_at = time.perf_counter()
+        try:
+            rows = super().fetchall()
+        finally:
+            self._duration += time.perf_counter() - started_at
+
+        self._rows += len(rows)
+        return rows
+
+    def close(self):
+        self._finish_query()
+        super().close()
+
+    def _start_query(self, sql, parameters):
+        self._sql = sql
+        self._parameters = parameters
+        self._shape = QueryStats.get_shape(sql)
+        self._duration = 0
+        self._rows = 0
+
+    def _finish_query(self):
+        if self._shape is None:
+            return
+
+        shape = self._shape
+        self._shape = None
+
+        query_stats = self.connection.query_stats
+        if query_stats is None:
+            return
+
+        # Use the number of changed rows for writes.
+        rows = self._rows
+        if rows == 0 and self.rowcount > 0:
+            rows = self.rowcount
+
+        plan = None
+        if self._duration >= query_stats.slow_query_threshold and self._parameters is not None and query_stats.wants_plan(shape, self._duration):
+            plan = self._explain()
+
+        query_stats.record(shape, self._duration, rows, plan=plan)
+
+    def _explain(self):
+        """
+        Return the query plan for the current query, or None if it doesn't have one.
+        """
+        if not self._is_explainable(self._sql):
+            return None
+
+        try:
+            rows = self.connection.execute('EXPLAIN QUERY PLAN ' + self._sql, self._parameters).fetchall()
+        except sqlite3.Error as e:
+            log.info('Couldn\'t get query plan: %s' % e)
+            return None
+
+        # Indent each step by its depth in the plan, like the sqlite3 shell.
+        depths = {}
+        lines = []
+        for row in rows:
+            depth = depths.get(row[1], -1) + 1
+            depths[row[0]] = depth
+            lines.append('  ' * depth + row[3])
+        return '\n'.join(lines)
+
+    @classmethod
+    def _is_explainable(cls, sql):
+        statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        return statement in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
@@ -0,0 +1,636 @@
+# The search index is a local index of every file in the library, which we can search
+# when Windows Search isn't available.
+#
+# Unlike FileIndex, this only stores what we can get from the directory listing: the
+# filename, size and timestamps, plus image dimensions if FileIndex already knows them.
+# It's filled in by Library.refresh, and kept up to date by the change monitor.
+#
+# Results are returned as IndexedDirEntry, which works like windows_search.SearchDirEntry,
+# so Library.search can treat results from either one the same way.  Results can be sorted
+# by the same columns as FileIndex, so they can be merged with index results.
+import os, stat, logging
+from .database import Database, transaction
+from ..util import misc
+
+log = logging.getLogger(__name__)
+
+class IndexedDirEntryStat:
+    """
+    An os.stat_result-like object for IndexedDirEntry.  Only the fields we store are
+    available.
+    """
+    def __init__(self, row):
+        self.st_mode = (stat.S_IFDIR | 0o777) if row['is_directory'] else (stat.S_IFREG | 0o666)
+        self.st_size = row['size']
+        self.st_mtime = row['mtime']
+        self.st_atime = row['mtime']
+        self.st_ctime = row['ctime']
+        self.st_birthtime = row['ctime']
+        self.st_ino = 0
+        self.st_dev = 0
+        self.st_nlink = 1
+        self.st_uid = 0
+        self.st_gid = 0
+
+class IndexedDirEntry(os.PathLike):
+    """
+    A DirEntry-like class for search results.  This has the same interface as
+    windows_search.SearchDirEntry.
+    """
+    def __init__(self, row):
+        self._row = row
+        self._path = row['path']
+        self._stat = None
+
+    @property
+    def metadata(self):
+        """
+        Return any extra metadata that we know about the file.
+        """
+        result = { }
+        if self._row['width'] is not None and self._row['height'] is not None:
+            result['width'] = self._row['width']
+            result['height'] = self._row['height']
+        return result
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def name(self):
+        return os.path.basename(self._path)
+
+    def is_dir(self, *, follow_symlinks=True):
+        return bool(self._row['is_directory'])
+
+    def is_file(self, *, follow_symlinks=True):
+        return not self._row['is_directory']
+
+    def exists(self, *, follow_symlinks=True):
+        return True
+
+    @property
+    def is_symlink(self):
+        return False
+
+    def stat(self, *, follow_symlinks=True):
+        if self._stat is None:
+            self._stat = IndexedDirEntryStat(self._row)
+        return self._stat
+
+    def __fspath__(self):
+        return self._path
+
+    def __repr__(self):
+        return 'IndexedDirEntry(%s)' % self._path
+
+class SearchIndex(Database):
+    # Column expressions that results can be sorted by.  These are the FileIndex columns
+    # used by library.sort_orders.
+    sort_expressions = {
+        'path_lowercase',
+        'basename_if_directory_lowercase',
+        'round(ctime - 0.5)',
+        'natural_sort_key',
+        'natural_sort_key_reverse_pages',
+    }
+
+    # Fields that update_directory compares to see if a record has changed.
+    _compared_fields = ('is_directory', 'size', 'mtime', 'ctime', 'width', 'height')
+
+    def __init__(self, db_path, *, schema='search'):
+        """
+        db_path is the path to the database on the filesystem.
+        """
+        super().__init__(db_path, schema=schema)
+
+    def open_db(self):
+        conn = super().open_db()
+
+        # Use the fastest sync mode.  This can always be rebuilt by refreshing.
+        conn.execute(f'PRAGMA {self.schema}.synchronous = OFF;')
+
+        # Make LIKE case-sensitive, so path prefix searches can use the files_path index.
+        conn.execute(f'PRAGMA {self.schema}.case_sensitive_like = ON;')
+
+        # Python's lower(), so rename can compute path_lowercase in SQL.  SQLite's lower()
+        # only handles ASCII.
+        conn.create_function('python_lower', 1, str.lower, deterministic=True)
+
+        return conn
+
+    def upgrade(self, *, conn):
+        """
+        Create and apply migrations to the search database.
+        """
+        with conn:
+            # If there's no info table, start by just creating it at version 0, so _get_info
+            # and _set_info work.
+            if 'info' not in self.get_tables(conn):
+                with transaction(conn):
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.info(
+                            id INTEGER PRIMARY KEY,
+                            version
+                        )
+                    ''')
+                    conn.execute(f'INSERT INTO {self.schema}.info (id, version) values (1, ?)', (0,))
+
+            if self.get_db_version(conn=conn) == 0:
+                with transaction(conn):
+                    self.set_db_version(1, conn=conn)
+
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.files(
+                            id INTEGER PRIMARY KEY,
+                            path UNIQUE NOT NULL,
+                            parent NOT NULL,
+                            name_lowercase NOT NULL,
+                            is_directory NOT NULL,
+                            size NOT NULL,
+                            mtime NOT NULL,
+                            ctime NOT NULL,
+
+                            -- The MIME type from the file extension, or null for directories.
+                            mime_type,
+
+                            -- Image dimensions, if FileIndex knew them when we indexed the file.
+                            width,
+                            height,
+
+                            -- Sort columns.  These are the same as in FileIndex.
+                            path_lowercase NOT NULL,
+                            basename_if_directory_lowercase,
+                            natural_sort_key NOT NULL,
+                            natural_sort_key_reverse_pages NOT NULL
+                        )
+                    ''')
+
+                    conn.execute(f'CREATE INDEX {self.schema}.files_parent on files(parent)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_normal on files(basename_if_directory_lowercase DESC, path_lowercase ASC)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_natural on files(natural_sort_key, path_lowercase)')
+                    conn.execute(f'CREATE INDEX {self.schema}.files_sort_natural_reverse_pages on files(natural_sort_key_reverse_pages, path_lowercase)')
+
+            if self.get_db_version(conn=conn) == 1:
+                with transaction(conn):
+                    self.set_db_version(2, conn=conn)
+
+                    # The refresh generation, which is incremented each time Library.refresh runs.
+                    conn.execute(f'ALTER TABLE {self.schema}.info ADD COLUMN refresh_generation NOT NULL DEFAULT 0')
+
+                    # The state of each directory when it was last refreshed.  This lets refresh skip
+                    # directories that haven't changed:
+                    #
+                    # - mtime is the directory's mtime when it was scanned, or null if it needs to
+                    # be scanned again.
+                    # - child_count is the number of files that were in the directory, which should
+                    # match the number of files with this parent.
+                    # - metadata_mtime is the mtime of the directory's metadata file, if it has one.
+                    # - scanned_generation is the last refresh that saw this directory.
+                    # - changed_generation is the last refresh where it had changed.
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.directory_state(
+                            path PRIMARY KEY NOT NULL,
+                            mtime,
+                            child_count NOT NULL,
+                            metadata_mtime,
+                            scanned_generation NOT NULL,
+                            changed_generation NOT NULL
+                        )
+                    ''')
+                    conn.execute(f'CREATE INDEX {self.schema}.directory_state_changed_generation on directory_state(changed_generation)')
+
+        assert self.get_db_version(conn=conn) == 2
+
+    @classmethod
+    def _make_record(cls, path, st, *, dimensions=None):
+        """
+        Return a files row for path, given its stat result.
+
+        dimensions is (width, height, mtime) if the dimensions of the file are known, and
+        they're only used if mtime matches the file.
+        """
+        path = os.fspath(path)
+        name = os.path.basename(path)
+        is_directory = stat.S_ISDIR(st.st_mode)
+        width = height = None
+        if dimensions is not None and not is_directory and dimensions[2] == st.st_mtime:
+            width, height = dimensions[0], dimensions[1]
+
+        return {
+            'path': path,
+            'parent': os.path.dirname(path),
+            'name_lowercase': name.lower(),
+            'is_directory': is_directory,
+            'size': 0 if is_directory else st.st_size,
+            'mtime': st.st_mtime,
+            'ctime': getattr(st, 'st_birthtime', st.st_ctime),
+            'mime_type': None if is_directory else misc.mime_type(path),
+            'width': width,
+            'height': height,
+            'path_lowercase': path.lower(),
+            'basename_if_directory_lowercase': name.lower() if is_directory else None,
+            'natural_sort_key': misc.natural_sort_key(name, is_directory),
+            'natural_sort_key_reverse_pages': misc.natural_sort_key(name, is_directory, reverse_pages=True),
+        }
+
+    def _write_records(self, cursor, records):
+        if not records:
+            return
+
+        fields = list(records[0].keys())
+        cursor.executemany(f'''
+            INSERT INTO {self.schema}.files ({', '.join(fields)})
+            VALUES ({', '.join('?'*len(fields))})
+            ON CONFLICT(path) DO UPDATE SET {', '.join(f'{field} = excluded.{field}' for field in fields)}
+        ''', [[record[field] for field in fields] for record in records])
+
+    def update_directory(self, path, children, *, dimensions=None, conn=None):
+        """
+        Update the contents of the directory path from a directory listing.
+
+        children is a list of DirEntry-like objects for the files in the directory.  Files
+        that are no longer in the directory are removed, including the contents of removed
+        directories.  dimensions is an optional dictionary of {path: (width, height, mtime)}
+        for files whose dimensions are already known.
+
+        Return the number of files that were added or changed.
+        """
+        return self.update_directories([(path, children)], dimensions=dimensions, conn=conn)
+
+    def update_directories(self, listings, *, dimensions=None, conn=None):
+        """
+        Update several directories at once.  listings is a list of (path, children), and
+        this is otherwise the same as update_directory.
+        """
+        dimensions = dimensions or {}
+
+        changed = []
+        removed = []
+        with self.cursor(conn, write=True) as cursor:
+            for path, children in listings:
+                records = []
+                for child in children:
+                    try:
+                        st = child.stat()
+                    except OSError:
+                        # The file was deleted while we were scanning.
+                        continue
+
+                    child_path = os.fspath(child)
+                    records.append(self._make_record(child_path, st, dimensions=dimensions.get(child_path)))
+
+                existing = {
+                    row['path']: row
+                    for row in cursor.execute(f'SELECT * FROM {self.schema}.files WHERE parent = ?', [os.fspath(path)])
+                }
+
+                # Only write records that have changed.
+                for record in records:
+                    old = existing.pop(record['path'], None)
+                    if old is None or any(old[field] != record[field] for field in self._compared_fields):
+                        changed.append(record)
+
+                # Anything left in existing isn't in the directory anymore.
+                removed.extend(existing.keys())
+
+            self._write_records(cursor, changed)
+
+            if removed:
+                self.delete_recursively(removed, conn=cursor.connection)
+
+        return len(changed)
+
+    def update_path(self, path, *, conn=None):
+        """
+        Update a single file or directory after it's been added or changed.  If it doesn't
+        exist, remove it.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.delete_recursively([path], conn=conn)
+            return
+
+        with self.cursor(conn, write=True) as cursor:
+            self._write_records(cursor, [self._make_record(path, st)])
+
+    def delete_recursively(self, paths, *, conn=None):
+        """
+        Remove paths from the index, and everything inside them.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            cursor.executemany(f'''
+                DELETE FROM {self.schema}.files
+                WHERE
+                    path = ? OR
+                    path LIKE ? ESCAPE "$"
+            ''', [(os.fspath(path), self.escape_like(os.fspath(path)) + os.path.sep + '%') for path in paths])
+
+    def rename(self, old_path, new_path, *, conn=None):
+        """
+        Rename old_path to new_path, and everything inside it.
+        """
+        old_path = os.fspath(old_path)
+        new_path = os.fspath(new_path)
+        if old_path == new_path:
+            return
+
+        with self.cursor(conn, write=True) as cursor:
+            # Anything already at the new path is stale.
+            self.delete_recursively([new_path], conn=cursor.connection)
+
+            # Update files inside old_path by replacing the old_path prefix of path and parent.
+            # Files inside it keep their names, so only the columns derived from the full path
+            # change.
+            new_path_expr = '? || substr(path, ?)'
+            cursor.execute(f'''
+                UPDATE {self.schema}.files
+                    SET
+                        path = {new_path_expr},
+                        parent = ? || substr(parent, ?),
+                        path_lowercase = python_lower({new_path_expr})
+                    WHERE path LIKE ? ESCAPE "$"
+            ''', [
+                new_path, len(old_path) + 1,   # path
+                new_path, len(old_path) + 1,   # parent
+                new_path, len(old_path) + 1,   # path_lowercase
+                self.escape_like(old_path) + os.path.sep + '%',
+            ])
+
+            # Update old_path itself.  Its name has changed, so its name columns and sort keys
+            # need to be updated too.
+            row = cursor.execute(f'SELECT id, is_directory, mime_type FROM {self.schema}.files WHERE path = ?', [old_path]).fetchone()
+            if row is None:
+                return
+
+            name = os.path.basename(new_path)
+            is_directory = row['is_directory']
+            cursor.execute(f'''
+                UPDATE {self.schema}.files
+                    SET
+                        path = ?, parent = ?, name_lowercase = ?, path_lowercase = ?, mime_type = ?,
+                        basename_if_directory_lowercase = ?,
+                        natural_sort_key = ?, natural_sort_key_reverse_pages = ?
+                    WHERE id = ?
+            ''', [
+                new_path,
+                os.path.dirname(new_path),
+                name.lower(),
+                new_path.lower(),
+                row['mime_type'] if is_directory else misc.mime_type(new_path),
+                name.lower() if is_directory else None,
+                misc.natural_sort_key(name, is_directory),
+                misc.natural_sort_key(name, is_directory, reverse_pages=True),
+                row['id'],
+            ])
+
+    def is_indexed(self, path, *, conn=None):
+        """
+        Return true if anything inside path is in the index.
+        """
+        with self.cursor(conn) as cursor:
+            for row in cursor.execute(f'SELECT 1 FROM {self.schema}.files WHERE parent = ? LIMIT 1', [os.fspath(path)]):
+                return True
+        return False
+
+    def begin_refresh(self, *, conn=None):
+        """
+        Start a refresh, returning its generation.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            generation = self._get_info(conn=cursor.connection)['refresh_generation'] + 1
+            self._set_info('refresh_generation', generation, conn=cursor.connection)
+            return generation
+
+    def get_directory_states(self, path, *, conn=None):
+        """
+        Return a dictionary of {path: directory_state row} for path and all directories
+        inside it.
+        """
+        path = os.fspath(path)
+        with self.cursor(conn) as cursor:
+            return {
+                row['path']: row
+                for row in cursor.execute(f'''
+                    SELECT * FROM {self.schema}.directory_state
+                    WHERE
+                        path = ? OR
+                        path LIKE ? ESCAPE "$"
+                ''', [path, self.escape_like(path) + os.path.sep + '%'])
+            }
+
+    def get_directory_children(self, path, *, conn=None):
+        """
+        Return a dictionary of {parent: (child_count, [child directory paths])} for path and
+        all directories inside it.  Directories with no children aren't included.
+        """
+        path = os.fspath(path)
+        results = {}
+        with self.cursor(conn) as cursor:
+            for row in cursor.execute(f'''
+                SELECT parent, path, is_directory FROM {self.schema}.files
+                WHERE
+                    parent = ? OR
+                    parent LIKE ? ESCAPE "$"
+            ''', [path, self.escape_like(path) + os.path.sep + '%']):
+                count, directories = results.get(row['parent'], (0, []))
+                if row['is_directory']:
+                    directories.append(row['path'])
+                results[row['parent']] = (count + 1, directories)
+
+        return results
+
+    def set_directory_states(self, states, *, conn=None):
+        """
+        Store directory states from a refresh.  states is a list of dictionaries with the
+        directory_state columns.
+        """
+        if not states:
+            return
+
+        with self.cursor(conn, write=True) as cursor:
+            fields = list(states[0].keys())
+            cursor.executemany(f'''
+                INSERT OR REPLACE INTO {self.schema}.directory_state ({', '.join(fields)})
+                VALUES ({', '.join('?'*len(fields))})
+            ''', [[state[field] for field in fields] for state in states])
+
+    def mark_directories_scanned(self, paths, generation, *, conn=None):
+        """
+        Record that the unchanged directories in paths were seen by the refresh generation.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            cursor.executemany(f'''
+                UPDATE {self.schema}.directory_state
+                SET scanned_generation = ?
+                WHERE path = ?
+            ''', [(generation, os.fspath(path)) for path in paths])
+
+    def finish_refresh(self, path, generation, *, conn=None):
+        """
+        Finish refreshing path in the given refresh generation.
+
+        Directories inside path that weren't seen by the refresh have been removed.  Remove
+        their state, and return their paths.
+        """
+        path = os.fspath(path)
+        with self.cursor(conn, write=True) as cursor:
+            where = '''
+                WHERE
+                    (path = ? OR path LIKE ? ESCAPE "$") AND
+                    scanned_generation < ?
+            '''
+            params = [path, self.escape_like(path) + os.path.sep + '%', generation]
+            removed = [row['path'] for row in cursor.execute(f'SELECT path FROM {self.schema}.directory_state {where}', params)]
+            cursor.execute(f'DELETE FROM {self.schema}.directory_state {where}', params)
+
+        return removed
+
+    def get_changed_directories(self, generation, *, conn=None):
+        """
+        Return the paths of directories that changed in the given refresh generation or later.
+        """
+        with self.cursor(conn) as cursor:
+            return [
+                row['path']
+                for row in cursor.execute(f'''
+                    SELECT path FROM {self.schema}.directory_state
+                    WHERE changed_generation >= ?
+                    ORDER BY path
+                ''', [generation])
+            ]
+
+    def search(self, *,
+        paths=None,
+
+        # If set, return only the file with this exact path.
+        exact_path=None,
+
+        # Filter for files with this exact basename:
+        filename=None,
+
+        substr=None,
+        recurse=True,
+        media_type=None, # "images" or "videos"
+        total_pixels=None,
+        aspect_ratio=None,
+        include_files=True,
+        include_dirs=True,
+
+        # A list of (expression, 'ASC' or 'DESC') to sort by, like library.sort_orders['index'].
+        # If any expression isn't in sort_expressions, we'll sort with order_fs instead.
+        order=None,
+
+        # A sort function that takes a DirEntry and returns a key, which should match order.
+        # This is used if we can't sort with order, and reverse reverses it.
+        order_fs=None,
+        reverse=False,
+
+        # Not supported:
+        contents=None,
+
+        # Searches don't time out, so this is ignored.
+        timeout=None,
+
+        conn=None,
+    ):
+        """
+        Search the index, yielding IndexedDirEntry results.  This takes the same arguments
+        as windows_search.search.
+        """
+        if contents: log.warn('Contents search not supported in the search index')
+
+        where = []
+        params = []
+
+        # Like Windows Search, we never search everything.
+        assert paths or exact_path
+        if paths:
+            path_conds = []
+            for path in paths:
+                path = os.fspath(path)
+                if recurse:
+                    path_conds.append('path LIKE ? ESCAPE "$"')
+                    params.append(self.escape_like(path) + os.path.sep + '%')
+                else:
+                    path_conds.append('parent = ?')
+                    params.append(path)
+            where.append(f"({' OR '.join(path_conds)})")
+
+        if exact_path is not None:
+            where.append('path = ?')
+            params.append(os.fspath(exact_path))
+
+        if filename is not None:
+            where.append('name_lowercase = ?')
+            params.append(filename.lower())
+
+        if substr is not None:
+            for word in substr.split(' '):
+                if word:
+                    where.append('instr(name_lowercase, ?) > 0')
+                    params.append(word.lower())
+
+        if not include_files:
+            where.append('is_directory')
+        if not include_dirs:
+            where.append('not is_directory')
+
+        if media_type == 'images':
+            where.append('mime_type LIKE "image/%"')
+        elif media_type == 'videos':
+            # Include GIFs when searching for videos, since they might be animated.  Our caller
+            # will finish filtering them.
+            where.append('(mime_type LIKE "video/%" OR mime_type = "image/gif")')
+
+        # Dimension filters only apply to files whose dimensions we know.
+        if total_pixels is not None:
+            if total_pixels[0] is not None:
+                where.append('(width IS NULL OR height IS NULL OR width*height >= ?)')
+                params.append(total_pixels[0])
+            if total_pixels[1] is not None:
+                where.append('(width IS NULL OR height IS NULL OR width*height <= ?)')
+                params.append(total_pixels[1])
+
+        if aspect_ratio is not None:
+            if aspect_ratio[0] is not None:
+                where.append('(width IS NULL OR NOT height OR 1.0 * width/height >= ?)')
+                params.append(aspect_ratio[0])
+            if aspect_ratio[1] is not None:
+                where.append('(width IS NULL OR NOT height OR 1.0 * width/height <= ?)')
+                params.append(aspect_ratio[1])
+
+        # Sort with SQL if we can.  Otherwise, we'll read everything and sort it ourself.
+        order_by = ''
+        sort_here = order_fs is not None
+        if order and all(expr in self.sort_expressions for expr, _ in order):
+            order_by = 'ORDER BY ' + ', '.join(f'{expr} {asc_desc}' for expr, asc_desc in order)
+            sort_here = False
+
+        query = f'''
+            SELECT *
+            FROM {self.schema}.files
+            WHERE {' AND '.join(where)}
+            {order_by}
+        '''
+
+        results = []
+        with self.cursor(conn) as cursor:
+            for row in cursor.execute(query, params):
+                entry = IndexedDirEntry(dict(row))
+                if sort_here:
+                    results.append(entry)
+                    continue
+
+                try:
+                    yield entry
+                except GeneratorExit:
+                    # GeneratorExit is normal.  Return rather than raising it to commit
+                    # the transaction.
+                    return
+
+        if sort_here:
+            results.sort(key=order_fs, reverse=reverse)
+            yield from results
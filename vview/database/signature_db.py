@@ -17,7 +17,8 @@
 #
 # We don't share IDs with file_index, and there's no foreign key relationship since
 # we're in a separate database.  We just use the path to match them up.
-import asyncio, logging, sqlite3, io
+import asyncio, logging, os, random, sqlite3, struct, io, time
+from pathlib import Path
 from .database import Database, transaction
 from ..util import image_index, misc
 from PIL import Image
@@ -47,8 +48,9 @@ class SignatureDB(Database):
         # required for the files_path index to be used.
         conn.execute(f'PRAGMA {self.schema}.case_sensitive_like = ON;')
 
-        # Do first-time initialization and any migrations.
-        self.upgrade(conn=conn)
+        # Fire delete triggers for rows removed by INSERT OR REPLACE, so deleted_count
+        # counts replaced signatures.
+        conn.execute('PRAGMA recursive_triggers = ON;')
 
         return conn
 
@@ -86,26 +88,74 @@ class SignatureDB(Database):
 
                     conn.execute(f'CREATE INDEX {self.schema}.signatures_path on signatures(path)')
 
-        assert self.get_db_version(conn=conn) == 1
+            if self.get_db_version(conn=conn) == 1:
+                with transaction(conn):
+                    self.set_db_version(2, conn=conn)
+
+                    # These identify the signatures the image index snapshot holds.  See
+                    # _IndexSnapshot.  database_id is random, so a snapshot from a database
+                    # that was deleted and recreated isn't used.
+                    conn.execute(f'ALTER TABLE {self.schema}.info ADD COLUMN database_id NOT NULL DEFAULT 0')
+                    conn.execute(f'ALTER TABLE {self.schema}.info ADD COLUMN deleted_count NOT NULL DEFAULT 0')
+                    self._set_info('database_id', random.getrandbits(63), conn=conn)
+
+                    conn.execute(f'''
+                        CREATE TRIGGER {self.schema}.signatures_delete_count AFTER DELETE ON signatures
+                        BEGIN
+                            UPDATE info SET deleted_count = deleted_count + 1;
+                        END
+                    ''')
+
+        assert self.get_db_version(conn=conn) == 2
+
+    @property
+    def index_snapshot_path(self):
+        """
+        Return the path to the image index snapshot.  See _IndexSnapshot.
+        """
+        return Path(os.fspath(self.db_path) + '.index')
 
     async def load_image_index(self):
         """
         Load the image index with saved signatures.
+
+        Signatures are loaded from the image index snapshot if it's up to date, and only
+        signatures added since it was saved are read from the database.  The snapshot is
+        then updated with them, or written from scratch if it was out of date.
         """
         if not image_index.available:
             return
 
         log.info('Loading image signatures...')
-        idx = 0
-        for idx, sig_entry in enumerate(self.all_signatures()):
-            signature = image_index.ImageSignature(sig_entry['signature'])
-            self.image_index.add_image(sig_entry['id'], signature)
+        start = time.time()
+
+        # Read this before reading signatures.  If signatures are deleted while we're
+        # loading, the snapshot we save won't match and won't be used next time.
+        info = self._get_info(conn=None)
+
+        loaded = 0
+        with _IndexSnapshot(self.index_snapshot_path, info['database_id'], info['deleted_count']) as snapshot:
+            for sig_id, signature in snapshot.read():
+                self.image_index.add_image(sig_id, image_index.ImageSignature(signature))
+
+                # Yield periodically to let other things happen.
+                loaded += 1
+                if (loaded % 100) == 0:
+                    await asyncio.sleep(0)
 
-            # Yield periodically to let other things happen.
-            if (idx % 10) == 0:
-                await asyncio.sleep(0)
+            from_snapshot = loaded
 
-        log.info(f'Loaded {idx} image signatures')
+            for sig_entry in self.all_signatures(after_id=snapshot.max_id):
+                self.image_index.add_image(sig_entry['id'], image_index.ImageSignature(sig_entry['signature']))
+                snapshot.append(sig_entry['id'], sig_entry['signature'])
+
+                loaded += 1
+                if (loaded % 100) == 0:
+                    await asyncio.sleep(0)
+
+            snapshot.save()
+
+        log.info(f'Loaded {loaded} image signatures ({from_snapshot} from the snapshot) in {time.time() - start:.1f}s')
 
     def get_from_ids(self, ids, *, conn=None):
         id_params = ['?'] * len(ids)
@@ -149,19 +199,48 @@ class SignatureDB(Database):
         assert len(results) == 1
         return results[0]
 
-    def all_signatures(self, *, conn=None):
+    def all_signatures(self, *, after_id=0, conn=None):
         """
-        Yield all (path, signature) entries.
+        Yield all (id, path, signature) entries with IDs after after_id, in ID order.
         """
         query = f"""
             SELECT id, path, signature
             FROM {self.schema}.signatures AS signatures
+            WHERE id > ?
+            ORDER BY id
         """
         with self.cursor(conn) as cursor:
-            for row in cursor.execute(query, []):
+            for row in cursor.execute(query, [after_id]):
                 result = dict(row)
                 yield result
 
+    def get_paths_after(self, after_id, limit, *, conn=None):
+        """
+        Return a list of (id, path) for up to limit signatures with IDs after after_id, in
+        ID order.  This is used to walk the whole database a piece at a time.
+        """
+        with self.cursor(conn) as cursor:
+            return [
+                (row['id'], row['path'])
+                for row in cursor.execute(f'''
+                    SELECT id, path FROM {self.schema}.signatures
+                    WHERE id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', [after_id, limit])
+            ]
+
+    def delete_signatures(self, ids, *, conn=None):
+        """
+        Delete the signatures with the given IDs, and remove them from the image index.
+        """
+        with self.cursor(conn, write=True) as cursor:
+            cursor.executemany(f'DELETE FROM {self.schema}.signatures WHERE id = ?', [(sig_id,) for sig_id in ids])
+
+        if image_index.available:
+            for sig_id in ids:
+                self.image_index.remove_image(sig_id)
+
     def set_signature(self, path, signature, mtime, *, conn=None):
         """
         Set the signature for an entry.  Return the row's ID.
@@ -256,3 +335,217 @@ class SignatureDB(Database):
         return results
             
 
+
+class _IndexSnapshot:
+    """
+    A copy of the signatures in the database, which can be read much faster than reading
+    them back out of the database.  load_image_index uses this to load the image index.
+
+    The file is a header followed by (id, signature) records in ID order.  Signatures are
+    never changed in place: set_signature replaces the row, which deletes the old one.
+    New rows get IDs larger than any existing row, so signatures added since the snapshot
+    was saved are the ones with IDs after its max_id, and they're appended to it.  Deleting
+    signatures would leave them in the snapshot and could allow their IDs to be reused, so
+    the snapshot is only used if the database's deleted_count hasn't changed.
+
+    Errors reading or writing the snapshot are logged and otherwise ignored, since the
+    signatures can always be read from the database.
+    """
+    magic = b'VVSIGIDX'
+
+    # magic, database_id, deleted_count, max_id, count, signature_size
+    header = struct.Struct('<8sQQQQQ')
+    record_id = struct.Struct('<Q')
+
+    # The number of records to read at once.
+    read_batch_size = 1000
+
+    def __init__(self, path, database_id, deleted_count):
+        self.path = path
+        self.database_id = database_id
+        self.deleted_count = deleted_count
+        self.file = None
+        self.max_id = 0
+        self.count = 0
+        self.signature_size = 0
+        self._appending = False
+
+    def __enter__(self):
+        try:
+            self.file = self.path.open('r+b' if self.path.exists() else 'w+b')
+            if not self._read_header():
+                self._reset()
+        except OSError as e:
+            log.warn(f'Couldn\'t open image index snapshot {self.path}: {e}')
+            self._close()
+            self.max_id = self.count = 0
+
+        return self
+
+    def __exit__(self, *args):
+        self._close()
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @property
+    def record_size(self):
+        return self.record_id.size + self.signature_size
+
+    def _read_header(self):
+        """
+        Read the header, returning true if the snapshot can be used.
+        """
+        header = self.file.read(self.header.size)
+        if len(header) != self.header.size:
+            return False
+
+        magic, database_id, deleted_count, max_id, count, signature_size = self.header.unpack(header)
+        if magic != self.magic or database_id != self.database_id or deleted_count != self.deleted_count:
+            return False
+
+        self.max_id = max_id
+        self.count = count
+        self.signature_size = signature_size
+
+        # If we were interrupted while appending, there may be records after the ones in the
+        # header.  Discard them.  If the file is shorter than the header says, discard it.
+        end = self.header.size + count * self.record_size
+        if os.fstat(self.file.fileno()).st_size < end:
+            return False
+
+        self.file.truncate(end)
+        return True
+
+    def _reset(self):
+        """
+        Discard the contents of the snapshot.
+        """
+        self.max_id = self.count = self.signature_size = 0
+        self.file.seek(0)
+        self.file.truncate()
+        self._write_header()
+
+    def _write_header(self):
+        self._appending = False
+        self.file.seek(0)
+        self.file.write(self.header.pack(self.magic, self.database_id, self.deleted_count, self.max_id, self.count, self.signature_size))
+
+    def read(self):
+        """
+        Yield (id, signature) for each signature in the snapshot.
+        """
+        if self.file is None or self.count == 0:
+            return
+
+        last_id = 0
+        self._appending = False
+        try:
+            self.file.seek(self.header.size)
+            remaining = self.count
+            while remaining:
+                records = min(remaining, self.read_batch_size)
+                data = self.file.read(records * self.record_size)
+                if len(data) != records * self.record_size:
+                    raise OSError('Snapshot is truncated')
+
+                for offset in range(0, len(data), self.record_size):
+                    sig_id, = self.record_id.unpack_from(data, offset)
+                    yield sig_id, data[offset+self.record_id.size:offset+self.record_size]
+                    last_id = sig_id
+
+                remaining -= records
+        except OSError as e:
+            # Stop using the snapshot, and let the caller read everything after the last
+            # signature we returned from the database.
+            log.warn(f'Couldn\'t read image index snapshot {self.path}: {e}')
+            self._close()
+            self.max_id = last_id
+
+    def append(self, sig_id, signature):
+        """
+        Add a signature to the end of the snapshot.  It isn't saved until save() is called.
+        """
+        if self.file is None:
+            return
+
+        if self.signature_size == 0:
+            self.signature_size = len(signature)
+        assert len(signature) == self.signature_size
+
+        try:
+            # Only seek before the first append, since seeking flushes the write buffer.
+            if not self._appending:
+                self.file.seek(0, os.SEEK_END)
+                self._appending = True
+
+            self.file.write(self.record_id.pack(sig_id))
+            self.file.write(signature)
+        except OSError as e:
+            log.warn(f'Couldn\'t write image index snapshot {self.path}: {e}')
+            self._close()
+            return
+
+        self.max_id = sig_id
+        self.count += 1
+
+    def save(self):
+        """
+        Save signatures added with append.  The records are written before the header, so
+        if we're interrupted, the snapshot still contains the records it had before.
+        """
+        if self.file is None:
+            return
+
+        try:
+            self.file.flush()
+            self._write_header()
+            self.file.flush()
+        except OSError as e:
+            log.warn(f'Couldn\'t write image index snapshot {self.path}: {e}')
+            self._close()
+
+async def test_load_image_index_benchmark(count=200000, added=1000):
+    """
+    Measure loading the image index from the database, from the snapshot, from the
+    snapshot with some signatures added since it was saved, and after a signature is
+    deleted, which discards the snapshot.
+    """
+    import tempfile
+
+    if not image_index.available:
+        log.warn('ImageIndex isn\'t available')
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = SignatureDB(Path(temp_dir) / 'signatures.sqlite')
+
+        def add_signatures(start, end):
+            for batch_start in range(start, end, 1000):
+                with db.connect(write=True) as conn:
+                    for idx in range(batch_start, min(end, batch_start + 1000)):
+                        db.set_signature(f'/images/image{idx}.jpg', random.randbytes(image_index._signature_size), 10, conn=conn)
+
+        async def load():
+            db.image_index = image_index.ImageIndex()
+            start = time.time()
+            await db.load_image_index()
+            return time.time() - start
+
+        await asyncio.to_thread(add_signatures, 0, count)
+
+        total = await load()
+        log.info(f'Loading {count} signatures from the database: {total*1000:.0f}ms')
+
+        total = await load()
+        log.info(f'Loading {count} signatures from the snapshot: {total*1000:.0f}ms')
+
+        await asyncio.to_thread(add_signatures, count, count + added)
+        total = await load()
+        log.info(f'Loading with {added} signatures added since the snapshot: {total*1000:.0f}ms')
+
+        db.delete_signatures([1])
+        total = await load()
+        log.info(f'Loading after a signature was deleted: {total*1000:.0f}ms')
@@ -0,0 +1,236 @@
+# The thumbnail cache stores generated thumbnails, so we don't have to decode and
+# re-encode the source image every time a client without a browser cache asks for
+# it.
+#
+# Browser caching already handles repeated requests from the same browser, but a new
+# browser, a second device or a guest session would otherwise pay the full decode cost
+# again for every image in a folder.
+#
+# Thumbnails are keyed by (path, mode), and each one stores the source mtime and inpaint
+# timestamp it was created from.  If either of those change, the stored thumbnail is stale
+# and is replaced the next time it's created.  The cache is limited to max_size bytes, and
+# the least recently used thumbnails are evicted when it fills up.
+#
+# This is a separate database from FileIndex, since it's much larger and is purely a
+# cache: it can always be deleted without losing anything.
+import logging, os, sqlite3, threading, time
+from .database import Database, transaction
+
+log = logging.getLogger(__name__)
+
+class ThumbnailCache(Database):
+    # We only update last_access for a thumbnail when it's older than this, so cache
+    # hits don't need to write to the database every time.  This only needs to be
+    # accurate enough for LRU eviction.
+    access_time_resolution = 60*60
+
+    def __init__(self, db_path, *, schema='thumbs', max_size=1024*1024*1024):
+        """
+        db_path is the path to the database on the filesystem.  max_size is the size
+        in bytes that the cache is allowed to grow to before old thumbnails are evicted.
+        """
+        super().__init__(db_path, schema=schema)
+        self.max_size = max_size
+
+        # Hit and miss counters.  These are only for diagnostics.
+        self.hits = 0
+        self.misses = 0
+
+        # The total size of thumbnail data in the cache.  This and the hit and miss counters
+        # are protected by stats_lock, since thumbnails can be read and stored from threads.
+        self.stats_lock = threading.Lock()
+        with self.cursor() as cursor:
+            for row in cursor.execute(f'SELECT COALESCE(SUM(size), 0) AS total FROM {self.schema}.thumbs'):
+                self.total_size = row['total']
+
+    def open_db(self):
+        conn = super().open_db()
+
+        # Use the fastest sync mode.  This data is only a cache, so we don't care
+        # if it loses data during a power loss.
+        conn.execute(f'PRAGMA {self.schema}.synchronous = OFF;')
+
+        # Make LIKE case-sensitive, so delete_recursively can use the thumbs_path index.
+        conn.execute(f'PRAGMA {self.schema}.case_sensitive_like = ON;')
+
+        return conn
+
+    def upgrade(self, *, conn):
+        """
+        Create and apply migrations to the thumbnail database.
+        """
+        with conn:
+            # If there's no info table, start by just creating it at version 0, so _get_info
+            # and _set_info work.
+            if 'info' not in self.get_tables(conn):
+                with transaction(conn):
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.info(
+                            id INTEGER PRIMARY KEY,
+                            version
+                        )
+                    ''')
+                    conn.execute(f'INSERT INTO {self.schema}.info (id, version) values (1, ?)', (0,))
+
+            if self.get_db_version(conn=conn) == 0:
+                with transaction(conn):
+                    self.set_db_version(1, conn=conn)
+
+                    conn.execute(f'''
+                        CREATE TABLE {self.schema}.thumbs(
+                            id INTEGER PRIMARY KEY,
+                            path NOT NULL,
+
+                            -- The type of thumbnail: "thumb", "tree-thumb" or "poster".
+                            mode NOT NULL,
+
+                            -- The source file's mtime and inpaint timestamp when this thumbnail
+                            -- was created.  If these don't match the file, the thumbnail is stale.
+                            mtime NOT NULL,
+                            inpaint_timestamp NOT NULL DEFAULT 0,
+
+                            mime_type NOT NULL,
+                            data BLOB NOT NULL,
+                            size NOT NULL,
+
+                            -- The last time this thumbnail was used, for LRU eviction.
+                            last_access NOT NULL,
+
+                            UNIQUE(path, mode)
+                        )
+                    ''')
+
+                    conn.execute(f'CREATE INDEX {self.schema}.thumbs_last_access on thumbs(last_access)')
+
+        assert self.get_db_version(conn=conn) == 1
+
+    def get(self, path, *, mode, mtime, inpaint_timestamp=0, conn=None):
+        """
+        Return (data, mime_type) for a cached thumbnail, or (None, None) if we don't
+        have an up-to-date thumbnail for path.
+        """
+        path = os.fspath(path)
+        with self.cursor(conn) as cursor:
+            query = f'''
+                SELECT id, mtime, inpaint_timestamp, mime_type, data, last_access
+                FROM {self.schema}.thumbs
+                WHERE path = ? AND mode = ?
+            '''
+            for row in cursor.execute(query, [path, mode]):
+                break
+            else:
+                row = None
+
+            # Treat thumbnails that were created from an older version of the file as a miss.
+            # They'll be replaced when the new thumbnail is stored.
+            if row is None or abs(row['mtime'] - mtime) >= 1 or row['inpaint_timestamp'] != inpaint_timestamp:
+                with self.stats_lock:
+                    self.misses += 1
+                return None, None
+
+            with self.stats_lock:
+                self.hits += 1
+
+        # Bump the access time for LRU eviction if it's gotten old.  This is rare, so
+        # only take a write lock when it's needed.
+        now = time.time()
+        if now - row['last_access'] > self.access_time_resolution:
+            with self.cursor(conn, write=True) as cursor:
+                cursor.execute(f'UPDATE {self.schema}.thumbs SET last_access = ? WHERE id = ?', [now, row['id']])
+
+        return bytes(row['data']), row['mime_type']
+
+    def put(self, path, data, *, mode, mtime, mime_type, inpaint_timestamp=0, conn=None):
+        """
+        Store a thumbnail, replacing any existing thumbnail for the same path and mode.
+        """
+        path = os.fspath(path)
+        size = len(data)
+        with self.cursor(conn, write=True) as cursor:
+            # Get the size of any thumbnail we're replacing, so we can keep total_size up to date.
+            query = f'SELECT size FROM {self.schema}.thumbs WHERE path = ? AND mode = ?'
+            old_size = 0
+            for row in cursor.execute(query, [path, mode]):
+                old_size = row['size']
+
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO {self.schema}.thumbs
+                    (path, mode, mtime, inpaint_timestamp, mime_type, data, size, last_access)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [path, mode, mtime, inpaint_timestamp, mime_type, sqlite3.Binary(data), size, time.time()])
+
+            with self.stats_lock:
+                self.total_size += size - old_size
+
+            if self.total_size > self.max_size:
+                self._evict(cursor)
+
+    def _evict(self, cursor):
+        """
+        Evict the least recently used thumbnails until we're below the size limit.
+
+        We evict down to 90% of the limit, so we don't end up evicting on every
+        put once the cache is full.
+        """
+        target_size = self.max_size * 0.9
+        with self.stats_lock:
+            to_free = self.total_size - target_size
+
+        freed = 0
+        evicted_ids = []
+        query = f'SELECT id, size FROM {self.schema}.thumbs ORDER BY last_access ASC'
+        for row in cursor.execute(query):
+            if freed >= to_free:
+                break
+
+            evicted_ids.append((row['id'],))
+            freed += row['size']
+
+        cursor.executemany(f'DELETE FROM {self.schema}.thumbs WHERE id = ?', evicted_ids)
+
+        with self.stats_lock:
+            self.total_size -= freed
+
+        log.info('Evicted %i thumbnails (%.1f MB) from the thumbnail cache' % (len(evicted_ids), freed / 1024 / 1024))
+
+    def delete_recursively(self, paths, *, conn=None):
+        """
+        Remove cached thumbnails for a list of paths.
+
+        If this includes directories, thumbnails for all files inside them will be
+        removed recursively.
+        """
+        path_list = [(str(path), self.escape_like(str(path)) + os.path.sep + '%') for path in paths]
+        with self.cursor(conn, write=True) as cursor:
+            freed = 0
+            for path, path_prefix in path_list:
+                query = f'''
+                    DELETE FROM {self.schema}.thumbs
+                    WHERE
+                        thumbs.path = ? OR
+                        thumbs.path LIKE ? ESCAPE "$"
+                    RETURNING size
+                '''
+                for row in cursor.execute(query, [path, path_prefix]):
+                    freed += row['size']
+
+            with self.stats_lock:
+                self.total_size -= freed
+
+    def get_stats(self):
+        """
+        Return a dictionary of cache statistics.
+        """
+        with self.stats_lock:
+            total_size = self.total_size
+            hits = self.hits
+            misses = self.misses
+
+        requests = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': (hits / requests) if requests else 0,
+            'size': total_size,
+            'max_size': self.max_size,
+        }
@@ -1,11 +1,14 @@
-import base64, os, urllib, uuid, time, asyncio, json, logging, traceback, aiohttp, io
+import base64, os, urllib, uuid, time, asyncio, json, logging, traceback, aiohttp, io, random
 from datetime import datetime, timezone
 from pprint import pprint
 from collections import defaultdict
 from pathlib import PurePosixPath
 from urllib import request
-from ..util import misc, inpainting, windows_search, image_index
+from ..util import misc, inpainting, image_index
+from ..util.threaded_tasks import AsyncTask
 from ..util.paths import open_path
+from . import metadata_storage
+from ..database.query_stats import QueryStats
 from PIL import Image
 
 log = logging.getLogger(__name__)
@@ -263,8 +266,8 @@ async def api_bookmark_add(info):
     If path is specified, only rename tags underneath that path (including the directory
     itself).
 
-    Since there may be a lot of tags to rename, this renames a block of tags and returns
-    the IDs that were edited.  Call this repeatedly until no more tags are modified.
+    This renames the tag in all matching files at once, and returns the IDs that were
+    edited.  Calling it again will find nothing left to rename.
     """
     path = info.data.get('path', None)
     from_tag = info.data['from']
@@ -274,9 +277,61 @@ async def api_bookmark_add(info):
         path = info.manager.resolve_path(path)
         info.manager.check_path(path, info.request, throw=True)
 
-    media_ids = info.manager.library.batch_rename_tag(from_tag, to_tag, paths=[path] if path else None, max_edits=100)
+    media_ids = info.manager.library.batch_rename_tag(from_tag, to_tag, paths=[path] if path else None)
     return { 'success': True, 'media_ids': media_ids }
 
+@reg('/bookmark/batch')
+async def api_bookmark_batch(info):
+    """
+    Add, edit or delete bookmarks for many files at once.
+
+    edits is a list of { id, action, tags, add_tags, remove_tags }, where id is a media ID,
+    action is "add" or "delete", and for "add", tags optionally replaces the file's tags, and
+    add_tags and remove_tags optionally add and remove individual tags.  Unlike /bookmark/add,
+    this doesn't index added bookmarks for similar image searching.
+
+    Each directory's metadata is written once, so this is much faster than editing files
+    one by one.  Return a result for each edit in order.  Failed edits don't prevent other
+    edits from being made.
+    """
+    results = [None] * len(info.data['edits'])
+    edits = []
+    edit_indexes = []
+    for idx, edit in enumerate(info.data['edits']):
+        try:
+            parts = edit['id'].split(':', 1)
+            if len(parts) < 2:
+                raise misc.Error('invalid-request', 'Invalid media ID')
+
+            absolute_path = info.manager.resolve_path(parts[1])
+            info.manager.check_path(absolute_path, info.request, throw=True)
+        except misc.Error as e:
+            results[idx] = e.data()
+            continue
+
+        tags = edit.get('tags', None)
+        if tags is not None:
+            tags = ' '.join(tags)
+
+        edits.append({
+            'path': absolute_path,
+            'action': edit.get('action', 'add'),
+            'tags': tags,
+            'add_tags': edit.get('add_tags'),
+            'remove_tags': edit.get('remove_tags'),
+        })
+        edit_indexes.append(idx)
+
+    # This can take a while for large batches, so run it in a thread.
+    library_results = await asyncio.to_thread(info.manager.library.bookmark_batch, edits)
+    for idx, result in zip(edit_indexes, library_results):
+        if isinstance(result, misc.Error):
+            results[idx] = result.data()
+        else:
+            results[idx] = { 'success': True, 'bookmark': _bookmark_data(result, info.user) }
+
+    return { 'success': True, 'results': results }
+
 # Return info about a single file.
 @reg('/illust/{type:[^:]+}:{path:.+}', allow_guest=True)
 async def api_illust(info):
@@ -324,7 +379,7 @@ async def api_similar_search(info):
     async def do_index():
         if path is not None:
             # Read all paths first, so the search doesn't time out while we're processing files.
-            paths = [result.path for result in windows_search.search(paths=[str(absolute_path)], timeout=30)]
+            paths = [result.path for result in info.manager.library.search_files(paths=[str(absolute_path)], timeout=30)]
         else:
             paths = info.manager.library.get_all_bookmark_paths()
 
@@ -357,11 +412,12 @@ async def api_similar_search(info):
 
     # This can take a long time, so run the job in a background task.
     name = f'Indexing {absolute_path}' if path is not None else 'Indexing bookmarks'
-    task_id = info.manager.run_background_task(do_index(), name=name)
+    task = info.manager.run_background_task(do_index(), name=name)
 
+    # The task's progress can be checked and it can be cancelled with /tasks.
     return {
         'success': True,
-        'task_id': task_id,
+        'task_id': task.id,
     }
 
 @reg('/similar/search')
@@ -544,6 +600,100 @@ def api_ids_impl(info):
 
     return media_ids
 
+def _get_list_sort_order(info):
+    sort_order = info.data.get('order', 'normal')
+    if not sort_order:
+        sort_order = 'normal'
+    return sort_order
+
+# Cursors for /list pages begin with this, to tell them apart from UUIDs of cached results.
+_list_cursor_prefix = 'cursor:'
+
+def _encode_list_cursor(info, cursor, *, backwards, offset):
+    """
+    Return an opaque page ID for a cursor from Library.get_cursor.
+
+    The cursor's path is stored as a public path, so this doesn't include filesystem
+    paths.  cursor['order'] is the sort order actually used, which includes the seed
+    for shuffles.
+    """
+    data = {
+        'path': str(info.manager.library.get_public_path(cursor['path'])),
+        'is_dir': cursor['is_dir'],
+        'key': cursor['key'],
+        'order': cursor['order'],
+        'backwards': backwards,
+        'offset': offset,
+    }
+    return _list_cursor_prefix + base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii')
+
+def _decode_list_cursor(info, page):
+    """
+    Decode a page ID from _encode_list_cursor.  Return None if page isn't a cursor.
+    """
+    if not isinstance(page, str) or not page.startswith(_list_cursor_prefix):
+        return None
+
+    try:
+        data = json.loads(base64.urlsafe_b64decode(page[len(_list_cursor_prefix):]))
+        cursor = {
+            'path': info.manager.resolve_path(data['path']),
+            'is_dir': bool(data['is_dir']),
+            'key': data['key'],
+        }
+        backwards = bool(data['backwards'])
+        offset = int(data['offset'])
+        order = data['order']
+    except (ValueError, KeyError, TypeError):
+        raise misc.Error('invalid-request', 'Invalid page')
+
+    # The cursor's sort key is only meaningful for the sort order it came from.  A request
+    # for "shuffle" continues with the seed that was chosen for its first page.
+    requested_order = _get_list_sort_order(info)
+    if requested_order.lstrip('-') == 'shuffle':
+        same_order = isinstance(order, str) and order.split(':')[0] == requested_order
+    else:
+        same_order = order == requested_order
+
+    if not same_order or not (cursor['key'] is None or isinstance(cursor['key'], list)):
+        raise misc.Error('invalid-request', 'Page doesn\'t match this search')
+
+    return {
+        'after': cursor,
+        'order': order,
+        'backwards': backwards,
+        'offset': offset,
+    }
+
+def _set_list_pages(info, results, *, this_page, offset, backwards):
+    """
+    Set page IDs and offsets for a page of /list results that can be resumed with cursors.
+
+    If backwards is true, the page was read in reverse order from a backwards cursor, and
+    we'll put it back in order.
+    """
+    first_cursor, last_cursor = results.pop('cursors', (None, None))
+    more = results.get('next')
+    count = len(results['results'])
+
+    if backwards:
+        results['results'].reverse()
+        first_cursor, last_cursor = last_cursor, first_cursor
+        offset = max(0, offset - count)
+        has_prev = more
+        has_next = True
+    else:
+        has_prev = offset > 0
+        has_next = more
+
+    results['pages'] = {
+        'this': this_page,
+        'prev': _encode_list_cursor(info, first_cursor, backwards=True, offset=offset) if has_prev and first_cursor else None,
+        'next': _encode_list_cursor(info, last_cursor, backwards=False, offset=offset + count) if has_next and last_cursor else None,
+    }
+    results['offset'] = offset
+    results['next_offset'] = offset + count
+
 @reg('/list/{type:[^:]+}:{path:.+}', allow_guest=True)
 async def api_list(info):
     """
@@ -552,11 +702,26 @@ async def api_list(info):
     If "search" is provided, a recursive filename search will be performed.
     This requires Windows indexing.
     """
-    # page is the UUID of the page we want to load.  skip is the offset from the beginning
-    # of the search of the page, which is only used if we can't load page.  It can't be used
-    # to seek from page.
+    # page is the ID of the page we want to load.  This is either a cursor, or the UUID
+    # of a cached result for searches that can't use cursors.  skip is the offset from the
+    # beginning of the search of the page, which is only used if we don't have page.  It
+    # can't be used to seek from page.
     page = info.data.get('page')
 
+    # If page is a cursor, resume the search from it.  Cursors hold everything needed to
+    # continue, so this doesn't depend on anything cached on the server, and each page only
+    # reads the results it returns.
+    cursor = _decode_list_cursor(info, page)
+    if cursor is not None:
+        result_generator = api_list_impl(info, cursor=cursor)
+        try:
+            next_results = await asyncio.to_thread(next, result_generator)
+        finally:
+            result_generator.close()
+
+        _set_list_pages(info, next_results, this_page=page, offset=cursor['offset'], backwards=cursor['backwards'])
+        return next_results
+
     # Try to load this page.
     cache = info.manager.get_api_list_result(page)
 
@@ -599,6 +764,18 @@ async def api_list(info):
 
         next_results = await asyncio.to_thread(run)
 
+        if 'cursors' in next_results:
+            # This search can be resumed with cursors, so use them for the page IDs and don't
+            # cache anything.
+            _set_list_pages(info, next_results, this_page=None, offset=offset, backwards=False)
+            offset += len(next_results['results'])
+            skip -= len(next_results['results'])
+            if skip < 0 or next_results['pages']['next'] is None:
+                result_generator.close()
+                break
+
+            continue
+
         # Store this page's IDs.
         next_results['pages'] = {
             'this': this_page_uuid,
@@ -645,7 +822,11 @@ async def api_list(info):
 #
 # If another page may be available, the 'next' key on the dictionary is true.  If it's
 # false or not present, the request will end.
-def api_list_impl(info):
+#
+# If the request can be resumed from a cursor, each page has a 'cursors' key with
+# cursors for its first and last result.  If cursor is set, the request continues
+# from a cursor returned by _decode_list_cursor.
+def api_list_impl(info, *, cursor=None):
     path = PurePosixPath(info.request.match_info['path'])
     def get_range_parameter(name):
         value = info.data.get(name, None)
@@ -693,9 +874,14 @@ def api_list_impl(info):
 
         search_options['bookmark_tags'] = ' '.join(tags)
 
-    sort_order = info.data.get('order', 'normal')
-    if not sort_order:
-        sort_order = 'normal'
+    # If we're resuming from a cursor, use its sort order.  Otherwise, give shuffles a random
+    # seed, so later pages can continue the same shuffle.
+    if cursor is not None:
+        sort_order = cursor['order']
+    else:
+        sort_order = _get_list_sort_order(info)
+        if sort_order.lstrip('-') == 'shuffle':
+            sort_order += ':%i' % random.randrange(1 << 63)
 
     # Remove null values from search_options, so it only contains search filters we're
     # actually using.
@@ -713,8 +899,10 @@ def api_list_impl(info):
         return
 
     file_info = []
+    page_entries = []
+    resumable = False
     def flush(*, last):
-        nonlocal file_info
+        nonlocal file_info, page_entries
 
         result = {
             'success': True,
@@ -723,7 +911,17 @@ def api_list_impl(info):
             'path': str(info.manager.library.get_public_path(path)),
         }
 
+        if resumable:
+            cursors = (None, None)
+            if page_entries:
+                cursors = tuple(
+                    info.manager.library.get_cursor(entry, sort_order) | { 'order': sort_order }
+                    for entry in (page_entries[0], page_entries[-1])
+                )
+            result['cursors'] = cursors
+
         file_info = []
+        page_entries = []
         return result
 
     # If we're not searching and listing the root, just list the libraries.
@@ -744,15 +942,32 @@ def api_list_impl(info):
         absolute_path = info.manager.resolve_path(path)
         paths_to_search = [absolute_path]
 
+    # Listings can always be resumed from a cursor.  Searches can if their results only
+    # come from the index.  We don't use cursors when returning everything at once for
+    # directories_only.
+    if directories_only:
+        resumable = False
+    elif search_options:
+        resumable = info.manager.library.can_resume_search(sort_order=sort_order, **search_options)
+    else:
+        resumable = True
+
+    resume_options = {}
+    if cursor is not None:
+        if not resumable:
+            raise misc.Error('invalid-request', 'This search can\'t be resumed from a page ID')
+        resume_options = { 'after': cursor['after'], 'backwards': cursor['backwards'] }
+
     if search_options:
-        entry_iterator = info.manager.library.search(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order, **search_options)
+        entry_iterator = info.manager.library.search(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order, **resume_options, **search_options)
     else:
         # We have no search, so just list the contents of the directory.
-        entry_iterator = info.manager.library.list(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order)
+        entry_iterator = info.manager.library.list(paths=paths_to_search, include_files=not directories_only, sort_order=sort_order, **resume_options)
 
     # This receives blocks of results.  Convert it to the API format and yield the whole
     # block.
     for entries in entry_iterator:
+        page_entries.extend(entries)
         for entry in entries:
             illust_info = get_illust_info(info, entry, info.base_url)
             if illust_info is not None:
@@ -795,6 +1010,92 @@ async def api_edit_inpainting(info):
         'illust': illust_info,
     }
 
+@reg('/stats')
+async def api_stats(info):
+    """
+    Return cache and database statistics.  This is only available to admins.
+    """
+    if not info.user.is_admin:
+        raise misc.Error('access-denied', 'Not an administrator')
+
+    return {
+        'success': True,
+        'listing_cache': info.manager.library.listing_cache.get_stats(),
+        'thumbnail_cache': info.manager.thumbnail_cache.get_stats(),
+        'metadata_cache': metadata_storage.get_cache_stats(),
+        'database_pools': {
+            db.schema: db.get_pool_stats()
+            for db in (info.manager.library.db, info.manager.library.search_index, info.manager.thumbnail_cache, info.manager.sig_db)
+        },
+    }
+
+@reg('/query-stats')
+async def api_query_stats(info):
+    """
+    Return the slowest query shapes for each database.  This is only available to admins.
+
+    count is the number of shapes to return for each database, and order is "total_time",
+    "max_time" or "mean_time".
+    """
+    if not info.user.is_admin:
+        raise misc.Error('access-denied', 'Not an administrator')
+
+    count = int(info.data.get('count', 20))
+    order = info.data.get('order', 'total_time')
+    if order not in ('total_time', 'max_time', 'mean_time'):
+        raise misc.Error('invalid-request', f'Invalid order: {order}')
+
+    databases = (info.manager.library.db, info.manager.sig_db, info.manager.library.search_index, info.manager.thumbnail_cache)
+    return {
+        'success': True,
+        'histogram_buckets': QueryStats.get_histogram_buckets(),
+        'databases': {
+            db.schema: db.query_stats.get_slowest(count, order=order)
+            for db in databases
+        },
+    }
+
+@reg('/maintenance')
+async def api_maintenance(info):
+    """
+    Return the status of database maintenance.  If run is true, start maintenance now
+    instead of waiting for the server to be idle.  This is only available to admins.
+    """
+    if not info.user.is_admin:
+        raise misc.Error('access-denied', 'Not an administrator')
+
+    if info.data.get('run', False):
+        info.manager.maintenance.run_now()
+
+    return {
+        'success': True,
+        **info.manager.maintenance.get_status(),
+    }
+
+@reg('/tasks')
+async def api_tasks(info):
+    """
+    Return the background tasks that are running, like library refreshes, and their
+    progress.  If cancel is set, it's the ID of a task to cancel.  This is only available
+    to admins.
+    """
+    if not info.user.is_admin:
+        raise misc.Error('access-denied', 'Not an administrator')
+
+    cancel_id = info.data.get('cancel')
+    if cancel_id is not None:
+        task = AsyncTask.get_running_task(int(cancel_id))
+        if task is None:
+            raise misc.Error('not-found', f'Task {cancel_id} isn\'t running')
+
+        task.cancel()
+
+    tasks = sorted(AsyncTask.get_running_tasks(), key=lambda task: task.id)
+    return {
+        'success': True,
+        'tasks': [task.get_status() for task in tasks],
+    }
+
 # Send basic info to the client.
 @reg('/info', allow_guest=True)
 async def api_info(info):
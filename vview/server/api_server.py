@@ -13,11 +13,22 @@ class APIServer:
     """
     Run and manage the HTTP server for the API.
     """
+    # Requests to these paths stay open as long as a page is open, like the WebSockets
+    # connection, so they don't count as activity for deciding if we're idle.
+    long_lived_paths = ('/ws',)
+
+    def __init__(self):
+        # All running requests, including long-lived ones, so we can cancel them on shutdown.
+        self.running_requests = {}
+
+        # The number of running requests that aren't long-lived, and when the last one finished.
+        self.active_requests = 0
+        self.last_request_at = time.time()
+
     async def init(self, server):
         self.server = server
         self.sites = []
         self.runner = None
-        self.running_requests = {}
 
         app = await self._create_app()
 
@@ -125,13 +136,20 @@ class APIServer:
     @web.middleware
     async def register_request_middleware(self, request, handler):
         """
-        Keep track of running requests, so we can cancel them on shutdown.
+        Keep track of running requests, so we can cancel them on shutdown, and when the
+        last request finished, so we know when we're idle.
         """
+        long_lived = request.path in self.long_lived_paths
         try:
             self.running_requests[request.task] = request
+            if not long_lived:
+                self.active_requests += 1
             return await handler(request)
         finally:
             del self.running_requests[request.task]
+            if not long_lived:
+                self.active_requests -= 1
+                self.last_request_at = time.time()
 
     async def _handle_options(self, request):
         """
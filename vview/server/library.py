@@ -31,62 +31,44 @@
 # XXX: we shouldn't do a full refresh on changes, but not sure how to find out if
 # indexing is up to date for a path in order to use quick refresh
 
-import asyncio, collections, errno, itertools, os, time, traceback, json, heapq, natsort, random, math, logging, stat, re
+import asyncio, collections, errno, functools, itertools, os, queue, sys, threading, time, traceback, json, heapq, random, math, logging, stat
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from pathlib import Path, PurePosixPath
 
-from ..util import monitor_changes, windows_search, misc, inpainting
+from ..util import monitor_changes, windows_search, misc, inpainting, threaded_tasks
 from . import metadata_storage
+from .listing_cache import ListingCache
 from ..database.file_index import FileIndex
+from ..database.file_entry import FileEntry
+from ..database.search_index import SearchIndex, IndexedDirEntry
 from ..util.paths import open_path, PathBase
 from ..util.misc import TransientWriteConnection
 
 log = logging.getLogger(__name__)
-natsort_key = natsort.natsort_keygen(alg=natsort.IGNORECASE)
 
-def _create_natsort():
+def _create_natsort(*, reverse_pages=False):
     """
-    Create our natural sort key.
+    Create our natural sort key for paths and DirEntries.
+
+    This is the same as _get_entry_natural_sort_key, so it can be used to sort search
+    results that are merged with the index.  Ties are broken by the path.
     """
     def key(entry):
-        return not entry.is_dir(), *natsort_key(entry.stem)
+        return misc.natural_sort_key(entry.name, entry.is_dir(), reverse_pages=reverse_pages), os.fspath(entry).lower()
 
     return key
 
-def _create_natsort_pages_reversed():
+def _get_entry_natural_sort_key(entry, *, reverse_pages=False):
     """
-    Create a natural sort key to sort in descending order, but to leave pages within a group in
-    ascending order.  For example:
-
-    Image 12350 #1.png
-    Image 12350 #2.png
-    Image 12345 #1.png
-    Image 12345 #2.png
-    Image 12345 #3.png
+    Return the natural sort key for an entry.
 
-    This allows viewing higher-numbered groups first, but keeping the pages within each group
-    in ascending order.
-
-    This sort actually does the opposite, and just reverses the pages within each group.  To
-    get the correct affect, use it as a reverse sort.
+    This is stored in the index, but placeholder entries from Windows search won't have it.
     """
-    # Look for "prefix #123...".
-    pattern = re.compile(r'(.* #)(\d+)(.*)')
-    def reverse_pages(entry):
-        entry_with_stem = entry
-
-        match = pattern.match(entry.stem)
-        if not entry.is_dir() and match:
-            # natsort doesn't handle negative numbers, so we can't just invert the page number.
-            prefix = match[1]
-            page = int(match[2])
-            suffix = match[3]
-            reversed_filename = f'{prefix}{1000000000000000 - page}{suffix}'
-            entry_with_stem = entry.with_stem(reversed_filename)
-
-        return not entry.is_dir(), *natsort_key(entry_with_stem.stem)
-
-    return reverse_pages
+    key = entry.get('natural_sort_key_reverse_pages' if reverse_pages else 'natural_sort_key')
+    if key is None:
+        key = misc.natural_sort_key(os.path.basename(entry['path']), bool(entry['is_directory']), reverse_pages=reverse_pages)
+    return key
 
 # Sort orders that we can use for listing and searching.
 #
@@ -96,6 +78,10 @@ def _create_natsort_pages_reversed():
 #
 # Filesystem ("fs") sorts are used by Library.list, and sort BasePaths.  This lets us sort items
 # before retrieving their entries.
+#
+# Index sorts always end with path_lowercase, and "index_key" returns an entry's values for the
+# other index columns.  These are used to resume index searches from a cursor (see
+# Library.get_cursor).
 sort_orders = {
     # Normal sorting puts directories first, then sorts by pathname.
     #
@@ -113,6 +99,7 @@ sort_orders = {
         # Use reverse_order_str to sort descending, since Python doesn't do this directly.        
         'entry': lambda entry: (misc.reverse_order_str(entry['basename_if_directory_lowercase']), entry['path_lowercase'].lower()),
         'index': [('basename_if_directory_lowercase', 'DESC'), ('path_lowercase', 'ASC')],
+        'index_key': lambda entry: (entry['basename_if_directory_lowercase'],),
         'fs': lambda entry: (not entry.is_dir(), entry.name),
     },
 
@@ -129,26 +116,41 @@ sort_orders = {
 
         # SQLite doesn't have floor(), so do it with round() instead.
         'index': [('round(ctime - 0.5)', 'ASC'), ('path_lowercase', 'ASC')],
+        'index_key': lambda entry: (math.floor(entry['ctime']),),
         'fs': lambda entry: (math.floor(entry.stat().st_birthtime), entry.name),
     },
 
     # A natural sort.  This also puts directories first, but sorts numbered files much better.
-    # This isn't supported for searching, but it's mostly useful for viewing single directories.
     # This is the default sort for Library.list.
+    #
+    # The index stores a precomputed key for this (see misc.natural_sort_key).  Windows search
+    # can't sort this way, so its results are read and sorted by Library.search.
     'natural': {
+        'windows': None,
+        'entry': lambda entry: (_get_entry_natural_sort_key(entry), entry['path_lowercase']),
+        'index': [('natural_sort_key', 'ASC'), ('path_lowercase', 'ASC')],
+        'index_key': lambda entry: (_get_entry_natural_sort_key(entry),),
         'fs': _create_natsort(),
     },
 
     # Like natural, but reverse the order of pages within a group.  This is an alternative to
     # -natural to show older image groups first, but without reversing the order of pages within
     # the group.
+    #
+    # This sort actually does the opposite, and just reverses the pages within each group.  To
+    # get the correct effect, use it as a reverse sort.
     'natural-reverse-pages': {
-        'fs': _create_natsort_pages_reversed(),
+        'windows': None,
+        'entry': lambda entry: (_get_entry_natural_sort_key(entry, reverse_pages=True), entry['path_lowercase']),
+        'index': [('natural_sort_key_reverse_pages', 'ASC'), ('path_lowercase', 'ASC')],
+        'index_key': lambda entry: (_get_entry_natural_sort_key(entry, reverse_pages=True),),
+        'fs': _create_natsort(reverse_pages=True),
     },
 
     # Sort by time bookmarked.  Use bookmark_updated_at, so editing a bookmark bumps it to the top.
     'bookmarked-at': {
-        'index': [('bookmark_updated_at', 'DESC')],
+        'index': [('bookmark_updated_at', 'DESC'), ('path_lowercase', 'ASC')],
+        'index_key': lambda entry: (entry['bookmark_updated_at'],),
 
         # Bookmark searches are always local index searches, so these aren't used.
         'windows': [],
@@ -169,6 +171,67 @@ sort_orders = {
 _default_directory_list_sort = 'natural'
 _default_directory_list_reverse_sort = '-natural-reverse-pages' # or '-natural'
 
+def _get_shuffle_sort(sort_order):
+    """
+    Return sort info for a shuffle.  This is handled by _get_sort.
+
+    "shuffle:1234" shuffles with the seed 1234, which gives the same order every time, so
+    it can be resumed with a cursor.  "shuffle" uses a random seed.
+
+    Files are ordered by misc.shuffle_key, which is a hash of the path that's stored in the
+    index.  The seed chooses where in that order to start, so each seed starts at a different
+    place and wraps around to the beginning.  This means each seed is a rotation of the same
+    order rather than a new one, but it lets the index return a shuffle incrementally instead
+    of reading every file before it can return anything.
+    """
+    reverse_order = sort_order.startswith('-')
+    sort_order = sort_order.lstrip('-')
+
+    _, _, seed = sort_order.partition(':')
+    if not seed:
+        seed = str(random.randrange(1 << 63))
+
+    # Hash the seed into the range of file keys, so similar seeds don't start at nearly the
+    # same place.  The seed can be any string.
+    seed = misc.shuffle_key(seed, False)
+
+    # The ranges of shuffle keys to read in order: directories, then files, each starting
+    # at the seed and wrapping around.  Directory keys are negative.  See misc.shuffle_key.
+    ranges = [
+        (seed - (1 << 63), 0), (-(1 << 63), seed - (1 << 63)),
+        (seed, 1 << 63), (0, seed),
+    ]
+
+    def get_range(key):
+        for idx, (start, end) in enumerate(ranges):
+            if start <= key < end:
+                return idx
+        assert False, key
+
+    def entry_key(entry):
+        key = entry.get('shuffle_key')
+        if key is None:
+            key = misc.shuffle_key(entry['path_lowercase'], entry['is_directory'])
+        return get_range(key), key, entry['path_lowercase']
+
+    def fs_key(entry):
+        path_lowercase = os.fspath(entry).lower()
+        key = misc.shuffle_key(path_lowercase, entry.is_dir())
+        return get_range(key), key, path_lowercase
+
+    asc_desc = 'DESC' if reverse_order else 'ASC'
+    return {
+        'windows': None,
+        'entry': entry_key,
+        'index': None,
+        'index_columns': [('shuffle_key', asc_desc), ('path_lowercase', asc_desc)],
+        'index_key': lambda entry: (entry_key(entry)[1],),
+        'fs': fs_key,
+        'reverse': reverse_order,
+        'shuffle_seed': seed,
+        'shuffle_ranges': ranges,
+    }
+
 def _get_sort(sort_order):
     """
     Return info for a sort order.
@@ -178,7 +241,11 @@ def _get_sort(sort_order):
     - SQL orders are flattened to an ORDER BY clause.
     - A "reverse" key is added, which is true if sort_order begins with "-".
     - If reversed, SQL orders are inversed.
+    - An "index_columns" key is added with the unflattened index order, for resuming searches.
     """
+    if sort_order.lstrip('-').split(':')[0] == 'shuffle':
+        return _get_shuffle_sort(sort_order)
+
     # If the sort order begins with '-', remove it and set the 'reversed' flag in
     # the results.
     reverse_order = sort_order.startswith('-')
@@ -196,7 +263,7 @@ def _get_sort(sort_order):
     # If this sort order is reversed, reverse the SQL ORDER BY sorts.
     if reverse_order:
         for order_type in 'windows', 'index':
-            if order_type not in order:
+            if order.get(order_type) is None:
                 continue
 
             new_order_by = []
@@ -207,15 +274,42 @@ def _get_sort(sort_order):
             
             order[order_type] = new_order_by
 
+    order['index_columns'] = order['index']
+
     # Flatten the SQL orderings to ORDER BY clauses.
     for order_type in 'windows', 'index':
-        if order_type not in order:
+        if order.get(order_type) is None:
             continue
 
         order[order_type] = 'ORDER BY ' + ', '.join('%s %s' % (key, asc_desc) for key, asc_desc in order[order_type])
 
     return order
 
+def _reverse_sort_order(sort_order):
+    """
+    Return the reverse of sort_order, eg. "-natural" for "natural".
+    """
+    if sort_order.startswith('-'):
+        return sort_order[1:]
+    else:
+        return '-' + sort_order
+
+class _ListingItem:
+    """
+    A stand-in for a file in a listing, with enough of the DirEntry interface for
+    fs sort keys that don't need to read the file.
+    """
+    def __init__(self, path, is_dir):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._is_dir = is_dir
+
+    def is_dir(self):
+        return self._is_dir
+
+    def __fspath__(self):
+        return self.path
+
 # This parameter to set_image_edits means to leave the existing value unchanged.
 no_change = object()
 
@@ -226,15 +320,49 @@ class Library:
     This handles a single root directory.  To index multiple directories, create
     multiple libraries.
     """
-    def __init__(self, data_dir):
+    # The default number of files per mount that we'll read at once while populating a page
+    # of results.
+    default_populate_workers = 4
+
+    # The default number of directories refresh will list at once.
+    default_refresh_workers = 8
+
+    def __init__(self, data_dir, *, thumbnail_cache=None, keyword_index='table', listing_cache_size=64*1024*1024,
+            search_backend=None):
         self.mounts = {}
         self.monitors = {}
+        self.populate_executors = {}
         self._data_dir = data_dir
 
+        # Cached directory listings for list and list_ids.
+        self.listing_cache = ListingCache(max_size=listing_cache_size)
+
         # Open our databases.
-        self.db = FileIndex(self.data_dir / 'index.sqlite')
+        self.db = FileIndex(self.data_dir / 'index.sqlite', keyword_index=keyword_index)
+
+        # The local index of all files, for searching files that aren't in FileIndex.  This is
+        # filled in by refresh and the change monitor.
+        self.search_index = SearchIndex(self.data_dir / 'search.sqlite')
+
+        # search_backend is "windows" to search files with Windows Search, falling back on
+        # search_index for directories it isn't indexing, or "index" to only use search_index.
+        if search_backend is None:
+            search_backend = 'windows' if sys.platform == 'win32' else 'index'
+        assert search_backend in ('windows', 'index'), search_backend
+        self.search_backend = search_backend
 
-    def mount(self, path, name=None):
+        # If set, this is the ThumbnailCache, so we can discard thumbnails when we see
+        # that their file has changed.
+        self.thumbnail_cache = thumbnail_cache
+
+    def mount(self, path, name=None, *, populate_workers=None):
+        """
+        Add a directory to the library.
+
+        populate_workers is the number of files in this mount that we'll read at once when
+        populating a page of results.  Higher values help on network filesystems and other
+        high-latency storage.  If this is 1, files are read one at a time.
+        """
         path = open_path(path)
         if name is None:
             name = path.name
@@ -242,6 +370,11 @@ class Library:
         assert name not in self.mounts
         self.mounts[name] = path
 
+        if populate_workers is None:
+            populate_workers = self.default_populate_workers
+        if populate_workers > 1:
+            self.populate_executors[name] = ThreadPoolExecutor(max_workers=populate_workers, thread_name_prefix=f'Populate({name})')
+
         self.monitor(name)
 
     async def unmount(self, name):
@@ -252,6 +385,10 @@ class Library:
         await self.stop_monitoring(name)
         del self.mounts[name]
 
+        executor = self.populate_executors.pop(name, None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
     def shutdown(self):
         pass
     
@@ -312,8 +449,9 @@ class Library:
         """
         Do a quick refresh of the library.
 
-        This uses Windows Search to find directories with our metadata, and refreshes just
-        those directories.
+        This uses the search backend to find directories with our metadata, and refreshes
+        just those directories.  If the search index hasn't been filled in for a path yet,
+        it's refreshed with a full refresh instead.
 
         This currently doesn't remove bookmarks from the database that no longer exist.
         """
@@ -322,12 +460,20 @@ class Library:
         log.info('Initializing library: %s' % ', '.join(str(path) for path in paths))
         start = time.time()
 
+        # The search index is empty until a path has been refreshed once.
+        if self.search_backend == 'index':
+            unindexed_paths = [path for path in paths if not self.search_index.is_indexed(path)]
+            if unindexed_paths:
+                log.info('Building search index: %s' % ', '.join(str(path) for path in unindexed_paths))
+                await self.refresh(paths=unindexed_paths)
+                paths = [path for path in paths if path not in unindexed_paths]
+
         # Scan for metadata files.
         log.info(f'Finding bookmarks...')
         all_metadata_files = []
         for path in paths:
             # Find all metadata files.
-            for result in windows_search.search(
+            for result in self.search_files(
                     paths=[str(path)],
                     filename=metadata_storage.metadata_filename,
                     timeout=0, # disable timeouts
@@ -336,72 +482,394 @@ class Library:
                 await asyncio.sleep(0)
 
         log.info(f"Scanning {len(all_metadata_files)} directories with bookmarks")
+
+        # Skip metadata files that haven't changed since they were last imported.  Importing
+        # only adds files that aren't in the database yet, so if a metadata file is unchanged
+        # and nothing in its directory has been removed from the database, there's nothing
+        # to import.
+        metadata_file_states = self.db.get_metadata_file_states()
+        new_states = []
+        skipped = 0
         for path in all_metadata_files:
             path = open_path(path)
-            await self._refresh_metadata_file(path)
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            if metadata_file_states.get(str(Path(path).parent)) == (stat.st_mtime, stat.st_size):
+                skipped += 1
+                continue
+
+            state = self._refresh_metadata_file(path)
+            if state is not None:
+                new_states.append(state)
 
             # Yield as we go, to make sure we allow other things to happen if this takes a while.
             await asyncio.sleep(0)
 
+        self.db.set_metadata_file_states(new_states)
+        log.info(f'{skipped} metadata files were unchanged')
+
         end = time.time()
         log.info(f'Indexing {", ".join(str(path) for path in paths)} took %.2f seconds' % (end-start))
 
-    async def refresh(self, *, paths=None):
+    async def refresh(self, *, paths=None, full=False, workers=None, progress=None):
         """
         Refresh the library.
 
         This does the same thing as quick_refresh, but scans the filesystem manually
         rather than using Windows search.
+
+        Directories are only listed again if they've changed since the last refresh: their
+        mtime, number of files or metadata file has changed.  Unchanged directories are
+        still descended into, since changes further down don't change their mtime.  Changes
+        that don't change the directory, like modifying an image in place, are left to the
+        change monitor.  If full is true, every directory is listed.
+
+        The scan runs on a thread, listing up to workers directories at once, so it doesn't
+        block the event loop.  If progress is set, it's called periodically with a dictionary
+        of progress, and if we're running in an AsyncTask, this is also its progress.
+        Cancelling the caller stops the scan.
+
+        Return a report of the directories that were added, changed and removed since the
+        last refresh.
         """
         if paths is None:
             paths = self.mounts.values()
 
-        refreshed = 0
-        total_refresh = 0
-
-        import queue
-        pending_paths = queue.LifoQueue()
+        # Make sure paths are inside this library.
+        root_paths = []
         for path in paths:
-            pending_paths.put(path)
-            total_refresh += 1
-
-        while not pending_paths.empty():
-            if total_refresh > 1 and (refreshed % 1000) == 0:
-                log.info('Refreshing %i/%i (%i left)' % (refreshed, total_refresh, pending_paths.qsize()))
-
-            path = pending_paths.get()
-            refreshed += 1
-
-            # Make sure path is inside this library.
             if self.get_mount_for_path(path) is None:
                 log.warn('Path %s isn\'t mounted' % path)
                 continue
+            root_paths.append(path)
 
-            # Let other tasks run periodically.
-            await asyncio.sleep(0)
+        task = asyncio.current_task()
+        def report_progress(value):
+            threaded_tasks.set_task_progress(task, value)
+            if progress is not None:
+                progress(value)
+
+        cancel = threading.Event()
+        try:
+            report = await asyncio.to_thread(self._refresh_paths, root_paths, full=full,
+                workers=workers or self.default_refresh_workers, progress=report_progress, cancel=cancel)
+        except asyncio.CancelledError:
+            # Stop the scan.  It'll stop at the next directory, and won't be awaited.
+            cancel.set()
+            raise
+
+        log.info('Refreshed %i directories (%i unchanged): %i added, %i changed, %i removed' % (
+            report['scanned'] + report['skipped'], report['skipped'],
+            len(report['added']), len(report['changed']), len(report['removed'])))
+
+        return report
+
+    def _refresh_paths(self, root_paths, *, full, workers, progress, cancel):
+        """
+        The synchronous part of refresh.  This runs on a thread, and lists directories on a
+        pool of workers threads.  This thread handles the results and writes them to the
+        database in batches.
+        """
+        generation = self.search_index.begin_refresh()
+        report = {
+            'generation': generation,
+            'added': [],
+            'changed': [],
+            'removed': [],
+            'scanned': 0,
+            'skipped': 0,
+        }
+
+        # Scan results waiting to be written to the database.
+        pending_files = 0
+        listings = []
+        metadata_files = []
+        new_states = []
+        unchanged_paths = []
+        def flush():
+            nonlocal pending_files
+            with self.search_index.connect(write=True) as conn:
+                self._update_search_index(listings, conn=conn)
+                self.search_index.set_directory_states(new_states, conn=conn)
+                self.search_index.mark_directories_scanned(unchanged_paths, generation, conn=conn)
+
+            if metadata_files:
+                with self.db.connect(write=True) as conn:
+                    states = [self._refresh_metadata_file(metadata_file, conn=conn) for metadata_file in metadata_files]
+                    self.db.set_metadata_file_states([state for state in states if state is not None], conn=conn)
+
+            pending_files = 0
+            listings.clear()
+            metadata_files.clear()
+            new_states.clear()
+            unchanged_paths.clear()
+
+        refreshed = 0
+        total_refresh = 0
+
+        # Note that we can't use with ThreadPoolExecutor, since that gives no way to set
+        # cancel_futures when cleaning up.
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Refresh')
+        try:
+            for root_path in root_paths:
+                # Read the state of every directory we know about under this path, and which
+                # directories are inside them, so the workers don't need to make any queries.
+                directory_states = self.search_index.get_directory_states(root_path)
+                directory_children = self.search_index.get_directory_children(root_path)
+
+                # Finished jobs are put on this queue as they complete.
+                finished = queue.Queue()
+
+                def refresh_directories(paths):
+                    results = []
+                    for path in paths:
+                        path_str = os.fspath(path)
+                        child_count, child_directories = directory_children.get(path_str, (0, []))
+                        results.append(self._refresh_directory(path,
+                            state=directory_states.get(path_str),
+                            child_count=child_count,
+                            child_directories=child_directories,
+                            full=full))
+                    return results
+
+                def submit(paths):
+                    nonlocal total_refresh
+
+                    # Checking an unchanged directory is quick, so give each job a group of
+                    # directories to reduce overhead, but keep enough jobs for every worker.
+                    group_size = max(1, min(64, len(paths) // workers))
+                    for idx in range(0, len(paths), group_size):
+                        future = executor.submit(refresh_directories, paths[idx:idx+group_size])
+                        future.add_done_callback(finished.put)
+
+                    total_refresh += len(paths)
+                    return len(paths)
+
+                pending = submit([root_path])
+
+                while pending:
+                    # Wait for the next group of directories.  Time out periodically to report
+                    # progress.
+                    try:
+                        future = finished.get(timeout=0.25)
+                    except queue.Empty:
+                        future = None
+
+                    if cancel.is_set():
+                        raise asyncio.CancelledError()
+
+                    progress({ 'refreshed': refreshed, 'total': total_refresh })
+                    if future is None:
+                        continue
+
+                    for result in future.result():
+                        # Write results in batches, keeping transactions short.
+                        if pending_files >= 10000 or len(listings) + len(unchanged_paths) >= 1000:
+                            flush()
+                            log.info('Refreshing %i/%i (%i left)' % (refreshed, total_refresh, pending))
+
+                        pending -= 1
+                        refreshed += 1
+                        if result is None:
+                            continue
+
+                        pending += submit(result['child_directories'])
+
+                        path_str = result['path']
+                        state = result['state']
+                        if result['children'] is None:
+                            report['skipped'] += 1
+                            unchanged_paths.append(path_str)
+                            continue
+
+                        listings.append((result['path'], result['children']))
+                        pending_files += len(result['children'])
+                        if result['metadata_file'] is not None:
+                            metadata_files.append(result['metadata_file'])
+
+                        report['scanned'] += 1
+                        new_state = result['new_state']
+                        changed = state is None or any(state[field] != new_state[field] for field in ('mtime', 'child_count', 'metadata_mtime'))
+                        if state is None:
+                            report['added'].append(path_str)
+                        elif changed:
+                            report['changed'].append(path_str)
+
+                        new_states.append(new_state | {
+                            'scanned_generation': generation,
+                            'changed_generation': generation if changed else state['changed_generation'],
+                        })
+
+                flush()
+
+                # Directories we didn't see this time have been removed.
+                report['removed'].extend(self.search_index.finish_refresh(root_path, generation))
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        progress({ 'refreshed': refreshed, 'total': total_refresh })
+        return report
+
+    def _refresh_directory(self, path, *, state, child_count, child_directories, full):
+        """
+        Check a directory for refresh, listing it if it's changed.  This is called on
+        refresh's worker threads, and doesn't access the database.
+
+        state is the directory's stored state, and child_count and child_directories are
+        the number of files and the subdirectories the search index has for it.
 
+        Return None if the directory doesn't exist anymore.  If it's unchanged, return
+        its stored child directories with children set to None.  Otherwise, return its
+        children and its new state.
+        """
+        path_str = os.fspath(path)
+        try:
+            path_stat = path.stat()
+            if not full and self._directory_unchanged(path, path_stat, state, child_count):
+                return {
+                    'path': path_str,
+                    'state': state,
+                    'child_directories': [open_path(child_path) for child_path in child_directories],
+                    'children': None,
+                }
+
+            # Read the time before listing the directory.  If the directory changes during
+            # the same mtime tick that we listed it, we won't be able to tell, so don't trust
+            # mtimes that are too recent.
+            scan_time = time.time()
+
+            children = []
+            child_directories = []
+            metadata_file = None
+            metadata_mtime = None
             for child in path.scandir():
+                children.append(child)
                 if child.is_real_dir():
-                    pending_paths.put(child)
-                    total_refresh += 1
+                    child_directories.append(child)
                 elif child.name == metadata_storage.metadata_filename:
-                    await self._refresh_metadata_file(child)
+                    metadata_file = child
+                    metadata_mtime = child.stat().st_mtime
+        except FileNotFoundError:
+            # The directory was removed while we were refreshing.
+            return None
+        except PermissionError as e:
+            log.warn('Couldn\'t refresh %s: %s' % (path, e))
+            return None
+
+        return {
+            'path': path_str,
+            'state': state,
+            'child_directories': child_directories,
+            'children': children,
+            'metadata_file': metadata_file,
+            'new_state': {
+                'path': path_str,
+                'mtime': path_stat.st_mtime if path_stat.st_mtime < scan_time - 2 else None,
+                'child_count': len(children),
+                'metadata_mtime': metadata_mtime,
+            },
+        }
+
+    @classmethod
+    def _directory_unchanged(cls, path, path_stat, state, child_count):
+        """
+        Return true if the directory path is unchanged since state was stored by refresh.
+
+        child_count is the number of files the search index has in the directory.  If
+        this doesn't match, the index was changed by something else and we need to list
+        the directory again.
+        """
+        if state is None or state['mtime'] is None:
+            return False
+        if state['mtime'] != path_stat.st_mtime or state['child_count'] != child_count:
+            return False
+
+        # Changing the metadata file normally replaces it, which changes the directory's
+        # mtime, but check it in case it was edited in place.
+        if state['metadata_mtime'] is not None:
+            try:
+                metadata_mtime = (path / metadata_storage.metadata_filename).stat().st_mtime
+            except FileNotFoundError:
+                return False
+
+            if metadata_mtime != state['metadata_mtime']:
+                return False
+
+        return True
+
+    def _update_search_index(self, listings, *, conn=None):
+        """
+        Update the search index with a list of (path, children) directory listings from
+        refresh.
+        """
+        # Include image dimensions for files that the file index has already read.
+        dimensions = {}
+        all_children = [child for path, children in listings for child in children]
+        for entry_path, entry in self.db.get_many(all_children).items():
+            if entry.get('width') is not None:
+                dimensions[entry_path] = (entry['width'], entry['height'], entry['mtime'])
+
+        self.search_index.update_directories(listings, dimensions=dimensions, conn=conn)
+
+    def _refresh_metadata_file(self, metadata_file, *, conn=None):
+        """
+        Add files listed in a metadata file that aren't in the database yet.
 
-    async def _refresh_metadata_file(self, metadata_file, *, conn=None):
+        If every file was added, return the metadata file's (directory, mtime, size) for
+        FileIndex.set_metadata_file_states, so it can be skipped until it changes.  If some
+        files couldn't be added, return None so we try again next time.
+        """
         assert metadata_file.name == metadata_storage.metadata_filename
-                    
+
+        # Stat the file before reading it, so if it changes while we're reading it, the state
+        # we return is out of date and it'll be read again.
+        try:
+            stat = metadata_file.stat()
+        except FileNotFoundError:
+            return None
+
         # Refresh just files with metadata.
-        for path in metadata_storage.get_files_with_metadata(metadata_file):
+        paths = metadata_storage.get_files_with_metadata(metadata_file)
+
+        # Skip files that are already in the database.
+        existing_entries = self.db.get_many(paths, conn=conn)
+
+        entries = []
+        complete = True
+        for path in paths:
+            if os.fspath(path) in existing_entries:
+                continue
+
             try:
                 # This file has metadata (usually a bookmark), so add it to the database.
                 # We might be adding thousands of files here, so only add an unpopulated entry.
                 # This imports bookmarrks, and any other metadata we stashed away in the
                 # metadata files.
-                self._get_entry(path=path, conn=conn, populate=False, check_mtime=False)
+                entry = self._get_entry_from_path(path, populate=False)
             except FileNotFoundError as e:
+                entry = None
+
+            if entry is None:
                 log.warn('Bookmarked file %s doesn\'t exist' % path)
+                complete = False
                 continue
 
+            # Don't cache entries if there was an error scanning the file.
+            if entry.get('error') is None:
+                entries.append(entry)
+            else:
+                complete = False
+
+        # Add the new entries together, so they're written in a single transaction.
+        self.db.add_records(entries, conn=conn)
+
+        if not complete:
+            return None
+        return str(Path(metadata_file).parent), stat.st_mtime, stat.st_size
+
     def monitor(self, mount):
         """
         Begin monitoring our directory for changes that need to be indexed.
@@ -414,7 +882,7 @@ class Library:
             raise ValueError('Mount doesn\'t exist: %s' % mount)
 
         try:
-            monitor = monitor_changes.MonitorChanges(path.path)
+            monitor = monitor_changes.create_monitor(path.path)
             task = asyncio.create_task(monitor.monitor_call(self.monitored_file_changed), name='MonitorChanges(%s)' % (mount))
             self.monitors[mount] = task
             log.info('Started monitoring: %s' % path)
@@ -432,9 +900,12 @@ class Library:
         if path is None:
             raise ValueError('Mount doesn\'t exist: %s' % mount)
 
+        # Wait for the monitor to exit.  If it was cancelled while handling a change rather
+        # than while waiting for one, the task ends as cancelled, so use wait() instead of
+        # awaiting it directly, so that doesn't propagate to us.
         task = self.monitors.pop(mount)
         task.cancel()
-        await task
+        await asyncio.wait([task])
 
         log.info('Stopped monitoring: %s' % path)
 
@@ -466,6 +937,28 @@ class Library:
         path may be a string.  We'll only convert it to a Path if necessary, since doing this
         for every file is slow.
         """
+        # If the monitor lost track of changes, anything inside path may have changed, so
+        # discard all cached listings and refresh it.
+        if action == monitor_changes.FileAction.FILE_ACTION_OVERFLOW:
+            log.info('Refreshing after missed changes: %s' % path)
+            self.listing_cache.clear()
+            await self.refresh(paths=[path])
+            return
+
+        # Discard cached listings for the directories this changed, and for the path itself
+        # if it's a directory that was removed or renamed.
+        for changed_path in (path, old_path):
+            if changed_path is not None:
+                changed_path = Path(os.fspath(changed_path))
+                self.listing_cache.invalidate(changed_path.parent)
+                self.listing_cache.invalidate(changed_path)
+
+        # Update the search index.  Added directories are filled in by the refresh below.
+        # This writes to the database, so do it in a thread, or a burst of changes like
+        # copying a large folder would block requests.  Changes are handled one at a time,
+        # so they're still applied in order.
+        await asyncio.to_thread(self._apply_search_index_change, path, action, old_path=old_path)
+
         # If we receive FILE_ACTION_ADDED for a directory, a directory was either created or
         # moved into our tree.  Scan it for metadata files.  We can't use a quick refresh
         # here, since we often get here before Windows's indexing has caught up.
@@ -482,6 +975,17 @@ class Library:
             log.info('Refreshing added directory: %s' % path)
             await self.refresh(paths=[path])
 
+    def _apply_search_index_change(self, path, action, *, old_path=None):
+        """
+        Update the search index for a change from handle_update.
+        """
+        if action == monitor_changes.FileAction.FILE_ACTION_REMOVED:
+            self.search_index.delete_recursively([path])
+        elif action == monitor_changes.FileAction.FILE_ACTION_RENAMED:
+            self.search_index.rename(old_path, path)
+        elif action in (monitor_changes.FileAction.FILE_ACTION_ADDED, monitor_changes.FileAction.FILE_ACTION_MODIFIED):
+            self.search_index.update_path(path)
+
     def _get_entry_from_path(self, path: os.PathLike, *, populate=True, extra_metadata=None):
         """
         Return an entry from a path.
@@ -720,7 +1224,7 @@ class Library:
             else:
                 return None
 
-        self._convert_to_path(entry)
+        entry = self._convert_to_path(entry)
         return entry
 
     def list(self,
@@ -731,6 +1235,12 @@ class Library:
         include_files=True,
         include_dirs=True,
         batch_size=50,
+
+        # If set, a cursor from get_cursor for the last result of a previous call, and
+        # the listing continues after it.  If backwards is true, return the files before
+        # it instead, in reverse order.
+        after=None,
+        backwards=False,
     ):
         """
         Return all files inside each path non-recursively.
@@ -745,49 +1255,63 @@ class Library:
         elif sort_order == '-normal':
             sort_order = _default_directory_list_reverse_sort
 
-        # Run scandir for each path, and chain them together into a single iterator.
-        iterators = []
-        for path in paths:
-            iterators.append(path.scandir())
-        scandir_results = itertools.chain(*iterators)
-
-        # If we have a sort order, read the full results and sort.  If we aren't sorting,
-        # leave iter as an iterator so we'll read it incrementally.
-        if sort_order == 'shuffle':
-            scandir_results = list(scandir_results)
-            random.shuffle(scandir_results)
-            scandir_results.sort(key=lambda item: not item.is_dir())
-            scandir_results = iter(scandir_results)
-        elif sort_order is not None:
-            sort_order_info = _get_sort(sort_order)
-            if sort_order_info is not None:
-                sorted_results = list(scandir_results)
-                sorted_results.sort(key=sort_order_info['fs'], reverse=sort_order_info['reverse'])
+        paths = list(paths)
+        listing = self._get_sorted_listing(paths, sort_order)
+
+        if after is not None:
+            position, found = self._find_in_listing(listing, after, sort_order)
+            if backwards:
+                listing = reversed(listing[:position])
+            else:
+                listing = itertools.islice(listing, position + 1 if found else position, None)
+        elif backwards:
+            listing = reversed(listing)
+
+        def get_children():
+            for parent, name, is_dir in listing:
+                if not include_dirs and is_dir:
+                    continue
+                if not include_files and not is_dir:
+                    continue
+
+                yield parent / name
 
-                # Convert back to an iterator.
-                scandir_results = iter(sorted_results)
+        children = get_children()
 
         results = []
-        for child in scandir_results:
-            # Skip unsupported files.
-            if misc.ignore_file(child):
-                continue
+        while True:
+            # Read enough children to fill the rest of this batch.
+            batch = list(itertools.islice(children, batch_size - len(results)))
+            if not batch:
+                break
 
-            is_dir = child.is_dir()
-            if not include_dirs and is_dir:
-                continue
-            if not include_files and not is_dir:
-                continue
+            # Read everything we have cached for this batch with one query, rather than looking
+            # up each file separately, and only read the part of the directory we're returning.
+            cached_entries = {}
+            if not force_refresh:
+                cached_entries = self.db.get_many(Path(os.fspath(child)) for child in batch)
 
-            # Find the file in cache and cache it if needed.
-            entry = self._get_entry(child, force_refresh=force_refresh)
-            if entry is None:
-                continue
+            # Find the children in cache or cache them if needed.  These are populated in parallel.
+            jobs = []
+            pending_writes = []
+            for child in batch:
+                def get_entry(child=child):
+                    return self._get_entry(child, force_refresh=force_refresh, cached_entries=cached_entries, pending_writes=pending_writes)
+                jobs.append((child, get_entry))
 
-            self._convert_to_path(entry)
-            results.append(entry)
+            entries = self._run_populate_jobs(jobs)
+
+            # Save newly cached entries for this batch in a single transaction.
+            self.db.add_records(pending_writes)
+
+            for entry in entries:
+                if entry is None:
+                    continue
+
+                entry = self._convert_to_path(entry)
+                results.append(entry)
 
-            # If we have a full batch, stop iterating and return it.
+            # If we have a full batch, return it.
             if len(results) >= batch_size:
                 yield results
                 results = []
@@ -811,16 +1335,7 @@ class Library:
         elif sort_order == '-normal':
             sort_order = _default_directory_list_reverse_sort
 
-        scandir_results = path.scandir()
-
-        if sort_order == 'shuffle':
-            scandir_results = list(scandir_results)
-            random.shuffle(scandir_results)
-            scandir_results.sort(key=lambda item: not item.is_dir())
-        elif sort_order is not None:
-            sort_order_info = _get_sort(sort_order)
-            if sort_order_info is not None:
-                scandir_results = sorted(scandir_results, key=sort_order_info['fs'], reverse=sort_order_info['reverse'])
+        listing = self._get_sorted_listing([path], sort_order)
 
         # pathlib is surprisingly slow, and becomes a major bottleneck when we're looking
         # up large search results.  Since all files will be in the same directory, optimize
@@ -836,18 +1351,134 @@ class Library:
             root_path = PurePosixPath('/root') / str(path).replace('\\', '/')
 
         results = []
-        for path in scandir_results:
-            # Skip unsupported files.
-            if misc.ignore_file(path):
-                continue
-
-            is_dir = path.is_dir()
-            relative_path = root_path / path.name
+        for parent, name, is_dir in listing:
+            relative_path = root_path / name
             media_id = '%s:%s' % ('folder' if is_dir else 'file', relative_path)
             results.append(media_id)
             
         return results
 
+    def get_cursor(self, entry, sort_order):
+        """
+        Return a cursor to resume list or search after entry, using the after argument.
+
+        This holds the entry's path and its values for the sort, so the listing or search
+        can continue from where the entry was even if it's been deleted since.  This doesn't
+        depend on any state, so it can be used later, or after restarting.
+        """
+        sort_order_info = _get_sort(sort_order)
+        key = None
+        if sort_order_info is not None and 'index_key' in sort_order_info:
+            key = list(sort_order_info['index_key'](entry))
+
+        return {
+            'path': entry['path'],
+            'is_dir': bool(entry['is_directory']),
+            'key': key,
+        }
+
+    def _find_in_listing(self, listing, cursor, sort_order):
+        """
+        Find a cursor from get_cursor in a listing from _get_sorted_listing, and return
+        (position, found).
+
+        If the cursor's file is still in the listing, return its position.  Otherwise, it's
+        been deleted or renamed, so return the position it would be at.
+        """
+        path = os.fspath(cursor['path'])
+        parent = os.path.dirname(path)
+        name = os.path.basename(path)
+
+        def is_cursor_file(item_parent, item_name):
+            return item_name == name and os.fspath(item_parent) == parent
+
+        sort_order_info = _get_sort(sort_order)
+        if sort_order_info is not None:
+            fs_key = sort_order_info['fs']
+            reverse = sort_order_info['reverse']
+
+            def get_key(item_parent, item_name, item_is_dir):
+                return fs_key(_ListingItem(os.path.join(os.fspath(item_parent), item_name), item_is_dir))
+
+            try:
+                # Binary search for the first file that doesn't sort before the cursor.
+                key = fs_key(_ListingItem(path, cursor['is_dir']))
+                start, end = 0, len(listing)
+                while start < end:
+                    mid = (start + end) // 2
+                    item_key = get_key(*listing[mid])
+                    if (item_key > key) if reverse else (item_key < key):
+                        start = mid + 1
+                    else:
+                        end = mid
+
+                # Files with the same key as the cursor follow it.  If the cursor's file is
+                # still there, it's one of them.
+                for idx in range(start, len(listing)):
+                    item_parent, item_name, item_is_dir = listing[idx]
+                    if is_cursor_file(item_parent, item_name):
+                        return idx, True
+                    if get_key(item_parent, item_name, item_is_dir) != key:
+                        break
+
+                return start, False
+            except (AttributeError, OSError):
+                # Some sorts, like ctime, need to stat the file, so fall back on searching
+                # the whole listing.
+                pass
+
+        for idx, (item_parent, item_name, _) in enumerate(listing):
+            if item_name == name and os.fspath(item_parent) == parent:
+                return idx, True
+
+        # The file is gone, and we can't tell where it would be.
+        log.warn(f'Couldn\'t find position of {path} in {sort_order} listing')
+        return 0, False
+
+    def _get_sorted_listing(self, paths, sort_order):
+        """
+        Return the files inside each path non-recursively, sorted by sort_order, as a list of
+        (parent, name, is_dir).  Ignored files aren't included.
+
+        Listings are cached in listing_cache until one of the directories changes.
+        """
+        # Read the directory mtimes before listing them, so if they're modified while we're
+        # reading them, the listing we cache will already be stale.  Don't cache shuffles
+        # without a seed, since the order should be different each time.
+        mtimes = None
+        if sort_order is None or sort_order.lstrip('-') != 'shuffle':
+            try:
+                mtimes = [os.stat(path.filesystem_path).st_mtime_ns for path in paths]
+            except OSError:
+                pass
+
+        if mtimes is not None:
+            listing = self.listing_cache.get(paths, sort_order, mtimes)
+            if listing is not None:
+                return listing
+
+        # Run scandir for each path, skipping unsupported files.
+        scandir_results = []
+        for path in paths:
+            for child in path.scandir():
+                if not misc.ignore_file(child):
+                    scandir_results.append((path, child))
+
+        if sort_order is not None:
+            sort_order_info = _get_sort(sort_order)
+            if sort_order_info is not None:
+                fs_key = sort_order_info['fs']
+                scandir_results.sort(key=lambda item: fs_key(item[1]), reverse=sort_order_info['reverse'])
+
+        # Only store names and not the paths themselves.  Paths from scandir cache the file's
+        # stat, which would go stale without the directory changing.
+        listing = [(parent, child.name, child.is_dir()) for parent, child in scandir_results]
+
+        if mtimes is not None:
+            self.listing_cache.put(paths, sort_order, mtimes, listing)
+
+        return listing
+
     def get_mountpoint_entries(self):
         """
         Return entries for each mountpoint.
@@ -858,7 +1489,7 @@ class Library:
                 entry = self._get_entry(mount_path, conn=conn)
                 assert entry is not None
                 
-                self._convert_to_path(entry)
+                entry = self._convert_to_path(entry)
                 results.append(entry)
         return results
 
@@ -889,6 +1520,15 @@ class Library:
 
         # If false and the file isn't cached, cache an unpopulated entry.
         populate=True,
+
+        # If set, this is a dictionary of database entries by path which the caller has
+        # already read, and is used instead of looking up path in the database.  Paths
+        # that aren't in the dictionary aren't cached.
+        cached_entries=None,
+
+        # If set, new entries are appended to this list instead of being saved, so the
+        # caller can save them together with add_records.
+        pending_writes=None,
         conn=None):
         """
         Return the entry for path.  If the path isn't cached, populate the cache entry.
@@ -898,7 +1538,10 @@ class Library:
         entry = None
         if not force_refresh:
             # See if the file is already cached.
-            entry = self.db.get(path=os.fspath(path), conn=conn)
+            if cached_entries is not None:
+                entry = cached_entries.get(os.fspath(path))
+            else:
+                entry = self.db.get(path=os.fspath(path), conn=conn)
 
             # If the entry isn't populated and we're populating, ignore the database entry, so
             # we'll populate it.
@@ -908,6 +1551,9 @@ class Library:
             if entry is not None and check_mtime:
                 # Check if this entry exists on disk and is up to date.
                 if not self._entry_is_up_to_date(entry):
+                    # The file has changed, so any thumbnails we have for it are stale.
+                    self._discard_thumbnails([entry['path']])
+
                     # Clear entry, so we'll re-cache it below.
                     entry = None
 
@@ -922,21 +1568,93 @@ class Library:
             # it.
             # log.info('Path doesn\'t exist, purging any cached entries: %s' % path)
             self.db.delete_recursively([path], conn=conn)
+            self._discard_thumbnails([path])
             return None
 
         # Don't cache entries if there was an error scanning the file.
         if entry.get('error') is None:
-            self.db.add_record(entry, conn=conn)
+            if pending_writes is not None:
+                pending_writes.append(entry)
+            else:
+                self.db.add_record(entry, conn=conn)
 
         return entry
 
+    def _run_populate_jobs(self, jobs):
+        """
+        Run a list of (path, func) jobs, returning the result of each func() in order.
+
+        Each job runs on the populate pool for the mount containing path, so reading the
+        files in a page of results can overlap.  Jobs on mounts without a pool are run
+        on this thread.
+        """
+        futures = []
+        for path, func in jobs:
+            executor = self.populate_executors.get(self.get_mount_for_path(path))
+            futures.append(executor.submit(func) if executor is not None else func)
+
+        results = []
+        for future in futures:
+            results.append(future() if callable(future) else future.result())
+        return results
+
+    def sweep_missing_files(self, *, after_id=0, limit=500):
+        """
+        Check up to limit index entries with IDs after after_id, removing entries for
+        files that no longer exist.  This cleans up entries that searches haven't run into.
+
+        Entries in mounts whose directory isn't available, such as a disconnected network
+        drive, are left alone.
+
+        Return (last_id, checked, removed), where last_id is the ID to continue from, or
+        None if the whole index has been checked.
+        """
+        rows = self.db.get_paths_after(after_id, limit)
+        if not rows:
+            return None, 0, 0
+
+        # Check the mount paths on the filesystem directly, since the mount's path object may
+        # have cached its stat.
+        available_mounts = {name for name, mount_path in self.mounts.items() if mount_path.filesystem_path.exists()}
+
+        missing = []
+        for _, path in rows:
+            path = open_path(path)
+            if self.get_mount_for_path(path) not in available_mounts:
+                continue
+
+            if not path.exists():
+                missing.append(path)
+
+        if missing:
+            log.info(f'Removing {len(missing)} index entries for files that no longer exist')
+            self.db.delete_recursively(missing)
+            self._discard_thumbnails(missing)
+
+        return rows[-1][0], len(rows), len(missing)
+
+    def _discard_thumbnails(self, paths):
+        """
+        Remove cached thumbnails for paths, since we've seen that they're stale.
+        """
+        if self.thumbnail_cache is None:
+            return
+
+        self.thumbnail_cache.delete_recursively(paths)
+
     def _convert_to_path(self, entry):
         """
-        FileIndex only deals with string paths.  Our API uses BasePath.  Convert paths
-        in entry from strings to BasePath.
+        FileIndex only deals with string paths.  Our API uses BasePath.  Return entry as
+        a FileEntry with paths converted from strings to BasePath.
+
+        Paths are converted when they're first read, since this is expensive for files
+        inside ZIPs, and most callers never look at the parent.
         """
-        entry['path'] = open_path(entry['path'])
-        entry['parent'] = open_path(entry['parent'])
+        if not isinstance(entry, FileEntry):
+            entry = FileEntry(entry)
+
+        entry.open_paths(open_path)
+        return entry
 
     # Searching is a bit tricky.  We have a few things we want to do:
     #
@@ -968,52 +1686,62 @@ class Library:
 
         # If true, check that search results from the database actually exist on disk.
         verify_files=True,
+
+        # If set, a cursor from get_cursor for the last result of a previous search, and the
+        # search continues after it.  If backwards is true, return the results before it
+        # instead, in reverse order.  This can only be used if can_resume_search is true.
+        after=None,
+        backwards=False,
         **search_options):
         if not paths:
             paths = self.mounts.values()
 
         assert paths
 
-        # if the sort order is shuffle, disable sorting within the actual searches.
-        shuffle = sort_order == 'shuffle'
-        if shuffle:
-            sort_order_info = None
-        else:
-            sort_order_info = _get_sort(sort_order)
+        if backwards:
+            sort_order = _reverse_sort_order(sort_order)
+        sort_order_info = _get_sort(sort_order)
 
         # A sort order needs these keys to be used with searching.
         if sort_order_info is not None:
             for key in ('entry', 'index', 'windows'):
                 if key not in sort_order_info:
                     log.warn(f'Sort "{sort_order}" not supported for searching')
-                    sort_order_info = sort_orders['normal']
+                    sort_order_info = _get_sort('normal')
                     break
 
-        # We're waiting synchronously for the Windows search if we're in shuffle and can't
-        # return any results at all until it finishes, so use a smaller timeout.
-        windows_search_timeout = 5 if shuffle else 10
+        shuffle = sort_order_info is not None and 'shuffle_seed' in sort_order_info
 
-        # Don't use Windows search when searching bookmarks.  Bookmarks are always indexed,
-        # and the search doesn't help us with them.
-        if search_options.get('bookmarked') or search_options.get('bookmark_tags') is not None:
+        # If we're resuming a search, start the index search after the cursor.  Only index
+        # searches can be resumed, so don't use Windows search.
+        index_after = None
+        if after is not None:
             use_windows_search = False
+            values = [*after['key'], str(after['path']).lower()]
+            assert len(values) == len(sort_order_info['index_columns'])
+            index_after = [(expr, asc_desc, value) for (expr, asc_desc), value in zip(sort_order_info['index_columns'], values)]
+
+        # Windows search can't shuffle, so we wait for all of its results if we're shuffling.
+        # Use a smaller timeout in case it matches tons of results.
+        windows_search_timeout = 5 if shuffle else 10
+
+        use_windows_search = self._should_use_windows_search(use_windows_search, search_options)
 
         # Create the Windows search.
         if use_windows_search:
-            order = sort_order_info['windows'] if sort_order_info else None
-            order_fs = sort_order_info['fs'] if sort_order_info else None
-            windows_search_iter = windows_search.search(paths=[str(path) for path in paths],
-                order=order,
-                order_fs=order_fs,
+            windows_search_iter = self.search_files(paths=[str(path) for path in paths],
+                sort_order_info=sort_order_info,
                 timeout=windows_search_timeout,
                 **search_options)
         else:
             windows_search_iter = []
 
         # Create the index search.
-        if use_index:
+        if use_index and shuffle:
+            index_search_iter = self._search_index_shuffled(sort_order_info, index_after, paths=[str(path) for path in paths], **search_options)
+        elif use_index:
             order = sort_order_info['index'] if sort_order_info else None
-            index_search_iter = self.db.search(paths=[str(path) for path in paths], order=order, **search_options)
+            index_search_iter = self.db.search(paths=[str(path) for path in paths], order=order, after=index_after, **search_options)
         else:
             index_search_iter = []
 
@@ -1025,7 +1753,7 @@ class Library:
                 # This is just a signal that the Windows search timed out.  We only enable timeouts
                 # for shuffled searches, in case they match tons of results.
                 return None
-            elif isinstance(result, os.DirEntry) or isinstance(result, windows_search.SearchDirEntry):
+            elif isinstance(result, (os.DirEntry, windows_search.SearchDirEntry, IndexedDirEntry)):
                 # log.info('Search result from Windows:', result.path)
                 if result.path in seen_paths:
                     return
@@ -1043,96 +1771,59 @@ class Library:
 
                 return result
 
-        if shuffle:
-            # If we're shuffling, read both iterators all the way through and shuffle them.
-            # This is set up so we only run the search and don't call Library.get() at this
-            # point, so we only run file caching for results as we return them.
-            all_results = list(windows_search_iter) + list(index_search_iter)
-            random.shuffle(all_results)
-
-            # To match other shuffles, sort folders first.  Since we're doing this before converting
-            # to entries, we need to sort a mixed list of SearchDirEntry and Paths.
-            def folders_first(item):
-                if item is windows_search.SearchTimeout:
-                    # This is ignored, so it doesn't matter where it goes.
-                    return 0
-                elif isinstance(item, os.DirEntry) or isinstance(item, windows_search.SearchDirEntry):
-                    return not item.is_dir()
-                else:
-                    return not item['is_directory']
-
-            all_results.sort(key=folders_first)
-
-            def get_shuffled_results():
-                for result in all_results:
-                    entry = get_entry_from_result(result)
-                    if entry is not None:
-                        yield entry
-
-            final_search = get_shuffled_results()
+        # We now have our two generators to run the searches: windows_search_iter and
+        # index_search_iter.  Wrap both of them in a ThreadedQueue, so they continue
+        # and run to completion in the background, even though we'll only read chunks of
+        # them at a time here.  This prevents us from keeping the Windows search queries
+        # and SQLite transactions open indefinitely.  This doesn't do any of the slower
+        # work of scanning files, just the file search.
+        windows_search_iter = misc.ThreadedQueue(windows_search_iter)
+        index_search_iter = misc.ThreadedQueue(index_search_iter)
+
+        # get_results_from_search iterates through those and yield entries.
+        def get_results_from_index():
+            for result in index_search_iter:
+                entry = get_entry_from_result(result)
+                if entry is not None:
+                    yield entry
+
+        def get_results_from_search():
+            for result in windows_search_iter:
+                entry = get_entry_from_result(result)
+                if entry is not None:
+                    yield entry
+
+        # Create the iterators for both searches.
+        search_results_iter = get_results_from_search()
+        index_results_iter = get_results_from_index()
+
+        # If we're sorting, use heapq.merge to merge the two together.  Otherwise, just chain them.
+        if sort_order_info:
+            final_search = heapq.merge(search_results_iter, index_results_iter, key=sort_order_info['entry'], reverse=sort_order_info['reverse'])
         else:
-            # We now have our two generators to run the searches: windows_search_iter and
-            # index_search_iter.  Wrap both of them in a ThreadedQueue, so they continue
-            # and run to completion in the background, even though we'll only read chunks of
-            # them at a time here.  This prevents us from keeping the Windows search queries
-            # and SQLite transactions open indefinitely.  This doesn't do any of the slower
-            # work of scanning files, just the file search.
-            windows_search_iter = misc.ThreadedQueue(windows_search_iter)
-            index_search_iter = misc.ThreadedQueue(index_search_iter)
-
-            # get_results_from_search iterates through those and yield entries.
-            def get_results_from_index():
-                for result in index_search_iter:
-                    entry = get_entry_from_result(result)
-                    if entry is not None:
-                        yield entry
-
-            def get_results_from_search():
-                for result in windows_search_iter:
-                    entry = get_entry_from_result(result)
-                    if entry is not None:
-                        yield entry
-
-            # Create the iterators for both searches.
-            search_results_iter = get_results_from_search()
-            index_results_iter = get_results_from_index()
-
-            # If we're sorting, use heapq.merge to merge the two together.  Otherwise, just chain them.
-            if sort_order_info:
-                final_search = heapq.merge(search_results_iter, index_results_iter, key=sort_order_info['entry'], reverse=sort_order_info['reverse'])
-            else:
-                final_search = itertools.chain(search_results_iter, index_results_iter)
+            final_search = itertools.chain(search_results_iter, index_results_iter)
 
-        # Iterate over the final search, returning it in batches.
-        results = []
-        for entry in final_search:
-            if entry is None:
-                continue
+        # Compile the search filters once, so filtering unpopulated entries doesn't need
+        # to run a query for each entry.
+        matches_search = self.db.compile_search(**search_options)
 
+        def load_entry(path, entry):
+            """
+            Populate and verify a search result.  This is run on the populate pool.
+            """
             # If this entry isn't populated, populate it now.
             if not entry['populated']:
-                # We have a subset of data in the unpopulated entry.  It'll always have the
-                # filename, keyword, etc., and it may or may not have file-specific data like
-                # width and height.  Do an early filter based on what information we have.
-                # If the user searched for width and we know the width already, we can discard
-                # the result now and not waste time reading the full entry.  This makes some
-                # searches a lot faster.
-                if not self.db.entry_matches_search(entry, incomplete=True, **search_options):
-                    # log.info('Early discarded search result that doesn\'t match: %s' % entry['path'])
-                    continue
-
                 # Load the full entry.
-                path = open_path(entry['path'])
                 entry = self._get_entry(path)
                 if entry is None:
-                    continue
+                    return None
 
                 # If the search only had a placeholder, it wasn't able to check the complete
                 # search.  For example, Windows index searching doesn't know if a GIF is animated.
                 # Re-check the result now that we have a populated entry.
-                if not self.db.entry_matches_search(entry, **search_options):
+                if not matches_search(entry):
                     log.info('Discarded search result that doesn\'t match: %s' % entry['path'])
-                    continue
+                    return None
 
             # If we're verifying files, see if the file needs to be refreshed.
             if verify_files:
@@ -1142,24 +1833,163 @@ class Library:
                     # exists we'll get the updated entry.
                     # The cached entry is out of date, so refresh or delete it.
                     log.info('Refreshing stale entry: %s', entry['path'])
-                    path = open_path(entry['path'])
                     entry = self._get_entry(path, force_refresh=True)
 
-            if entry is None:
-                continue
+            return entry
 
-            self._convert_to_path(entry)
-            results.append(entry)
+        # Iterate over the final search, returning it in batches.  If our caller stops
+        # reading early, stop the background searches so they don't keep reading results
+        # nobody will use.
+        results = []
+        try:
+            while True:
+                # Read enough results to fill the rest of this batch.
+                jobs = []
+                for entry in final_search:
+                    if entry is None:
+                        continue
+
+                    # We have a subset of data in unpopulated entries.  It'll always have the
+                    # filename, keyword, etc., and it may or may not have file-specific data like
+                    # width and height.  Do an early filter based on what information we have.
+                    # If the user searched for width and we know the width already, we can discard
+                    # the result now and not waste time reading the full entry.  This makes some
+                    # searches a lot faster.
+                    if not entry['populated'] and not matches_search(entry, incomplete=True):
+                        # log.info('Early discarded search result that doesn\'t match: %s' % entry['path'])
+                        continue
 
-            # If we have a full batch, stop iterating and return it.
-            if len(results) >= batch_size:
-                # Yield this block of results.
+                    path = open_path(entry['path'])
+                    jobs.append((path, lambda path=path, entry=entry: load_entry(path, entry)))
+                    if len(jobs) >= batch_size - len(results):
+                        break
+
+                if not jobs:
+                    break
+
+                # Populate the results in parallel.  Results are returned in order.
+                for entry in self._run_populate_jobs(jobs):
+                    if entry is None:
+                        continue
+
+                    entry = self._convert_to_path(entry)
+                    results.append(entry)
+
+                # If we have a full batch, yield this block of results.
+                if len(results) >= batch_size:
+                    yield results
+                    results = []
+
+            # Yield any leftover results.
+            if results:
                 yield results
-                results = []
+        finally:
+            windows_search_iter.cancel(wait=False)
+            index_search_iter.cancel(wait=False)
 
-        # Yield any leftover results.
-        if results:
-            yield results
+    def _search_index_shuffled(self, sort_order_info, after, **search_options):
+        """
+        Run an index search in the shuffled order from _get_shuffle_sort.
+
+        The shuffle is made of several ranges of shuffle keys, so we search each range in
+        turn.  If after is set, skip to the range containing it and continue from there.
+        """
+        reverse = sort_order_info['reverse']
+        asc_desc = 'DESC' if reverse else 'ASC'
+        order = f'ORDER BY shuffle_key {asc_desc}, path_lowercase {asc_desc}'
+
+        ranges = sort_order_info['shuffle_ranges']
+        if reverse:
+            ranges = list(reversed(ranges))
+
+        for start, end in ranges:
+            if start >= end:
+                continue
+
+            if after is not None:
+                # Skip ranges until we reach the one the cursor is in.
+                after_key = after[0][2]
+                if not (start <= after_key < end):
+                    continue
+
+                range_after = after
+                after = None
+            elif not reverse:
+                range_after = [('shuffle_key', 'ASC', start - 1)] if start > -(1 << 63) else None
+            else:
+                range_after = [('shuffle_key', 'DESC', end)] if end < (1 << 63) else None
+
+            search = self.db.search(order=order, after=range_after, **search_options)
+            try:
+                for entry in search:
+                    # Stop when we reach the end of the range.
+                    key = entry['shuffle_key']
+                    if (key < start) if reverse else (key >= end):
+                        break
+
+                    yield entry
+            finally:
+                search.close()
+
+    def search_files(self, *, paths, sort_order_info=None, **search_options):
+        """
+        Search for files on disk with the search backend, yielding DirEntry-like results.
+
+        This searches all files, not just ones in FileIndex.  search_options are the same
+        as windows_search.search.  If sort_order_info is set, results are in that order, so
+        they can be merged with index results.  If the backend can't sort that way, all
+        results are read and sorted here.
+        """
+        order_fs = sort_order_info['fs'] if sort_order_info else None
+        reverse = sort_order_info['reverse'] if sort_order_info else False
+
+        if self.search_backend == 'index':
+            order = sort_order_info['index_columns'] if sort_order_info else None
+            return self.search_index.search(paths=paths, order=order, order_fs=order_fs, reverse=reverse, **search_options)
+
+        # Paths that Windows Search isn't indexing are searched with the search index.
+        fallback = functools.partial(self.search_index.search, order=sort_order_info['index_columns'] if sort_order_info else None)
+
+        order = sort_order_info['windows'] if sort_order_info else None
+        results = windows_search.search(paths=paths,
+            order=order,
+            order_fs=order_fs,
+            reverse=reverse,
+            fallback=fallback,
+            **search_options)
+
+        # If Windows search can't sort this way, read all of its results and sort them here,
+        # so they can be merged with the index.  This is the case for natural sorts and
+        # shuffles.
+        if sort_order_info is not None and order is None:
+            results = sorted(
+                (result for result in results if result is not windows_search.SearchTimeout),
+                key=order_fs, reverse=reverse)
+
+        return results
+
+    @classmethod
+    def _should_use_windows_search(cls, use_windows_search, search_options):
+        # Don't use Windows search when searching bookmarks.  Bookmarks are always indexed,
+        # and the search doesn't help us with them.
+        if search_options.get('bookmarked') or search_options.get('bookmark_tags') is not None:
+            return False
+
+        return use_windows_search
+
+    def can_resume_search(self, *, sort_order='normal', use_windows_search=True, **search_options):
+        """
+        Return true if a search with these options can be resumed from a cursor.
+
+        This is only possible if all results come from the index, in index order.  Windows
+        search results can't be resumed partway through.  Shuffles can only be resumed if
+        they have a seed, like "shuffle:1234".
+        """
+        if sort_order.lstrip('-') == 'shuffle' or self._should_use_windows_search(use_windows_search, search_options):
+            return False
+
+        sort_order_info = _get_sort(sort_order)
+        return sort_order_info is not None and 'index_key' in sort_order_info
 
     def get_all_bookmark_paths(self):
         """
@@ -1191,23 +2021,7 @@ class Library:
         # Update the bookmark metadata file.
         path = open_path(entry['path'])
         with metadata_storage.load_and_lock_file_metadata(path) as file_metadata:
-            file_metadata['bookmarked'] = True
-
-            # Touch the updated time, and set the created time if it wasn't already set.
-            now = math.floor(time.time())
-            if 'bookmark_created_at' not in file_metadata:
-                file_metadata['bookmark_created_at'] = now
-            file_metadata['bookmark_updated_at'] = now
-
-            if tags is not None:
-                tags = self.normalize_bookmark_tags(tags)
-                file_metadata['bookmark_tags'] = tags
-
-            # Cache some basic metadata too, so we have access to it in placeholder
-            # data later.
-            file_metadata['width'] = entry['width']
-            file_metadata['height'] = entry['height']
-
+            self._set_bookmark_metadata(file_metadata, entry, tags=tags, now=math.floor(time.time()))
             metadata_storage.save_file_metadata(path, file_metadata)
 
         # Update the file in the index.
@@ -1216,25 +2030,157 @@ class Library:
     def bookmark_remove(self, path):
         # Update the bookmark metadata file.
         with metadata_storage.load_and_lock_file_metadata(path) as file_metadata:
-            if 'bookmarked' in file_metadata: del file_metadata['bookmarked']
-            if 'bookmark_tags' in file_metadata: del file_metadata['bookmark_tags']
-            if 'bookmark_created_at' in file_metadata: del file_metadata['bookmark_created_at']
-            if 'bookmark_updated_at' in file_metadata: del file_metadata['bookmark_updated_at']
-
-            # Clear cached metadata too, so the metadata is empty after unbookmarking and the
-            # metadata file can be deleted.
-            if 'width' in file_metadata: del file_metadata['width']
-            if 'height' in file_metadata: del file_metadata['height']
-
+            self._clear_bookmark_metadata(file_metadata)
             metadata_storage.save_file_metadata(path, file_metadata)
 
         # Update the file in the index.
         return self.get(path, force_refresh=True)
 
+    @classmethod
+    def _set_bookmark_metadata(cls, file_metadata, entry, *, tags, now):
+        """
+        Bookmark a file in its metadata, setting its tags if tags isn't None.
+        """
+        file_metadata['bookmarked'] = True
+
+        # Touch the updated time, and set the created time if it wasn't already set.
+        if 'bookmark_created_at' not in file_metadata:
+            file_metadata['bookmark_created_at'] = now
+        file_metadata['bookmark_updated_at'] = now
+
+        if tags is not None:
+            tags = cls.normalize_bookmark_tags(tags)
+            file_metadata['bookmark_tags'] = tags
+
+        # Cache some basic metadata too, so we have access to it in placeholder
+        # data later.  Don't overwrite dimensions we already have with None if the file
+        # couldn't be read.
+        if entry.get('width') is not None and entry.get('height') is not None:
+            file_metadata['width'] = entry['width']
+            file_metadata['height'] = entry['height']
+
+    @classmethod
+    def _clear_bookmark_metadata(cls, file_metadata):
+        """
+        Remove a file's bookmark from its metadata.
+        """
+        for key in ('bookmarked', 'bookmark_tags', 'bookmark_created_at', 'bookmark_updated_at'):
+            file_metadata.pop(key, None)
+
+        # Clear cached metadata too, so the metadata is empty after unbookmarking and the
+        # metadata file can be deleted.
+        file_metadata.pop('width', None)
+        file_metadata.pop('height', None)
+
+    def bookmark_batch(self, edits):
+        """
+        Add, edit or delete bookmarks for many files at once.
+
+        edits is a list of dictionaries with:
+
+        - path: the absolute path to the file
+        - action: "add" to add or edit the bookmark, or "delete" to remove it
+        - tags: for "add", the new bookmark tags, or None to leave them unchanged
+        - add_tags, remove_tags: for "add", lists of tags to add to or remove from
+        the existing tags, for retagging files without replacing their other tags
+
+        This does the same thing as calling bookmark_edit or bookmark_remove for each
+        file, but each directory's metadata file is only written once, and the index
+        is updated in a single transaction.
+
+        Return a list with the updated entry for each edit, or a misc.Error if the edit
+        failed.
+        """
+        results = [None] * len(edits)
+        paths = [open_path(edit['path']) for edit in edits]
+
+        # Look up the files in the index.  Files being bookmarked are populated like
+        # bookmark_edit if they aren't in the index, aren't populated or have changed on
+        # disk, so we cache their current dimensions.  These are usually rare.  Files
+        # having their bookmark removed don't need to be up to date.
+        cached_entries = self.db.get_many(paths)
+        entries = {}
+        pending_writes = []
+        add_paths = {path for edit, path in zip(edits, paths) if edit['action'] == 'add'}
+        for path in list(add_paths) + [path for path in paths if path not in add_paths]:
+            if os.fspath(path) in entries:
+                continue
+
+            populate = path in add_paths
+            entry = self._get_entry(path, populate=populate, check_mtime=populate,
+                cached_entries=cached_entries, pending_writes=pending_writes)
+            if entry is not None:
+                entries[os.fspath(path)] = entry
+
+        if pending_writes:
+            self.db.add_records(pending_writes)
+
+        now = math.floor(time.time())
+        edited = []
+        existing_paths = {path for path in paths if os.fspath(path) in entries}
+        with metadata_storage.load_and_lock_files_metadata(existing_paths) as files_metadata:
+            for idx, (edit, path) in enumerate(zip(edits, paths)):
+                entry = entries.get(os.fspath(path))
+                if entry is None:
+                    results[idx] = misc.Error('not-found', 'File not in library')
+                    continue
+
+                file_metadata = files_metadata[path]
+                if edit['action'] == 'add':
+                    tags = edit.get('tags')
+                    add_tags = edit.get('add_tags') or []
+                    remove_tags = edit.get('remove_tags') or []
+                    if add_tags or remove_tags:
+                        tags = set((tags if tags is not None else file_metadata.get('bookmark_tags', '')).split(' '))
+                        tags = ' '.join((tags | set(add_tags)) - set(remove_tags))
+
+                    self._set_bookmark_metadata(file_metadata, entry, tags=tags, now=now)
+                elif edit['action'] == 'delete':
+                    self._clear_bookmark_metadata(file_metadata)
+                else:
+                    results[idx] = misc.Error('invalid-request', f'Invalid bookmark action: {edit["action"]}')
+                    continue
+
+                # Update bookmark data in the index entry from the new metadata.  This is
+                # the same data _get_entry_from_path reads, and avoids rereading the file.
+                entry['bookmarked'] = file_metadata.get('bookmarked', False)
+                entry['bookmark_tags'] = self.normalize_bookmark_tags(file_metadata.get('bookmark_tags', ''))
+                entry['bookmark_created_at'] = file_metadata.get('bookmark_created_at', 0)
+                entry['bookmark_updated_at'] = file_metadata.get('bookmark_updated_at', 0)
+
+                # Return a copy of the entry as of this edit, since a path can be edited more
+                # than once.
+                results[idx] = FileEntry(entry)
+                edited.append(idx)
+
+            # Write each directory's metadata file once.
+            edited_paths = {paths[idx] for idx in edited}
+            errors = metadata_storage.save_files_metadata({path: files_metadata[path] for path in edited_paths})
+            for idx in edited:
+                if paths[idx] in errors:
+                    results[idx] = misc.Error('error', str(errors[paths[idx]]))
+
+            # Update the index for the files we saved.
+            self.db.add_records(entries[os.fspath(path)] for path in edited_paths if path not in errors)
+
+        for idx, result in enumerate(results):
+            if isinstance(result, FileEntry):
+                results[idx] = self._convert_to_path(result)
+
+        return results
+
     def get_all_bookmark_tags(self):
         return self.db.get_all_bookmark_tags()
 
-    def batch_rename_tag(self, from_tag, to_tag, paths=None, max_edits=100):
+    def batch_rename_tag(self, from_tag, to_tag, paths=None):
+        """
+        Rename from_tag to to_tag in the bookmarks of all files in paths, or in all mounts
+        if paths isn't set.
+
+        Like bookmark_batch, each directory's metadata file is only written once, and the
+        index is updated in a single transaction.  Return a list of { media_id, tags } for
+        each file that was changed.
+        """
         # Stop if we're not changing anything.
         if from_tag == to_tag:
             return []
@@ -1247,16 +2193,17 @@ class Library:
         if ' ' in from_tag or ' ' in to_tag or to_tag == '':
             raise misc.Error('invalid-request', 'Invalid tag rename')
 
-        # Search for images bookmarked with from_tag.
-        index_search = self.db.search(paths=[str(path) for path in paths], bookmarked=True, bookmark_tags=from_tag)
+        # Search for images bookmarked with from_tag.  Read the results before we start
+        # writing.
+        entries = list(self.db.search(paths=[str(path) for path in paths], bookmarked=True, bookmark_tags=from_tag))
+        entry_paths = [open_path(entry['path']) for entry in entries]
 
-        updates = []
-        for entry in index_search:
-            # Update the bookmark metadata file.  This is the authoritative data for bookmark tags.
-            path = open_path(entry['path'])
-            with metadata_storage.load_and_lock_file_metadata(path) as file_metadata:
+        edited = []
+        with metadata_storage.load_and_lock_files_metadata(entry_paths) as files_metadata:
+            for entry, path in zip(entries, entry_paths):
                 # Our search is from the database, but the file metadata is authoritative.  Make sure
                 # the image is actually bookmarked and has the tag we're looking for.
+                file_metadata = files_metadata[path]
                 if not file_metadata.get('bookmarked'):
                     log.warn(f"Path is bookmarked in the database, but not on disk: {entry['path']}")
                     continue
@@ -1272,31 +2219,27 @@ class Library:
                 entry_bookmark_tags.remove(from_tag)
                 if to_tag not in entry_bookmark_tags:
                     entry_bookmark_tags.append(to_tag)
-                entry_bookmark_tags = ' '.join(entry_bookmark_tags)
-                file_metadata['bookmark_tags'] = entry_bookmark_tags
-
-                # Save the new bookmark tags.
-                metadata_storage.save_file_metadata(path, file_metadata)
-
-            # Update the file in the index to update cached bookmark_tags.  We don't populate here,
-            # so we don't spend a lot of time populating unpopulated images.  This will cause
-            # populated entries to be unpopulated in the database, which is OK.  They'll be
-            # repopulated the next time they're accessed.
-            self._get_entry(path, force_refresh=True, populate=False)
-
-            # We don't return full media info here, since we'd need to populate all of the data to
-            # do that.  Instead, we just return the new tag lists, so the client can update tags
-            # for images it already knows about and ignore the rest.
-            updates.append({
-                'media_id': entry['id'],
-                'tags': entry_bookmark_tags,
-            })
+                file_metadata['bookmark_tags'] = ' '.join(entry_bookmark_tags)
 
-            # Stop if we've made the maximum number of updates in one pass.
-            if max_edits and len(updates) >= max_edits:
-                break
+                # Update the cached bookmark tags in the index entry from the new metadata, like
+                # bookmark_batch.
+                entry['bookmark_tags'] = self.normalize_bookmark_tags(file_metadata['bookmark_tags'])
+                edited.append((entry, path))
+
+            # Write each directory's metadata file once.
+            errors = metadata_storage.save_files_metadata({path: files_metadata[path] for entry, path in edited})
+
+            # Update the index for the files we saved.
+            edited = [(entry, path) for entry, path in edited if path not in errors]
+            self.db.add_records(entry for entry, path in edited)
 
-        return updates
+        # We don't return full media info here, since we'd need to populate all of the data to
+        # do that.  Instead, we just return the new tag lists, so the client can update tags
+        # for images it already knows about and ignore the rest.
+        return [{
+            'media_id': entry['id'],
+            'tags': files_metadata[path]['bookmark_tags'],
+        } for entry, path in edited]
 
     def set_image_edits(self, entry, *, inpaint=no_change, crop=no_change, pan=no_change):
         with metadata_storage.load_and_lock_file_metadata(entry['path']) as file_metadata:
@@ -1368,5 +2311,439 @@ async def test():
     while True:
         await asyncio.sleep(0.5)
 
+async def test_populate_benchmark(count=200, latency=0.02, workers=(1, 2, 4, 8), batch_size=50):
+    """
+    Measure how long it takes to return the first page of a cold folder with different
+    numbers of populate workers.
+
+    latency is added to each file read, to simulate reading files over a network.
+    """
+    import tempfile
+    from PIL import Image
+
+    class SlowLibrary(Library):
+        @classmethod
+        def _create_file_record(cls, path):
+            time.sleep(latency)
+            return super()._create_file_record(path)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        folder = temp_dir / 'images'
+        folder.mkdir()
+        for idx in range(count):
+            Image.new('RGB', (64, 48)).save(folder / f'image {idx}.jpg')
+
+        for worker_count in workers:
+            data_dir = temp_dir / f'data-{worker_count}'
+            data_dir.mkdir()
+
+            library = SlowLibrary(data_dir)
+            library.mount(folder, 'images', populate_workers=worker_count)
+
+            def first_page(results):
+                start = time.time()
+                page = next(results)
+                assert len(page) == batch_size, len(page)
+                return time.time() - start
+
+            list_time = await asyncio.to_thread(first_page, library.list([open_path(folder)], batch_size=batch_size))
+
+            # Add placeholder entries for the search, like quick_refresh does for bookmarks, then
+            # search them.  Clear the database first, so these are cold too.
+            library.db.delete_recursively([str(folder)])
+            placeholders = [library._get_placeholder_entry(child) for child in open_path(folder).scandir()]
+            library.db.add_records(placeholders)
+            search = library.search(paths=[open_path(folder)], use_windows_search=False, batch_size=batch_size)
+            search_time = await asyncio.to_thread(first_page, search)
+
+            log.info(f'{worker_count} workers: list {list_time*1000:.0f}ms, search {search_time*1000:.0f}ms')
+
+            await library.unmount('images')
+
+async def test_list_benchmark(count=5000, batch_size=50):
+    """
+    Measure listing a cold folder, which isn't in the database yet, and a warm folder
+    which is fully cached.
+    """
+    import tempfile
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        folder = temp_dir / 'images'
+        folder.mkdir()
+        for idx in range(count):
+            Image.new('RGB', (64, 48)).save(folder / f'image {idx}.jpg')
+
+        library = Library(temp_dir)
+        library.mount(folder, 'images')
+
+        def list_folder():
+            start = time.time()
+            first_page = None
+            for page in library.list([open_path(folder)], batch_size=batch_size):
+                if first_page is None:
+                    first_page = time.time() - start
+            return first_page, time.time() - start
+
+        def get_entries_separately():
+            # Look up each file with its own query, like list did before it read the directory
+            # with a single query.
+            start = time.time()
+            for child in open_path(folder).scandir():
+                library._get_entry(child)
+            return time.time() - start
+
+        first_page, total = await asyncio.to_thread(list_folder)
+        log.info(f'Cold folder: first page {first_page*1000:.0f}ms, {count} files {total*1000:.0f}ms')
+
+        first_page, total = await asyncio.to_thread(list_folder)
+        log.info(f'Warm folder: first page {first_page*1000:.0f}ms, {count} files {total*1000:.0f}ms')
+
+        total = await asyncio.to_thread(get_entries_separately)
+        log.info(f'Warm folder with a query per file: {count} files {total*1000:.0f}ms')
+
+        await library.unmount('images')
+
+async def test_bookmark_batch_benchmark(count=5000, directories=50):
+    """
+    Measure tagging files spread across directories one at a time with bookmark_edit,
+    and all at once with bookmark_batch.
+    """
+    import tempfile
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        folder = temp_dir / 'images'
+        paths = [folder / f'dir{idx % directories}' / f'image {idx}.jpg' for idx in range(count)]
+        for path in paths:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            Image.new('RGB', (64, 48)).save(path)
+
+        library = Library(temp_dir)
+        library.mount(folder, 'images')
+
+        # Add the files to the index first, so we're only measuring the bookmark edits.
+        entries = await asyncio.to_thread(lambda: [library.get(open_path(path)) for path in paths])
+
+        def edit_separately():
+            start = time.time()
+            for entry in entries:
+                library.bookmark_edit(entry, tags='tag1')
+            return time.time() - start
+
+        def edit_batch():
+            start = time.time()
+            results = library.bookmark_batch([{
+                'path': path,
+                'action': 'add',
+                'add_tags': ['tag2'],
+            } for path in paths])
+            assert all(result['bookmark_tags'] == 'tag1 tag2' for result in results)
+            return time.time() - start
+
+        total = await asyncio.to_thread(edit_separately)
+        log.info(f'Tagging {count} files in {directories} directories separately: {total*1000:.0f}ms')
+
+        total = await asyncio.to_thread(edit_batch)
+        log.info(f'Tagging {count} files in {directories} directories in a batch: {total*1000:.0f}ms')
+
+        assert library.get_all_bookmark_tags() == { 'tag1': count, 'tag2': count, '': 0 }
+
+        def rename():
+            start = time.time()
+            results = library.batch_rename_tag('tag2', 'tag3')
+            assert len(results) == count and all(result['tags'] == 'tag1 tag3' for result in results)
+            return time.time() - start
+
+        total = await asyncio.to_thread(rename)
+        log.info(f'Renaming a tag on {count} files in {directories} directories: {total*1000:.0f}ms')
+
+        assert library.get_all_bookmark_tags() == { 'tag1': count, 'tag3': count, '': 0 }
+        assert metadata_storage.load_file_metadata(open_path(paths[0]))['bookmark_tags'] == 'tag1 tag3'
+
+        await library.unmount('images')
+
+async def test_bookmark_batch_populates():
+    """
+    Check that bookmark_batch caches the current dimensions of files that are unpopulated
+    or out of date in the index.
+    """
+    import tempfile
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        folder = temp_dir / 'images'
+        folder.mkdir()
+        unpopulated_path = folder / 'unpopulated.png'
+        stale_path = folder / 'stale.png'
+        Image.new('RGB', (64, 48)).save(unpopulated_path)
+        Image.new('RGB', (64, 48)).save(stale_path)
+
+        library = Library(temp_dir)
+        library.mount(folder, 'images')
+
+        def run():
+            # Add one file as an unpopulated entry, and populate the other and then change it
+            # on disk.
+            library._get_entry(open_path(unpopulated_path), populate=False)
+            library.get(open_path(stale_path))
+            Image.new('RGB', (32, 24)).save(stale_path)
+            mtime = stale_path.stat().st_mtime + 10
+            os.utime(stale_path, (mtime, mtime))
+
+            results = library.bookmark_batch([{
+                'path': path,
+                'action': 'add',
+                'tags': 'tag',
+            } for path in (unpopulated_path, stale_path)])
+            assert [(result['width'], result['height']) for result in results] == [(64, 48), (32, 24)]
+
+            for path, size in ((unpopulated_path, (64, 48)), (stale_path, (32, 24))):
+                file_metadata = metadata_storage.load_file_metadata(open_path(path))
+                assert (file_metadata['width'], file_metadata['height']) == size, file_metadata
+                assert file_metadata['bookmark_tags'] == 'tag'
+
+        await asyncio.to_thread(run)
+        await library.unmount('images')
+
+async def test_natural_sort_benchmark(count=100000, batch_size=50):
+    """
+    Measure natural sorting a large folder, and a natural sorted search with a large
+    number of results, which can now be sorted by the index.
+    """
+    import natsort, tempfile
+
+    # The natural sort key before keys were stored in the index.
+    old_natsort_key = natsort.natsort_keygen(alg=natsort.IGNORECASE)
+    def old_key(entry):
+        return (not entry.is_dir(), *old_natsort_key(Path(entry.name).stem))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        folder = temp_dir / 'images'
+        folder.mkdir()
+        for idx in range(count):
+            (folder / f'image {idx % 1000} #{idx // 1000}.jpg').touch()
+
+        entries = list(os.scandir(folder))
+        new_key = sort_orders['natural']['fs']
+        for name, key in (('tuple key', old_key), ('string key', new_key)):
+            start = time.time()
+            sorted(entries, key=key)
+            log.info(f'Folder sort, {name}: {count} files {(time.time() - start)*1000:.0f}ms')
+
+        # Add the files to an index and search for all of them.
+        db = FileIndex(temp_dir / 'index.sqlite')
+        await asyncio.to_thread(db.add_records, [{
+            'populated': True,
+            'path': entry.path,
+            'parent': str(folder),
+            'path_lowercase': entry.path.lower(),
+            'basename_if_directory_lowercase': None,
+            'is_directory': False,
+            'mtime': 10,
+            'ctime': 10,
+            'filesystem_mtime': 10,
+            'tags': '',
+            'title': '',
+            'comment': '',
+            'mime_type': 'image/jpeg',
+            'author': '',
+        } for entry in entries])
+
+        def search_sorted_in_python():
+            # Read every result and sort them, which is what a natural search would need
+            # to do without the index.
+            start = time.time()
+            results = list(db.search(paths=[str(folder)]))
+            results.sort(key=lambda entry: (old_natsort_key(Path(entry['path']).stem), entry['path_lowercase']))
+            return time.time() - start
+
+        def search_sorted_by_index():
+            order = _get_sort('natural')['index']
+            start = time.time()
+            first_page = None
+            for idx, entry in enumerate(db.search(paths=[str(folder)], order=order)):
+                if idx == batch_size:
+                    first_page = time.time() - start
+            return first_page, time.time() - start
+
+        total = await asyncio.to_thread(search_sorted_in_python)
+        log.info(f'Search sorted in Python: {count} results {total*1000:.0f}ms')
+
+        first_page, total = await asyncio.to_thread(search_sorted_by_index)
+        log.info(f'Search sorted by the index: first page {first_page*1000:.0f}ms, {count} results {total*1000:.0f}ms')
+
+async def test_shuffle_benchmark(count=500000, batch_size=50):
+    """
+    Compare shuffling a large search by reading every result and shuffling them to a seeded
+    shuffle read from the index, for the first page and for later pages resumed from a cursor.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        folder = temp_dir / 'images'
+
+        # The files don't need to exist, since we don't verify them.
+        library = Library(temp_dir)
+        await asyncio.to_thread(library.db.add_records, [{
+            'populated': True,
+            'path': str(folder / f'dir{idx // 1000}' / f'image {idx}.jpg'),
+            'parent': str(folder / f'dir{idx // 1000}'),
+            'path_lowercase': str(folder / f'dir{idx // 1000}' / f'image {idx}.jpg').lower(),
+            'basename_if_directory_lowercase': None,
+            'is_directory': False,
+            'mtime': 10,
+            'ctime': 10,
+            'filesystem_mtime': 10,
+            'tags': '',
+            'title': '',
+            'comment': '',
+            'mime_type': 'image/jpeg',
+            'author': '',
+        } for idx in range(count)])
+
+        def shuffle_in_python():
+            # Read every result and shuffle them, which is what shuffled searches did before
+            # they could be read from the index.  Every page needs to do this again.
+            start = time.time()
+            results = list(library.db.search(paths=[str(folder)]))
+            random.shuffle(results)
+            return time.time() - start
+
+        def shuffle_from_index(pages):
+            # Read the first page, then resume from a cursor for each page after it, like
+            # paging through /api/list.
+            times = []
+            after = None
+            for _ in range(pages):
+                start = time.time()
+                search = library.search(paths=[open_path(folder)], sort_order='shuffle:1', use_windows_search=False,
+                    verify_files=False, batch_size=batch_size, after=after)
+                results = next(search)
+                search.close()
+                times.append(time.time() - start)
+                after = library.get_cursor(results[-1], 'shuffle:1')
+            return times
+
+        total = await asyncio.to_thread(shuffle_in_python)
+        log.info(f'Shuffled in Python: {count} results {total*1000:.0f}ms per page')
+
+        times = await asyncio.to_thread(shuffle_from_index, 10)
+        log.info(f'Shuffled by the index: first page {times[0]*1000:.0f}ms, later pages {sum(times[1:])/len(times[1:])*1000:.0f}ms')
+
+async def test_refresh_benchmark(directories=100000, changed=10):
+    """
+    Measure refreshing a large tree of directories the first time, again with no changes,
+    again with a few changed directories, and with a full refresh that lists everything.
+    For the first refresh, also measure how long the event loop is blocked.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        folder = temp_dir / 'images'
+
+        # 100 directories with the rest spread across them, and a file in every tenth one.
+        paths = [folder / f'dir{idx % 100}' / f'dir{idx}' for idx in range(directories - 100)]
+        for idx, path in enumerate(paths):
+            path.mkdir(parents=True)
+            if idx % 10 == 0:
+                (path / 'image.jpg').touch()
+
+        # Set directory mtimes to the past, so refresh trusts them.
+        def set_mtimes(paths, mtime):
+            for path in paths:
+                os.utime(path, (mtime, mtime))
+        set_mtimes([folder, *folder.iterdir(), *paths], 1000000000)
+
+        library = Library(temp_dir)
+        library.mount(folder, 'images')
+
+        async def refresh(**kwargs):
+            start = time.time()
+            report = await library.refresh(**kwargs)
+            return time.time() - start, report
+
+        # Measure how long the event loop is blocked while refreshing, which delays every
+        # request.
+        longest_stall = 0
+        async def measure_stalls():
+            nonlocal longest_stall
+            while True:
+                start = time.time()
+                await asyncio.sleep(0.01)
+                longest_stall = max(longest_stall, time.time() - start - 0.01)
+
+        stall_task = asyncio.create_task(measure_stalls())
+        total, report = await refresh()
+        stall_task.cancel()
+        log.info(f'First refresh: {report["scanned"]} directories listed in {total*1000:.0f}ms, event loop blocked for up to {longest_stall*1000:.0f}ms')
+
+        total, report = await refresh()
+        log.info(f'No changes: {report["skipped"]} directories skipped in {total*1000:.0f}ms')
+
+        for path in paths[:changed]:
+            (path / 'new image.jpg').touch()
+        set_mtimes(paths[:changed], 1000000001)
+        total, report = await refresh()
+        log.info(f'{len(report["changed"])} directories changed: {report["scanned"]} listed in {total*1000:.0f}ms')
+
+        total, report = await refresh(full=True)
+        log.info(f'Full refresh: {report["scanned"]} directories listed in {total*1000:.0f}ms')
+
+        await library.unmount('images')
+
+async def test_quick_refresh_benchmark(count=200000, directories=2000, bookmarked=10):
+    """
+    Measure starting up with a library of count files, with bookmarked files in each of
+    directories directories: the first start, restarting with no changes, and restarting
+    without the saved metadata file states, which imports every metadata file again.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        folder = temp_dir / 'images'
+
+        for dir_idx in range(directories):
+            path = folder / f'dir{dir_idx}'
+            path.mkdir(parents=True)
+            files = [f'image{idx}.jpg' for idx in range(count // directories)]
+            for filename in files:
+                (path / filename).touch()
+
+            metadata_storage.save_directory_metadata(open_path(path), {
+                filename: { 'bookmarked': True, 'bookmark_tags': 'tag1' }
+                for filename in files[:bookmarked]
+            })
+
+        async def start():
+            # Open the library from scratch, like the server does on startup.
+            library = Library(temp_dir)
+            library.mount(folder, 'images')
+            start = time.time()
+            await library.quick_refresh()
+            total = time.time() - start
+            assert library.get_all_bookmark_tags() == { 'tag1': directories * bookmarked, '': 0 }
+            await library.unmount('images')
+            return library, total
+
+        library, total = await start()
+        log.info(f'First start: {count} files {total*1000:.0f}ms')
+
+        library, total = await start()
+        log.info(f'Restart with no changes: {total*1000:.0f}ms')
+
+        with library.db.connect(write=True) as conn:
+            conn.execute(f'DELETE FROM {library.db.schema}.metadata_files')
+        library, total = await start()
+        log.info(f'Restart without metadata file states: {total*1000:.0f}ms')
+
 if __name__ == '__main__':
     asyncio.run(test())
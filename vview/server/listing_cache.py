@@ -0,0 +1,132 @@
+# The listing cache stores filtered, sorted directory listings for Library.list and
+# Library.list_ids.
+#
+# Listing a directory runs scandir, filters out ignored files and sorts the result, which
+# can take seconds for large directories on network shares.  Most of the time nothing has
+# changed since the last time the directory was listed, so we keep the result.
+#
+# Listings are stored with the mtime of the directories they came from, and are only used
+# if the directory mtime still matches.  Adding, removing or renaming a file changes the
+# directory's mtime, but modifying a file doesn't, so listings only hold names and not
+# anything that can change without changing the listing.  The change monitor also
+# invalidates listings directly, in case mtimes aren't reliable, such as on some network
+# shares.
+#
+# The cache is limited to max_size bytes of listings, estimated with sys.getsizeof, and
+# the least recently used listings are evicted when it fills up.
+import collections, logging, os, sys, threading
+
+log = logging.getLogger(__name__)
+
+class ListingCache:
+    def __init__(self, *, max_size=64*1024*1024):
+        """
+        max_size is the approximate number of bytes of listings to keep.
+        """
+        self.max_size = max_size
+
+        # (paths, sort_order) -> (mtimes, listing, size), in LRU order.  This is protected
+        # by lock, since listings are read from API threads.
+        self.lock = threading.Lock()
+        self.listings = collections.OrderedDict()
+        self.size = 0
+
+        # Hit and miss counters.  These are only for diagnostics.
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def _make_key(cls, paths, sort_order):
+        return tuple(os.fspath(path) for path in paths), sort_order
+
+    @classmethod
+    def _get_size(cls, listing):
+        """
+        Estimate the memory used by a listing.  This is a list of tuples, and we count the
+        list, the tuples and the strings in them.  Other values are assumed to be shared.
+        """
+        size = sys.getsizeof(listing)
+        for item in listing:
+            size += sys.getsizeof(item)
+            for value in item:
+                if isinstance(value, str):
+                    size += sys.getsizeof(value)
+        return size
+
+    def get(self, paths, sort_order, mtimes):
+        """
+        Return the cached listing for paths with the given sort order, or None if we
+        don't have one or the directories have changed since it was cached.
+
+        mtimes is a list of the current mtimes of each path.
+        """
+        key = self._make_key(paths, sort_order)
+        with self.lock:
+            cached = self.listings.get(key)
+            if cached is None or cached[0] != tuple(mtimes):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.listings.move_to_end(key)
+            return cached[1]
+
+    def put(self, paths, sort_order, mtimes, listing):
+        """
+        Store a listing for paths with the given sort order.  mtimes is a list of the mtimes
+        of each path when the listing was read.  This must be read before listing the directory,
+        so a change during the scan causes the listing to be discarded.
+        """
+        key = self._make_key(paths, sort_order)
+        size = self._get_size(listing)
+
+        # Don't cache listings that would take up most of the cache on their own.
+        if size > self.max_size / 2:
+            return
+
+        with self.lock:
+            old = self.listings.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+
+            self.listings[key] = (tuple(mtimes), listing, size)
+            self.size += size
+
+            # Evict the least recently used listings until we're below the size limit.
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self.listings.popitem(last=False)
+                self.size -= evicted_size
+
+    def invalidate(self, path):
+        """
+        Discard any listings that include the directory path.
+        """
+        path = os.fspath(path)
+        with self.lock:
+            for key in list(self.listings.keys()):
+                if path in key[0]:
+                    _, _, size = self.listings.pop(key)
+                    self.size -= size
+
+    def clear(self):
+        """
+        Discard all listings.
+        """
+        with self.lock:
+            self.listings.clear()
+            self.size = 0
+
+    def get_stats(self):
+        """
+        Return a dictionary of cache statistics.
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / requests) if requests else 0,
+                'listings': len(self.listings),
+                'size': self.size,
+                'max_size': self.max_size,
+            }
@@ -0,0 +1,301 @@
+# Database maintenance that runs while the server is idle.
+#
+# Periodically, once no requests or background tasks have run for idle_time, this:
+#
+# - updates the query planner's statistics for each database with ANALYZE,
+# - checkpoints and truncates WAL files that have grown past wal_checkpoint_size,
+# - checks the bookmark tag counts against a full count, and
+# - sweeps the file index and signature database for entries whose files no longer exist.
+# Searches remove entries for deleted files when they come across them, but files nobody
+# searches for stay in the database forever otherwise.
+#
+# Sweeps are rate limited to sweep_rate files per second and stop when the server becomes
+# busy.  The next run continues where the last one left off.  Maintenance is interrupted
+# as soon as a request arrives, and the work that was done is still reported.
+import asyncio, logging, threading, time
+from ..util.paths import open_path
+from ..util.threaded_tasks import AsyncTask
+
+log = logging.getLogger(__name__)
+
+class Maintenance:
+    def __init__(self, server, *,
+        # How often to run maintenance, in seconds.
+        interval=24*60*60,
+
+        # How long the server needs to be idle before maintenance runs, in seconds.
+        idle_time=5*60,
+
+        # Checkpoint WAL files that are at least this many bytes.
+        wal_checkpoint_size=64*1024*1024,
+
+        # The number of files per second to check while sweeping, and the number to check
+        # at once.
+        sweep_rate=1000,
+        sweep_batch_size=200,
+    ):
+        self.server = server
+        self.interval = interval
+        self.idle_time = idle_time
+        self.wal_checkpoint_size = wal_checkpoint_size
+        self.sweep_rate = sweep_rate
+        self.sweep_batch_size = sweep_batch_size
+
+        # The summary of the last maintenance run, or None if it hasn't run yet.
+        self.last_summary = None
+        self.last_run_at = 0
+        self.running = False
+
+        # Where each sweep will continue from.
+        self.sweep_positions = { 'files': 0, 'signatures': 0 }
+
+        # This is set to run maintenance immediately, without waiting for the server to be
+        # idle.
+        self._run_now = asyncio.Event()
+
+    def is_idle(self):
+        """
+        Return true if no requests or background tasks have run for idle_time.
+        """
+        api_server = self.server.api_server
+        if api_server.active_requests:
+            return False
+
+        if time.time() - api_server.last_request_at < self.idle_time:
+            return False
+
+        return not AsyncTask.get_running_tasks()
+
+    def run_now(self):
+        """
+        Run maintenance as soon as possible, even if the server isn't idle.
+        """
+        self._run_now.set()
+
+    def get_status(self):
+        return {
+            'running': self.running,
+            'last_run': self.last_summary,
+            'next_run_at': self.last_run_at + self.interval,
+        }
+
+    async def run(self):
+        """
+        Run maintenance periodically while the server is idle.  This runs until cancelled.
+        """
+        while True:
+            # Wake up periodically to check if we're idle, or immediately if run_now is called.
+            try:
+                await asyncio.wait_for(self._run_now.wait(), 10)
+            except asyncio.TimeoutError:
+                pass
+
+            forced = self._run_now.is_set()
+            self._run_now.clear()
+            if not forced and (time.time() - self.last_run_at < self.interval or not self.is_idle()):
+                continue
+
+            # If we're forced to run, don't stop for requests.
+            cancel = threading.Event()
+            should_stop = (lambda: cancel.is_set()) if forced else (lambda: cancel.is_set() or not self.is_idle())
+
+            self.running = True
+            try:
+                self.last_summary = await asyncio.to_thread(self.run_once, should_stop=should_stop)
+            except asyncio.CancelledError:
+                cancel.set()
+                raise
+            finally:
+                self.running = False
+
+            # If we were interrupted, try again the next time we're idle.
+            if not self.last_summary['interrupted']:
+                self.last_run_at = time.time()
+
+    def run_once(self, *, should_stop=lambda: False):
+        """
+        Run maintenance once, returning a summary of what was done.  should_stop is called
+        between steps, and if it returns true, maintenance stops early.
+        """
+        started_at = time.time()
+        log.info('Running database maintenance')
+
+        summary = {
+            'started_at': started_at,
+            'interrupted': False,
+            'databases': {},
+            'bookmark_tag_counts': None,
+            'sweeps': {},
+        }
+
+        databases = [self.server.library.db, self.server.library.search_index, self.server.thumbnail_cache, self.server.sig_db]
+        for db in databases:
+            if should_stop():
+                summary['interrupted'] = True
+                break
+
+            try:
+                summary['databases'][db.schema] = {
+                    'optimize': db.optimize(),
+                    'checkpoint': db.checkpoint(min_wal_size=self.wal_checkpoint_size),
+                }
+            except Exception as e:
+                log.exception(f'Error running maintenance on {db.schema}')
+                summary['databases'][db.schema] = { 'error': str(e) }
+
+        # Check the bookmark tag counts against a full count, in case they've drifted.
+        if not summary['interrupted']:
+            try:
+                summary['bookmark_tag_counts'] = self.server.library.db.check_bookmark_tag_counts(fix=True)
+            except Exception as e:
+                log.exception('Error checking bookmark tag counts')
+                summary['bookmark_tag_counts'] = { 'error': str(e) }
+
+        sweeps = {
+            'files': self._sweep_files,
+            'signatures': self._sweep_signatures,
+        }
+        for name, sweep_batch in sweeps.items():
+            if summary['interrupted']:
+                break
+
+            result = summary['sweeps'][name] = self._sweep(name, sweep_batch, should_stop=should_stop)
+            summary['interrupted'] = result['interrupted']
+
+        summary['time'] = time.time() - started_at
+        self._log_summary(summary)
+        return summary
+
+    def _sweep(self, name, sweep_batch, *, should_stop):
+        """
+        Run sweep_batch repeatedly, continuing from the last position for this sweep, until
+        it's complete or should_stop returns true.
+        """
+        result = {
+            'checked': 0,
+            'removed': 0,
+            'complete': False,
+            'interrupted': False,
+        }
+
+        while True:
+            if should_stop():
+                result['interrupted'] = True
+                break
+
+            started_at = time.time()
+            try:
+                last_id, checked, removed = sweep_batch(self.sweep_positions[name])
+            except Exception as e:
+                log.exception(f'Error sweeping {name}')
+                result['error'] = str(e)
+                break
+
+            result['checked'] += checked
+            result['removed'] += removed
+
+            if last_id is None:
+                # We've reached the end.  Start from the beginning next time.
+                self.sweep_positions[name] = 0
+                result['complete'] = True
+                break
+
+            self.sweep_positions[name] = last_id
+
+            # Wait long enough to stay under sweep_rate.
+            delay = checked / self.sweep_rate - (time.time() - started_at)
+            if delay > 0:
+                time.sleep(delay)
+
+        return result
+
+    def _sweep_files(self, after_id):
+        return self.server.library.sweep_missing_files(after_id=after_id, limit=self.sweep_batch_size)
+
+    def _sweep_signatures(self, after_id):
+        sig_db = self.server.sig_db
+        rows = sig_db.get_paths_after(after_id, self.sweep_batch_size)
+        if not rows:
+            return None, 0, 0
+
+        # Like sweep_missing_files, only remove signatures for files in mounts that are
+        # available.  Signatures are expensive to recreate, so we don't want to discard
+        # them because a drive is disconnected.
+        library = self.server.library
+        available_mounts = {name for name, mount_path in library.mounts.items() if mount_path.filesystem_path.exists()}
+
+        missing = []
+        for sig_id, path in rows:
+            path = open_path(path)
+            if library.get_mount_for_path(path) in available_mounts and not path.exists():
+                missing.append(sig_id)
+
+        if missing:
+            sig_db.delete_signatures(missing)
+
+        return rows[-1][0], len(rows), len(missing)
+
+    @classmethod
+    def _log_summary(cls, summary):
+        lines = [f'Database maintenance finished in {summary["time"]:.1f}s' + (' (interrupted)' if summary['interrupted'] else '')]
+        for schema, result in summary['databases'].items():
+            if 'error' in result:
+                lines.append(f'  {schema}: error: {result["error"]}')
+                continue
+
+            optimize = result['optimize']
+            checkpoint = result['checkpoint']
+            line = f'  {schema}: analyzed in {optimize["time"]*1000:.0f}ms, {optimize["pages"]} pages ({optimize["free_pages"]} free)'
+            if checkpoint['checkpointed']:
+                line += f', checkpointed {checkpoint["wal_size"] // 1024}KB WAL'
+            lines.append(line)
+
+        if summary['bookmark_tag_counts']:
+            lines.append(f'  bookmark tag counts didn\'t match: {summary["bookmark_tag_counts"]}')
+
+        for name, result in summary['sweeps'].items():
+            line = f'  {name} sweep: checked {result["checked"]}, removed {result["removed"]}'
+            if result['complete']:
+                line += ', complete'
+            lines.append(line)
+
+        log.info('\n'.join(lines))
+
+async def test_idle():
+    """
+    Check that an open WebSockets connection doesn't keep the server from being idle, and
+    that other requests do.
+    """
+    import types
+    from aiohttp.test_utils import make_mocked_request
+    from .api_server import APIServer
+
+    api_server = APIServer()
+    maintenance = Maintenance(types.SimpleNamespace(api_server=api_server), idle_time=0)
+
+    async def start_request(path):
+        # Run a request that stays open until finish is set.
+        finish = asyncio.Event()
+        async def handler(request):
+            await finish.wait()
+
+        task = asyncio.create_task(api_server.register_request_middleware(make_mocked_request('GET', path), handler))
+        await asyncio.sleep(0)
+        return finish, task
+
+    websocket_finish, websocket_task = await start_request('/ws')
+    assert maintenance.is_idle()
+
+    api_finish, api_task = await start_request('/api/info')
+    assert not maintenance.is_idle()
+
+    api_finish.set()
+    await api_task
+    assert maintenance.is_idle()
+
+    websocket_finish.set()
+    await websocket_task
+    assert not api_server.running_requests
+
+if __name__ == '__main__':
+    asyncio.run(test_idle())
@@ -1,4 +1,4 @@
-import copy, json, os, threading, logging
+import collections, json, os, sys, threading, logging
 from contextlib import contextmanager
 from ..util import win32
 from ..util.paths import open_path
@@ -8,20 +8,164 @@ log = logging.getLogger(__name__)
 
 metadata_filename = '.vview.txt'
 
-# A mapping from metadata filenames to their contents.
-#
-# Note that we always deep copy these objects before returning them to callers.
-_metadata_cache = {}
+class _FrozenDict(dict):
+    """
+    A read-only dictionary for cached metadata.
+
+    This is a dict, so it can be serialized with json.dumps like the original data,
+    but it can't be modified, so it can be returned from the cache without copying it.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Cached metadata is read-only')
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+def _freeze(value):
+    """
+    Return a read-only copy of metadata loaded from JSON.  Dictionaries become _FrozenDicts
+    and lists become tuples.
+    """
+    if isinstance(value, dict):
+        return _FrozenDict((key, _freeze(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    else:
+        return value
+
+def _thaw(value):
+    """
+    Return a modifiable copy of metadata returned by _freeze.
+    """
+    if isinstance(value, dict):
+        return { key: _thaw(item) for key, item in value.items() }
+    elif isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    else:
+        return value
+
+def _get_size(value):
+    """
+    Estimate the memory used by metadata, counting containers and strings.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sys.getsizeof(key) + _get_size(item)
+    elif isinstance(value, tuple):
+        for item in value:
+            size += _get_size(item)
+    return size
+
+class _MetadataCache:
+    """
+    An LRU cache of metadata files, from their filenames to their frozen contents.
+
+    Entries are stored with the mtime and size of the file, and are only used if the file
+    still matches, so changes made outside of the app are picked up.  Missing files are
+    cached as empty.  This is only accessed with _metadata_lock held.
+    """
+    def __init__(self, *, max_size=32*1024*1024):
+        self.max_size = max_size
+
+        # filename -> ((mtime, size), data, memory size), in LRU order.
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        # Hit and miss counters.  These are only for diagnostics.
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def get_file_version(cls, filename):
+        """
+        Return the version of a metadata file to store with its cache entry, or None if it
+        doesn't exist.
+        """
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, filename, version):
+        """
+        Return the cached data for filename, or None if we don't have it or the file
+        doesn't match version anymore.
+        """
+        entry = self.entries.get(filename)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(filename)
+        return entry[1]
+
+    def put(self, filename, version, data):
+        """
+        Cache data for filename, which must be frozen.
+        """
+        self.discard(filename)
+
+        size = _get_size(data) + sys.getsizeof(filename)
+        self.entries[filename] = (version, data, size)
+        self.size += size
+
+        # Evict the least recently used entries until we're below the size limit.  Always
+        # keep the entry we just added.
+        while self.size > self.max_size and len(self.entries) > 1:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def discard(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def get_stats(self):
+        """
+        Return a dictionary of cache statistics.
+        """
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / requests) if requests else 0,
+            'entries': len(self.entries),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
+
+_metadata_cache = _MetadataCache()
 
 # This is held while accessing _metadata_cache or doing any operations on
 # metadata files.
 _metadata_lock = threading.RLock()
 
-def load_directory_metadata(directory_path, return_copy=True):
+def set_cache_size(max_size):
+    """
+    Set the approximate number of bytes of metadata to cache.
+    """
+    with _metadata_lock:
+        _metadata_cache.max_size = max_size
+
+def get_cache_stats():
+    """
+    Return statistics for the metadata cache.
+    """
+    with _metadata_lock:
+        return _metadata_cache.get_stats()
+
+def load_directory_metadata(directory_path, return_copy=False):
     """
     Get stored metadata for files in path.  This currently only stores bookmarks.
     If no metadata is available, return an empty dictionary.
 
+    The result is read-only and shared with the cache.  If return_copy is true, return
+    a copy that can be modified instead.
+
     This is a hidden file in the directory which stores metadata for all files
     in the directory, as well as the directory itself.  This has a bunch of
     advantages over putting the data in each file:
@@ -40,37 +184,44 @@ def load_directory_metadata(directory_path, return_copy=True):
     with _metadata_lock:
         return _load_directory_metadata_locked(directory_path, return_copy=return_copy)
 
-def _load_directory_metadata_locked(directory_path, *, return_copy=True):
-    try:
-        this_metadata_filename = os.fspath(directory_path / metadata_filename)
-        result = _metadata_cache.get(this_metadata_filename)
-        if result is not None:
-            if return_copy:
-                result = copy.deepcopy(result)
-            return result
+def _load_directory_metadata_locked(directory_path, *, return_copy=False):
+    result = _read_directory_metadata_locked(directory_path)
+    if return_copy:
+        result = _thaw(result)
+    return result
+
+def _read_directory_metadata_locked(directory_path):
+    """
+    Return the frozen metadata for directory_path, reading it if it isn't cached or has
+    changed.
+    """
+    this_metadata_filename = os.fspath(directory_path / metadata_filename)
+    version = _metadata_cache.get_file_version(this_metadata_filename)
+    result = _metadata_cache.get(this_metadata_filename, version)
+    if result is not None:
+        return result
 
+    result = _FrozenDict()
+    try:
         with open(this_metadata_filename, 'rt', encoding='utf-8') as f:
             data = f.read()
             try:
-                result = json.loads(data)
+                data = json.loads(data)
             except ValueError as e:
                 log.warn('Metadata file %s is corrupt: %s' % (this_metadata_filename, str(e)))
-                result = {}
+                data = {}
 
-            result = result.get('data', { })
-            if not isinstance(result, dict):
+            data = data.get('data', { }) if isinstance(data, dict) else None
+            if not isinstance(data, dict):
                 log.warn('Metadata file %s is corrupt: data isn\'t a dictionary' % this_metadata_filename)
-                result = { }
+                data = { }
 
-            _metadata_cache[this_metadata_filename] = result
-            return result
+            result = _freeze(data)
     except FileNotFoundError:
-        _metadata_cache[this_metadata_filename] = { }
-        return { }
-    except json.decoder.JSONDecodeError as e:
-        log.warn('Error reading metadata from %s: %s' % (this_metadata_filename, e))
-        _metadata_cache[this_metadata_filename] = { }
-        return { }
+        pass
+
+    _metadata_cache.put(this_metadata_filename, version, result)
+    return result
 
 def save_directory_metadata(directory_path, data):
     with _metadata_lock:
@@ -83,9 +234,7 @@ def _save_directory_metadata_locked(directory_path, data):
     # If there's no data, delete the metadata file if it exists.
     if not data:
         this_metadata_filename.unlink(missing_ok=True)
-
-        if os.fspath(this_metadata_filename) in _metadata_cache:
-            del _metadata_cache[os.fspath(this_metadata_filename)]
+        _metadata_cache.discard(os.fspath(this_metadata_filename))
         return
 
     data = {
@@ -116,8 +265,10 @@ def _save_directory_metadata_locked(directory_path, data):
     with this_metadata_filename.open('r+t', shared=False) as f:
         win32.set_file_hidden(f, hide=True)
 
-    # Only update our cache once we've successfully written the new data.
-    _metadata_cache[os.fspath(this_metadata_filename)] = copy.deepcopy(data.get('data', { }))
+    # Only update our cache once we've successfully written the new data.  Freezing the
+    # data copies it, so the caller can keep modifying its own copy.
+    filename = os.fspath(this_metadata_filename)
+    _metadata_cache.put(filename, _metadata_cache.get_file_version(filename), _freeze(data['data']))
 
 def _directory_path_for_file(path):
     """
@@ -136,13 +287,12 @@ def _directory_path_for_file(path):
     filename = path.relative_to(directory_path)
     return directory_path, filename
 
-def load_file_metadata(path, *, return_copy=True):
+def load_file_metadata(path, *, return_copy=False):
     """
     Return metadata for the given path.
 
-    If metadata for the parent directory has already been loaded with
-    load_directory_metadata, it can be specified with directory_metadata
-    to avoid loading it repeatedly while scanning directories.
+    The result is read-only and shared with the cache.  If return_copy is true, return
+    a copy that can be modified instead.
     """
     with _metadata_lock:
         return _load_file_metadata_locked(path, return_copy=return_copy)
@@ -157,22 +307,34 @@ def load_and_lock_file_metadata(path):
     before exiting the context manager.
     """
     with _metadata_lock:
-        result = _load_file_metadata_locked(path)
+        result = _load_file_metadata_locked(path, return_copy=True)
         yield result
 
-def _load_file_metadata_locked(path, *, return_copy=True):
+@contextmanager
+def load_and_lock_files_metadata(paths):
+    """
+    Yield a dictionary of metadata for each path in paths, locking all metadata until
+    the context manager completes.
+
+    This is used for writing metadata for many files at once.  The caller should call
+    save_files_metadata before exiting the context manager.
+    """
+    with _metadata_lock:
+        yield { path: _load_file_metadata_locked(path, return_copy=True) for path in paths }
+
+def _load_file_metadata_locked(path, *, return_copy=False):
     # Do the copy here if return_copy is true instead of having load_directory_metadata
-    # do it, so we only deep copy the file we're returning and not the entire directory.
+    # do it, so we only copy the file we're returning and not the entire directory.
     directory_path, filename = _directory_path_for_file(path)
-    directory_metadata = load_directory_metadata(directory_path, return_copy=False)
+    directory_metadata = load_directory_metadata(directory_path)
 
-    result = directory_metadata.get(str(filename), {})
+    result = directory_metadata.get(str(filename), _FrozenDict())
     if not isinstance(result, dict):
         log.warn('Metadata for %s is corrupt' % path)
-        result = {}
+        result = _FrozenDict()
 
     if return_copy:
-        result = copy.deepcopy(result)
+        result = _thaw(result)
 
     return result
 
@@ -180,7 +342,7 @@ def has_file_metadata(path):
     """
     Return true if path has metadata.
     """
-    return len(load_file_metadata(path, return_copy=False)) != 0
+    return len(load_file_metadata(path)) != 0
 
 def save_file_metadata(path, data):
     with _metadata_lock:
@@ -189,8 +351,9 @@ def save_file_metadata(path, data):
 def _save_file_metadata_locked(path, data):
     directory_path, filename = _directory_path_for_file(path)
 
-    # Read the full metadata so we can replace this file.
-    directory_metadata = load_directory_metadata(directory_path)
+    # Read the full metadata so we can replace this file.  Only the top level needs to be
+    # copied, since we're only replacing this file's entry.
+    directory_metadata = dict(load_directory_metadata(directory_path))
 
     # If data is empty, remove this record.
     if not data:
@@ -201,6 +364,39 @@ def _save_file_metadata_locked(path, data):
 
     _save_directory_metadata_locked(directory_path, directory_metadata)
 
+def save_files_metadata(files):
+    """
+    Save metadata for many files, given a dictionary from paths to their metadata.
+
+    Files are grouped by the metadata file they're stored in, and each metadata file is
+    only written once.  Return a dictionary of paths that couldn't be saved and the
+    exception that prevented it.
+    """
+    with _metadata_lock:
+        # Group the files by directory.
+        directories = {}
+        for path, data in files.items():
+            directory_path, filename = _directory_path_for_file(path)
+            _, directory_files = directories.setdefault(os.fspath(directory_path), (directory_path, {}))
+            directory_files[path] = (str(filename), data)
+
+        errors = {}
+        for directory_path, directory_files in directories.values():
+            directory_metadata = dict(load_directory_metadata(directory_path))
+            for filename, data in directory_files.values():
+                if data:
+                    directory_metadata[filename] = data
+                else:
+                    directory_metadata.pop(filename, None)
+
+            try:
+                _save_directory_metadata_locked(directory_path, directory_metadata)
+            except OSError as e:
+                log.warn('Error saving metadata in %s: %s' % (directory_path, e))
+                errors.update((path, e) for path in directory_files.keys())
+
+        return errors
+
 def get_files_with_metadata(metadata_path):
     """
     Given the filename to a metadata file, return paths to the files the metadata
@@ -212,3 +408,48 @@ def get_files_with_metadata(metadata_path):
 
     return [open_path(directory_path / filename) for filename in directory_metadata.keys()]
 
+
+def test_cache_benchmark(files=5000, reads=100000):
+    """
+    Measure reading file metadata from a large metadata file as a view and as a copy,
+    and check that changes to the file made behind our back are noticed.
+    """
+    import tempfile, time
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory_path = open_path(temp_dir)
+        for idx in range(files):
+            with (directory_path / f'image{idx}.jpg').open('wb'):
+                pass
+
+        save_directory_metadata(directory_path, {
+            f'image{idx}.jpg': {
+                'bookmarked': True,
+                'bookmark_tags': 'tag1 tag2',
+                'width': 1920,
+                'height': 1080,
+                'crop': [0, 0, 100, 100],
+            } for idx in range(files)
+        })
+        paths = [directory_path / f'image{idx % files}.jpg' for idx in range(reads)]
+
+        for return_copy in (True, False):
+            start = time.time()
+            for path in paths:
+                load_file_metadata(path, return_copy=return_copy)
+            log.info(f'{reads} file reads with return_copy={return_copy}: {(time.time() - start)*1000:.0f}ms')
+
+            start = time.time()
+            for _ in range(100):
+                load_directory_metadata(directory_path, return_copy=return_copy)
+            log.info(f'100 directory reads with return_copy={return_copy}: {(time.time() - start)*1000:.0f}ms')
+
+        # Replace the file without going through save_directory_metadata.  Make sure the
+        # size changes, in case the filesystem's mtime resolution is coarse.
+        metadata_path = directory_path / metadata_filename
+        with metadata_path.open('w+t') as f:
+            json.dump({ 'data': { 'image0.jpg': { 'bookmarked': False } } }, f)
+
+        assert load_file_metadata(paths[0]) == { 'bookmarked': False }
+        assert load_file_metadata(paths[1]) == { }
+        log.info(f'Cache: {get_cache_stats()}')
@@ -8,8 +8,11 @@ from ..util import misc, win32, windows_ui
 from ..util.paths import open_path, PathBase
 from ..util.threaded_tasks import AsyncTask
 from ..database.signature_db import SignatureDB
+from ..database.thumbnail_cache import ThumbnailCache
 from .library import Library
+from . import metadata_storage
 from .api_server import APIServer
+from .maintenance import Maintenance
 
 misc.config_logging()
 log = logging.getLogger(__name__)
@@ -106,13 +109,38 @@ class Server:
         self.data_dir.mkdir()
 
         self.settings = Settings(self.data_dir / 'settings.json')
-        self.library = Library(self.data_dir)
+
+        # The thumbnail cache size is in megabytes.
+        thumbnail_cache_size = self.settings.data.get('thumbnail_cache_size', 1024)
+        self.thumbnail_cache = ThumbnailCache(self.data_dir / 'thumbnails.sqlite', max_size=thumbnail_cache_size*1024*1024)
+
+        # keyword_index can be set to "fts" to use an FTS5 index for keyword searches.  See FileIndex.
+        keyword_index = self.settings.data.get('keyword_index', 'table')
+        # The size of the directory listing cache, in megabytes.
+        listing_cache_size = self.settings.data.get('listing_cache_size', 64)
+        # The size of the sidecar metadata cache, in megabytes.
+        metadata_cache_size = self.settings.data.get('metadata_cache_size', 32)
+        metadata_storage.set_cache_size(metadata_cache_size*1024*1024)
+        # search_backend can be "windows" or "index" to override the default file search.  See Library.
+        search_backend = self.settings.data.get('search_backend')
+        self.library = Library(self.data_dir, thumbnail_cache=self.thumbnail_cache, keyword_index=keyword_index,
+            listing_cache_size=listing_cache_size*1024*1024, search_backend=search_backend)
         self.sig_db = SignatureDB(self.data_dir / 'signatures.sqlite')
 
+        # How often to run database maintenance, in hours, and how long the server needs to
+        # be idle first, in minutes.  See Maintenance.
+        maintenance_interval = self.settings.data.get('maintenance_interval', 24)
+        maintenance_idle_time = self.settings.data.get('maintenance_idle_time', 5)
+        self.maintenance = Maintenance(self, interval=maintenance_interval*60*60, idle_time=maintenance_idle_time*60)
+
         # Start the API server.
         self.api_server = APIServer()
         await self.api_server.init(self)
 
+        # Run maintenance in the background while we're idle.  This isn't an AsyncTask, since
+        # those keep the server from being considered idle.
+        self.maintenance_task = asyncio.create_task(self.maintenance.run(), name='Maintenance')
+
         # The remaining tasks can take some time, but we don't need to wait for them, so
         # we run them asynchronously.
         #
@@ -135,7 +163,7 @@ class Server:
                 log.warn('Library path isn\'t a directory: %s', str(path))
                 continue
 
-            self.library.mount(path, name)
+            self.library.mount(path, name, populate_workers=folder_info['populate_workers'])
 
         # Run a quick refresh at startup.  This can still take a few seconds for larger
         # libraries, so run this in a task to allow requests to start being handled immediately.
@@ -147,6 +175,12 @@ class Server:
 
         await self.api_server.shutdown()
 
+        self.maintenance_task.cancel()
+        try:
+            await self.maintenance_task
+        except asyncio.CancelledError:
+            pass
+
         for name in list(self.library.mounts.keys()):
             await self.library.unmount(name)
         
@@ -181,9 +215,9 @@ class Server:
 
     def run_background_task(self, func, *, name=None):
         """
-        Run a background task.
+        Run a background task, returning its AsyncTask.
         """
-        AsyncTask.run(func, name=name)
+        return AsyncTask.run(func, name=name)
 
     # Values of api_list_results can be a dictionary, in which case they're a result
     # cached from a previous call.  They can also be a function, which is called to
@@ -102,6 +102,10 @@ class Settings:
             folders.append({
                 'name': name,
                 'path': path,
+
+                # The number of files to read at once when populating results in this folder,
+                # or None to use the default.
+                'populate_workers': folder.get('populate_workers'),
             })
         return folders
     
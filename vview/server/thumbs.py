@@ -345,23 +345,43 @@ async def handle_thumb(request, mode='thumb'):
     if entry is None:
         raise aiohttp.web.HTTPNotFound()
 
-    # Generate the thumbnail in a thread.
-    filetype = misc.file_type(str(absolute_path))
-    if filetype == 'video':
-        if mode =='poster':
-            file, mime_type = await _create_video_poster(path, absolute_path, data_dir)
-            thumbnail_file = file.read_bytes()
+    # Video posters are already cached on disk by _create_video_poster, so only use the
+    # thumbnail cache for thumbs.
+    thumbnail_cache = request.app['server'].thumbnail_cache
+    use_thumbnail_cache = mode != 'poster'
+
+    # See if we have this thumbnail cached already before doing any decoding.
+    cache_key = {
+        'mode': mode,
+        'mtime': mtime,
+        'inpaint_timestamp': entry.get('inpaint_timestamp') or 0,
+    }
+    thumbnail_file = None
+    if use_thumbnail_cache:
+        thumbnail_file, mime_type = await asyncio.to_thread(thumbnail_cache.get, absolute_path, **cache_key)
+
+    if thumbnail_file is None:
+        # Generate the thumbnail in a thread.
+        filetype = misc.file_type(str(absolute_path))
+        if filetype == 'video':
+            if mode =='poster':
+                file, mime_type = await _create_video_poster(path, absolute_path, data_dir)
+                thumbnail_file = file.read_bytes()
+            else:
+                thumb_path = await _extract_video_thumbnail_frame(path, absolute_path, data_dir)
+
+                # Create the thumbnail in the same way we create image thumbs.
+                thumbnail_file, mime_type = await create_thumb(request, thumb_path)
         else:
-            thumb_path = await _extract_video_thumbnail_frame(path, absolute_path, data_dir)
+            inpaint_path = inpainting.get_inpaint_path_for_entry(entry, request.app['server'])
+            thumbnail_file, mime_type = await create_thumb(request, absolute_path, inpaint_path=inpaint_path)
 
-            # Create the thumbnail in the same way we create image thumbs.
-            thumbnail_file, mime_type = await create_thumb(request, thumb_path)
-    else:
-        inpaint_path = inpainting.get_inpaint_path_for_entry(entry, request.app['server'])
-        thumbnail_file, mime_type = await create_thumb(request, absolute_path, inpaint_path=inpaint_path)
+        if thumbnail_file is None:
+            raise aiohttp.web.HTTPNotFound()
 
-    if thumbnail_file is None:
-        raise aiohttp.web.HTTPNotFound()
+        if use_thumbnail_cache:
+            thumbnail_file = thumbnail_file.getvalue()
+            await asyncio.to_thread(thumbnail_cache.put, absolute_path, thumbnail_file, mime_type=mime_type, **cache_key)
 
     response = aiohttp.web.Response(body=thumbnail_file, headers={
         'Content-Type': mime_type,
@@ -1,5 +1,5 @@
 # Helpers that don't have dependancies on our other modules.
-import asyncio, concurrent, os, io, struct, logging, os, re, tempfile, threading, time, traceback, sys, queue, uuid
+import asyncio, concurrent, os, io, struct, logging, os, re, tempfile, threading, time, traceback, sys, queue, uuid, natsort, hashlib
 from contextlib import contextmanager
 from pathlib import Path
 from PIL import Image, ImageFile, ExifTags
@@ -608,7 +608,7 @@ class ThreadedQueue:
         self.results = queue.Queue()
         self.exception = None
         self.iterator = iterator
-        self.cancel = threading.Event()
+        self.cancelled = threading.Event()
 
         self.thread = threading.Thread(target=self._read_results)
         self.thread.start()
@@ -616,7 +616,7 @@ class ThreadedQueue:
     def _read_results(self):
         try:
             for result in self.iterator:
-                if self.cancel.is_set():
+                if self.cancelled.is_set():
                     break
 
                 if result is None:
@@ -628,6 +628,11 @@ class ThreadedQueue:
             # caller after the queue is empty.
             self.exception = e
         finally:
+            # Close the iterator here, so if we were cancelled it cleans up on this thread and
+            # not on whatever thread happens to garbage collect it.
+            if hasattr(self.iterator, 'close'):
+                self.iterator.close()
+
             self.results.put(None)
 
     def __iter__(self):
@@ -649,14 +654,15 @@ class ThreadedQueue:
 
         return result
 
-    def cancel(self):
+    def cancel(self, *, wait=True):
         """
-        Cancel the task, and block is true until the generator has stopped.
+        Cancel the task.  If wait is true, block until the generator has stopped.
 
         The iterator will receive GeneratorExit the next time it yields a value.
         """
-        self.cancel.set()
-        self._join_thread()
+        self.cancelled.set()
+        if wait:
+            self._join_thread()
 
     def _join_thread(self):
         self.thread.join()
@@ -706,6 +712,59 @@ def remove_file_extension(fn):
     """
     return re.sub(r'\.[a-z0-9]+$', '', fn, flags=re.IGNORECASE)
 
+natsort_key = natsort.natsort_keygen(alg=natsort.IGNORECASE)
+_page_number_pattern = re.compile(r'(.* #)(\d+)(.*)')
+
+def natural_sort_key(filename, is_dir, *, reverse_pages=False):
+    """
+    Return a key to sort filename naturally.
+
+    Directories sort first, and names are sorted case-insensitively with numbers sorted by
+    value, like natsort.  The extension is ignored.  This returns a string rather than a
+    tuple, so it can be stored and indexed in the database.  It sorts the same way in SQLite
+    as it does in Python.
+
+    If reverse_pages is true, reverse the order of pages within a group, for the
+    natural-reverse-pages sort:
+
+    Image 12345 #3.png
+    Image 12345 #2.png
+    Image 12345 #1.png
+    """
+    stem = os.path.splitext(filename)[0]
+
+    if reverse_pages and not is_dir:
+        # Look for "prefix #123...".  natsort doesn't handle negative numbers, so we can't just
+        # invert the page number.
+        match = _page_number_pattern.match(stem)
+        if match:
+            stem = f'{match[1]}{1000000000000000 - int(match[2])}{match[3]}'
+
+    # Join the parts of natsort's key with \x01, which sorts before any character in a
+    # filename, so shorter strings sort first.  Prefix numbers with their length, so they
+    # sort by value.
+    parts = ['0' if is_dir else '1']
+    for part in natsort_key(stem):
+        if isinstance(part, int):
+            digits = str(part)
+            part = chr(0x20 + len(digits)) + digits
+        parts.append(part)
+
+    return '\x01'.join(parts)
+
+def shuffle_key(path_lowercase, is_dir):
+    """
+    Return a key to shuffle files with, which is a hash of the path.
+
+    This is a signed 64-bit integer, so it can be stored in SQLite.  Directories are
+    negative and files are positive, so directories sort first.  See library._get_shuffle_sort.
+    """
+    digest = hashlib.blake2b(path_lowercase.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    key = int.from_bytes(digest, 'big') >> 1
+    if is_dir:
+        key -= 1 << 63
+    return key
+
 class reverse_order_str(str):
     """
     A string that sorts in inverse order.
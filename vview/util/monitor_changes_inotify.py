@@ -0,0 +1,442 @@
+# A MonitorChanges backend for Linux, using inotify.
+#
+# inotify only watches a single directory, not a tree, so we add a watch for every
+# directory in the tree and keep track of which directory each watch is for.  Directories
+# that are created or moved into the tree get new watches, and renaming a directory
+# updates the paths of the watches inside it.
+#
+# Each user can only have fs.inotify.max_user_watches watches.  If a tree has more
+# directories than that, we monitor as much of it as we can and log a warning.
+import asyncio, ctypes, ctypes.util, errno, os, struct, logging
+from pathlib import Path
+
+from .monitor_changes import FileAction, MonitorChanges
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event, not including the name that follows it:
+_inotify_event = struct.Struct('iIII')
+
+_libc = None
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        libc.inotify_rm_watch.restype = ctypes.c_int
+        _libc = libc
+
+    return _libc
+
+class MonitorChangesInotify(MonitorChanges):
+    # The events we watch for.  We use IN_CLOSE_WRITE rather than IN_MODIFY for modified
+    # files, so we get one event when a file is written and not one for every write.
+    watch_mask = \
+        IN_CLOSE_WRITE | IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+    def __init__(self, path: os.PathLike, *, buffer_size=1024*64, rename_timeout=0.25):
+        """
+        rename_timeout is how long to wait for the second half of a rename before deciding
+        that the file was moved out of the tree.
+        """
+        super().__init__(path)
+        self.buffer_size = buffer_size
+        self.rename_timeout = rename_timeout
+        self.watch_subtree = True
+        self.watch_limit_reached = False
+
+        # Watch descriptors to the directory they're watching, and back.  Paths are strings,
+        # since there may be a lot of them.
+        self.watches = {}
+        self.watch_paths = {}
+
+        self.fd = _get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd == -1:
+            self.fd = None
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    async def monitor(self, watch_subtree=True):
+        self.watch_subtree = watch_subtree
+
+        # Add watches for the tree.  This can take a while for large trees, so do it in
+        # a thread.
+        await asyncio.to_thread(self._add_watches, os.fspath(self.path))
+
+        # MOVED_FROM events waiting for the MOVED_TO event with the same cookie, which
+        # comes right after it unless the file was moved out of the tree.  These are
+        # cookie -> (path, is_dir, read_count).
+        pending_moves = {}
+        read_count = 0
+
+        while self.fd is not None:
+            try:
+                data = await self._read(timeout=self.rename_timeout if pending_moves else None)
+            except asyncio.CancelledError:
+                return
+            except OSError as e:
+                log.warn('Error monitoring %s: %s' % (self.path, e.strerror))
+                return
+
+            # If we timed out waiting for the other half of a rename, the files were moved
+            # out of the tree, so treat them as removed.
+            if data is None:
+                for path, is_dir, _ in pending_moves.values():
+                    yield self._moved_out(path, is_dir)
+                pending_moves.clear()
+                continue
+
+            read_count += 1
+            for wd, mask, cookie, name in self._parse_events(data):
+                if mask & IN_Q_OVERFLOW:
+                    # The kernel's event queue overflowed, so we've lost events.  Resync
+                    # our watches with the tree, since directories may have been created
+                    # or renamed, and tell our caller that anything may have changed.
+                    log.warn('Event queue overflowed while monitoring %s' % self.path)
+                    for path, is_dir, _ in pending_moves.values():
+                        yield self._moved_out(path, is_dir)
+                    pending_moves.clear()
+
+                    await asyncio.to_thread(self._sync_watches)
+                    yield (self.path, None), FileAction.FILE_ACTION_OVERFLOW
+                    continue
+
+                parent = self.watches.get(wd)
+                if parent is None:
+                    # This is a late event for a watch we've already removed.
+                    continue
+
+                if mask & IN_IGNORED:
+                    # The watch was removed, because the directory was deleted or we removed it.
+                    self._forget_watch(wd)
+                    continue
+
+                # We don't need IN_DELETE_SELF and IN_MOVE_SELF, since the parent directory
+                # will also tell us about it.
+                if not name:
+                    continue
+
+                path = os.path.join(parent, name)
+                is_dir = bool(mask & IN_ISDIR)
+
+                if mask & IN_MOVED_FROM:
+                    pending_moves[cookie] = (path, is_dir, read_count)
+                elif mask & IN_MOVED_TO:
+                    move = pending_moves.pop(cookie, None)
+                    if move is not None:
+                        old_path = move[0]
+                        if is_dir:
+                            self._rename_watches(old_path, path)
+                        yield (Path(path), Path(old_path)), FileAction.FILE_ACTION_RENAMED
+                    else:
+                        # This was moved in from outside of the tree.
+                        if is_dir:
+                            await asyncio.to_thread(self._add_watches, path)
+                        yield (Path(path), None), FileAction.FILE_ACTION_ADDED
+                elif mask & IN_CREATE:
+                    # Watch new directories.  Files may have been created inside it before
+                    # we added the watch, so our caller should scan it when it sees it added.
+                    if is_dir:
+                        await asyncio.to_thread(self._add_watches, path)
+                    yield (Path(path), None), FileAction.FILE_ACTION_ADDED
+                elif mask & IN_DELETE:
+                    yield (Path(path), None), FileAction.FILE_ACTION_REMOVED
+                elif mask & (IN_CLOSE_WRITE | IN_ATTRIB):
+                    yield (Path(path), None), FileAction.FILE_ACTION_MODIFIED
+
+            # The two halves of a rename are queued together, but they can be split across
+            # reads if the first one fills the buffer.  If a MOVED_FROM from an earlier read
+            # still hasn't been paired, it isn't going to be.
+            for cookie, (path, is_dir, move_read_count) in list(pending_moves.items()):
+                if move_read_count < read_count:
+                    del pending_moves[cookie]
+                    yield self._moved_out(path, is_dir)
+
+    async def _read(self, *, timeout=None):
+        """
+        Read a block of events.  Return None if timeout is set and no events arrive
+        before it.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            # close() may have been called while we were waiting.
+            fd = self.fd
+            if fd is None:
+                return b''
+
+            try:
+                return os.read(fd, self.buffer_size)
+            except BlockingIOError:
+                pass
+
+            ready = loop.create_future()
+            loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await asyncio.wait_for(ready, timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                loop.remove_reader(fd)
+
+    @classmethod
+    def _parse_events(cls, data):
+        """
+        Yield (wd, mask, cookie, name) for each event in a block read from inotify.
+        """
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+
+            # The name is null-terminated and padded.
+            name = data[offset:offset+length].split(b'\0', 1)[0]
+            offset += length
+
+            yield wd, mask, cookie, os.fsdecode(name)
+
+    def _moved_out(self, path, is_dir):
+        """
+        Handle a file or directory that was moved out of the tree, and return its event.
+        """
+        if is_dir:
+            self._remove_watches(path)
+        return (Path(path), None), FileAction.FILE_ACTION_REMOVED
+
+    def _add_watch(self, path):
+        """
+        Add a watch for a directory, and return its watch descriptor, or None if it can't
+        be watched.
+        """
+        fd = self.fd
+        if fd is None:
+            return None
+
+        wd = _get_libc().inotify_add_watch(fd, os.fsencode(path), self.watch_mask)
+        if wd == -1:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                if not self.watch_limit_reached:
+                    log.warn(f'Reached the inotify watch limit while monitoring {self.path}, so some directories '
+                        'won\'t be monitored.  Increase fs.inotify.max_user_watches to monitor more directories.')
+                self.watch_limit_reached = True
+            elif error not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES, errno.EBADF):
+                log.warn('Couldn\'t monitor %s: %s' % (path, os.strerror(error)))
+
+            return None
+
+        # If this directory was already watched under another path, the kernel gives us the
+        # same watch, so update its path.
+        old_path = self.watches.get(wd)
+        if old_path is not None and self.watch_paths.get(old_path) == wd:
+            del self.watch_paths[old_path]
+
+        self.watches[wd] = path
+        self.watch_paths[path] = wd
+        return wd
+
+    def _add_watches(self, top):
+        """
+        Watch top, and everything inside it if we're watching the whole tree.  Return the
+        set of watch descriptors for the directories we found.
+        """
+        found = set()
+        pending = [top]
+        while pending:
+            path = pending.pop()
+            wd = self._add_watch(path)
+            if wd is None:
+                # Stop if we've run out of watches.  We'll try again if we resync.
+                if self.watch_limit_reached:
+                    break
+                continue
+
+            found.add(wd)
+            if not self.watch_subtree:
+                break
+
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+            except OSError:
+                # The directory was probably removed while we were scanning it.
+                continue
+
+        return found
+
+    def _sync_watches(self):
+        """
+        Update our watches to match the tree, after we've missed events.
+
+        Adding a watch for a directory that's already watched returns the same watch, so
+        this updates the paths of directories that were renamed.  Watches that aren't in
+        the tree anymore are removed.
+        """
+        self.watch_limit_reached = False
+        found = self._add_watches(os.fspath(self.path))
+        if self.watch_limit_reached:
+            # We didn't see the whole tree, so we don't know which watches are stale.
+            return
+
+        for wd in list(self.watches.keys()):
+            if wd not in found:
+                self._remove_watch(wd)
+
+    def _rename_watches(self, old_path, new_path):
+        """
+        Update the paths of watches for a directory that was renamed within the tree, and
+        everything inside it.
+        """
+        prefix = old_path + os.path.sep
+        for wd, path in list(self.watches.items()):
+            if path == old_path:
+                renamed_path = new_path
+            elif path.startswith(prefix):
+                renamed_path = new_path + path[len(old_path):]
+            else:
+                continue
+
+            if self.watch_paths.get(path) == wd:
+                del self.watch_paths[path]
+            self.watches[wd] = renamed_path
+            self.watch_paths[renamed_path] = wd
+
+    def _remove_watches(self, top):
+        """
+        Remove watches for a directory that's left the tree, and everything inside it.
+        """
+        prefix = top + os.path.sep
+        for wd, path in list(self.watches.items()):
+            if path == top or path.startswith(prefix):
+                self._remove_watch(wd)
+
+    def _remove_watch(self, wd):
+        if self.fd is not None:
+            _get_libc().inotify_rm_watch(self.fd, wd)
+        self._forget_watch(wd)
+
+    def _forget_watch(self, wd):
+        path = self.watches.pop(wd, None)
+        if path is not None and self.watch_paths.get(path) == wd:
+            del self.watch_paths[path]
+
+    def close(self):
+        fd = getattr(self, 'fd', None)
+        if fd is None:
+            return
+
+        # Closing the inotify descriptor removes all of its watches.
+        self.fd = None
+        self.watches = {}
+        self.watch_paths = {}
+        os.close(fd)
+
+async def test():
+    """
+    Create, rename and delete files in a temporary directory, and check that we see
+    the right changes.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        (temp_dir / 'existing').mkdir()
+
+        monitor = MonitorChangesInotify(temp_dir, rename_timeout=0.1)
+        events = asyncio.Queue()
+        async def changes(path, old_path, action):
+            await events.put((action, path, old_path))
+        task = asyncio.create_task(monitor.monitor_call(changes))
+
+        # Wait for the initial watches to be added.
+        while monitor.watch_paths.get(str(temp_dir / 'existing')) is None:
+            await asyncio.sleep(0.01)
+
+        async def expect(*expected):
+            for action, path, old_path in expected:
+                event = await asyncio.wait_for(events.get(), 5)
+                assert event == (action, path, old_path), (event, (action, path, old_path))
+
+        # Files in a directory that existed when we started.
+        file = temp_dir / 'existing' / 'file.txt'
+        file.write_text('data')
+        await expect(
+            (FileAction.FILE_ACTION_ADDED, file, None),
+            (FileAction.FILE_ACTION_MODIFIED, file, None),
+        )
+
+        file.rename(file.with_name('renamed.txt'))
+        await expect((FileAction.FILE_ACTION_RENAMED, file.with_name('renamed.txt'), file))
+
+        file.with_name('renamed.txt').unlink()
+        await expect((FileAction.FILE_ACTION_REMOVED, file.with_name('renamed.txt'), None))
+
+        # A new directory is watched, and keeps being watched after it's renamed.
+        (temp_dir / 'new').mkdir()
+        await expect((FileAction.FILE_ACTION_ADDED, temp_dir / 'new', None))
+
+        (temp_dir / 'new').rename(temp_dir / 'new2')
+        await expect((FileAction.FILE_ACTION_RENAMED, temp_dir / 'new2', temp_dir / 'new'))
+
+        (temp_dir / 'new2' / 'file.txt').touch()
+        await expect(
+            (FileAction.FILE_ACTION_ADDED, temp_dir / 'new2' / 'file.txt', None),
+            (FileAction.FILE_ACTION_MODIFIED, temp_dir / 'new2' / 'file.txt', None),
+        )
+
+        # Moving a directory out of the tree is seen as removing it, and stops watching it.
+        with tempfile.TemporaryDirectory() as outside:
+            outside = Path(outside)
+            (temp_dir / 'new2').rename(outside / 'moved')
+            await expect((FileAction.FILE_ACTION_REMOVED, temp_dir / 'new2', None))
+            assert str(temp_dir / 'new2') not in monitor.watch_paths
+
+            # Moving it back in is seen as adding it.
+            (outside / 'moved').rename(temp_dir / 'moved')
+            await expect((FileAction.FILE_ACTION_ADDED, temp_dir / 'moved', None))
+            assert str(temp_dir / 'moved') in monitor.watch_paths
+
+        # Deleting a directory removes its watch.
+        (temp_dir / 'moved' / 'file.txt').unlink()
+        (temp_dir / 'moved').rmdir()
+        await expect(
+            (FileAction.FILE_ACTION_REMOVED, temp_dir / 'moved' / 'file.txt', None),
+            (FileAction.FILE_ACTION_REMOVED, temp_dir / 'moved', None),
+        )
+        while str(temp_dir / 'moved') in monitor.watch_paths:
+            await asyncio.sleep(0.01)
+
+        task.cancel()
+        await task
+        monitor.close()
+        assert events.empty(), events.get_nowait()
+
+    log.info('inotify monitor test passed')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(test())
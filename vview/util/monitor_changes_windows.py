@@ -0,0 +1,154 @@
+# A MonitorChanges backend for Windows, using ReadDirectoryChangesW.
+import asyncio, ctypes, os, logging
+from ctypes.wintypes import BYTE, DWORD
+kernel32 = ctypes.windll.kernel32
+
+log = logging.getLogger(__name__)
+
+from . import win32
+from .monitor_changes import FileAction, MonitorChanges
+
+ReadDirectoryChangesW = kernel32.ReadDirectoryChangesW
+
+FILE_NOTIFY_CHANGE_FILE_NAME = 0x00000001
+FILE_NOTIFY_CHANGE_DIR_NAME = 0x00000002
+FILE_NOTIFY_CHANGE_ATTRIBUTES = 0x00000004
+FILE_NOTIFY_CHANGE_SIZE = 0x00000008
+FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
+FILE_NOTIFY_CHANGE_LAST_ACCESS = 0x00000020
+FILE_NOTIFY_CHANGE_CREATION = 0x00000040
+FILE_NOTIFY_CHANGE_SECURITY = 0x00000100
+
+class FileNotifyInformation(ctypes.Structure):
+    _fields_ = [
+        ('NextEntryOffset', DWORD),
+        ('Action', DWORD),
+        ('FileNameLength', DWORD),
+        # ('FileName', BYTE),
+    ]
+
+class MonitorChangesWindows(MonitorChanges):
+    def __init__(self, path: os.PathLike, *, buffer_size=1024*128):
+        self.path = path
+        self.buffer_size = buffer_size
+
+        self.handle = win32.CreateFileW(
+                # \\?\ enables long filename support.
+                '\\\\?\\' + str(path),
+                win32.FILE_LIST_DIRECTORY,
+                win32.FILE_SHARE_READ|win32.FILE_SHARE_WRITE|win32.FILE_SHARE_DELETE,
+                None, # lpSecurityAttributes
+                win32.OPEN_EXISTING, # dwCreationDisposition
+                win32.FILE_FLAG_BACKUP_SEMANTICS,
+                None)
+
+        if self.handle == -1:
+            raise ctypes.WinError(ctypes.get_last_error())
+
+    async def monitor(self, watch_subtree=True):
+        # Open the directory if it's closed.  If we're called and cancelled we'll close the file
+        # handle, 
+        # If we're not monitoring, open the directory.
+        changes = \
+            FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_DIR_NAME | FILE_NOTIFY_CHANGE_ATTRIBUTES | \
+            FILE_NOTIFY_CHANGE_SIZE | FILE_NOTIFY_CHANGE_LAST_WRITE | FILE_NOTIFY_CHANGE_CREATION
+
+        # Allocate the buffer locally.  This isn't reused, so if we're cancelled and a
+        # ReadDirectoryChangesW call stays running briefly, we won't make another call
+        # on the same buffer.
+        change_buffer = (BYTE * self.buffer_size)()
+
+        while True:
+            # Run ReadDirectoryChangesW in a thread so it doesn't block the event loop.
+            try:
+                bytes_returned = await asyncio.to_thread(self._read_changes, watch_subtree, changes, change_buffer)
+            except asyncio.CancelledError:
+                # If we're cancelled, call CancelIoEx to cancel ReadDirectoryChangesW which is
+                # still running in the thread.  We should wait after doing that for it to return,
+                # but I'm not sure how to do that with asyncio.  The handle stays open and we can
+                # be called again until close() is called.
+                win32.CancelIoEx(self.handle, None)
+                return
+            except OSError as e:
+                if e.winerror == win32.ERROR_OPERATION_ABORTED:
+                    # We were aborted by a call to close().
+                    return
+
+                if e.winerror == 87:
+                    # ERROR_INVALID_FUNCTION means this path doesn't support monitoring.
+                    # The most common cause is probably that it's an SMB mount that doesn't
+                    # support it.
+                    log.warn('File monitoring not supported on volume: %s' % self.path)
+                else:
+                    log.warn('Error monitoring %s: %s' % (self.path, e.strerror))
+
+                return
+
+            # If more changes happened than fit in the buffer, ReadDirectoryChangesW succeeds
+            # but doesn't return any of them.
+            if bytes_returned.value == 0:
+                log.warn('Change buffer overflowed while monitoring %s' % self.path)
+                yield (self.path, None), FileAction.FILE_ACTION_OVERFLOW
+                continue
+
+            # Yield all results.
+            offset = 0
+            rename_old_path = None
+            while True:
+                entry = FileNotifyInformation.from_buffer(change_buffer, offset)
+
+                filename_ptr = ctypes.byref(change_buffer, offset + ctypes.sizeof(FileNotifyInformation))
+                filename = ctypes.wstring_at(filename_ptr, entry.FileNameLength // 2)
+
+                path = self.path / filename
+                action = FileAction(entry.Action)
+
+                # RENAMED_OLD_NAME and RENAMED_NEW_NAME are normally received in pairs.
+                # Pair them back up and return them as a single event.
+                if action == FileAction.FILE_ACTION_RENAMED_OLD_NAME:
+                    rename_old_path = path
+                elif action == FileAction.FILE_ACTION_RENAMED_NEW_NAME:
+                    if rename_old_path is None:
+                        log.warn('Received FILE_ACTION_RENAMED_NEW_NAME without FILE_ACTION_RENAMED_OLD_NAME')
+                    else:
+                        yield (path, rename_old_path), FileAction.FILE_ACTION_RENAMED
+                        rename_old_path = None
+                else:
+                    rename_old_path = None
+
+                    yield (path, None), FileAction(action)
+
+                # NextEntryOffset is 0 for the last item.
+                if entry.NextEntryOffset == 0:
+                    break
+
+                offset += entry.NextEntryOffset
+
+    def _read_changes(self, watch_subtree, changes, change_buffer):
+        bytes_returned = DWORD()
+        result = ReadDirectoryChangesW(
+            self.handle, # hDirectory
+            change_buffer, # lpBuffer
+            len(change_buffer), # nBufferLength
+            watch_subtree, # bWatchSubtree,
+            changes,
+            ctypes.pointer(bytes_returned), # lpBytesReturned
+            None, #  lpOverlapped
+            None, # lpCompletionRoutine
+        )
+
+        if not result:
+            raise ctypes.WinError()
+
+        return bytes_returned
+
+    def close(self):
+        if not self.handle:
+            return
+
+        # CancelIoEx will cause any running call to ReadDirectoryChangesW to return
+        # with ERROR_OPERATION_ABORTED.
+        win32.CancelIoEx(self.handle, None)
+
+        win32.CloseHandle(self.handle)
+        self.handle = None
@@ -1,4 +1,4 @@
-import asyncio, logging
+import asyncio, itertools, logging
 from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger(__name__)
@@ -18,18 +18,26 @@ class AsyncTask:
     tasks = set()
     task_executor = ThreadPoolExecutor(max_workers=4)
 
+    # AsyncTasks that are currently running, so their progress can be checked.
+    running_tasks = set()
+
+    # Each task gets an ID, so it can be referred to by the API.
+    _next_id = itertools.count(1)
+
     @classmethod
     def run(cls, task, *, name):
         """
-        Run a background task.
+        Run a background task, returning its AsyncTask.
         """
         result = cls()
         result.ran_task = False
+        result.id = next(cls._next_id)
 
-        # Start _run_main_loop_task as a task in the caller's loop.  This can be awaited or cancelled
-        # by the caller to await or cancel the threaded task.
+        # Start _run_main_loop_task as a task in the caller's loop.  The caller can await or cancel
+        # result.main_loop_task to await or cancel the threaded task.
         main_loop_task = result._run_main_loop_task(task, name=name)
         main_loop_task = asyncio.get_running_loop().create_task(main_loop_task, name=name)
+        result.main_loop_task = main_loop_task
 
         # Put the task on the task list to prevent it from being GC'd.
         cls.tasks.add(main_loop_task)
@@ -54,7 +62,7 @@ class AsyncTask:
 
         main_loop_task.add_done_callback(remove_when_done)
 
-        return main_loop_task
+        return result
 
     async def _run_main_loop_task(self, task, *, name):
         log.info(f'Running task: {name}')
@@ -72,6 +80,7 @@ class AsyncTask:
         self.task = self.task_loop.create_task(task, name=name)
 
         # Start the task.
+        self.running_tasks.add(self)
         task_loop_task = asyncio.get_running_loop().run_in_executor(self.task_executor, self._run_task)
 
         # Create a future in the main loop, and finish it when task_loop_task is finished.
@@ -95,12 +104,56 @@ class AsyncTask:
         # Clean up the task.
         log.info(f'Task {"cancelled" if self.was_cancelled else "finished"}: {self}')
 
+        self.running_tasks.discard(self)
         self.task_loop.close()
         self.task_loop = None
 
     def __str__(self):
         return f'QueuedTask({self.name})'
 
+    @property
+    def progress(self):
+        """
+        Return the last progress the task reported with set_progress, or None.
+        """
+        task = getattr(self, 'task', None)
+        return task.progress if task is not None else None
+
+    def cancel(self):
+        """
+        Ask the task to cancel.  This doesn't wait for it to finish.
+        """
+        if getattr(self, 'task', None) is not None:
+            self._cancel()
+
+    def get_status(self):
+        """
+        Return a dictionary describing this task and its progress.
+        """
+        return {
+            'id': self.id,
+            'name': self.name,
+            'progress': self.progress,
+            'cancelled': self.was_cancelled,
+        }
+
+    @classmethod
+    def get_running_tasks(cls):
+        """
+        Return a list of AsyncTasks that are currently running.
+        """
+        return list(cls.running_tasks)
+
+    @classmethod
+    def get_running_task(cls, task_id):
+        """
+        Return the running AsyncTask with the ID task_id, or None if it isn't running.
+        """
+        for task in cls.get_running_tasks():
+            if task.id == task_id:
+                return task
+        return None
+
     def _cancel(self):
         """
         Ask the task to cancel.
@@ -143,6 +196,16 @@ class _SyncCancellableTask(asyncio.tasks.Task):
     def __init__(self, loop, coro):
         super().__init__(coro, loop=loop)
         self.sync_cancelled = False
+        self.progress = None
+
+    def set_progress(self, progress):
+        """
+        Set the progress of this task, which can be read with AsyncTask.progress.
+
+        progress is a dictionary describing the task's progress, and its contents are up
+        to the task.  This can be called from any thread.
+        """
+        self.progress = progress
 
     def cancel_sync(self):
         """
@@ -171,3 +234,12 @@ class _SyncCancellableTask(asyncio.tasks.Task):
         """
         if self.should_cancel():
             raise asyncio.CancelledError
+
+def set_task_progress(task, progress):
+    """
+    Set the progress of task, if it's running in an AsyncTask.  task is the
+    asyncio.current_task() of the code running in the AsyncTask, and this can be called
+    from other threads.  See _SyncCancellableTask.set_progress.
+    """
+    if isinstance(task, _SyncCancellableTask):
+        task.set_progress(progress)
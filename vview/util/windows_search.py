@@ -1,8 +1,7 @@
 # This gives an interface to Windows Search, returning results similar to
 # os.scandir.
 
-import asyncio, time, os, stat, logging, threading, queue
-import concurrent.futures
+import asyncio, time, os, stat, logging
 from pathlib import Path
 from pprint import pprint
 
@@ -182,8 +181,13 @@ def search(*args,
         order=None,
         
         # A sort function that takes a DirEntry and returns a key.  This should match order.
-        # This is used if we fall back to _fallback_search.
+        # This is passed to fallback, and reverse reverses it.
         order_fs=None,
+        reverse=False,
+
+        # If set, a function taking the same arguments as search, which is used to search
+        # paths that Windows Search isn't indexing, like SearchIndex.search.
+        fallback=None,
 
         **kwargs):
     paths = [Path(path) for path in paths]
@@ -213,9 +217,11 @@ def search(*args,
         if len(recordset) > 0:
             unseen_paths.remove(unseen_path)
 
+    if fallback is None:
+        return
+
     for unseen_path in list(unseen_paths):
-        for result in _fallback_search(*args, paths=[unseen_path], order_fs=order_fs, **kwargs):
-            yield result
+        yield from fallback(*args, paths=[unseen_path], order_fs=order_fs, reverse=reverse, **kwargs)
 
 def _windows_search(*,
         paths=None,
@@ -373,126 +379,6 @@ def _windows_search(*,
         else:
             raise Exception('The search timed out')
 
-# This does a direct recursive search for files, as a slow fallback when Windows indexing
-# isn't available.  This only supports filters that we can implement reasonably quickly.
-# This is just enough to make things functional where we can't use search, like over network
-# mounts.
-def _fallback_search(*,
-        paths=None,
-        exact_path=None,
-        filename=None,
-
-        substr=None,
-        recurse=True,
-        media_type=None,
-        order_fs=None,
-
-        include_files=True,
-        include_dirs=True,
-
-        # Not supported:
-        contents=None,
-        total_pixels=None,
-        aspect_ratio=None,
-        timeout=None,
-    ):
-
-    if contents: log.warn('Contents search not supported in fallback search')
-    if total_pixels: log.warn('Total pixels search not supported in fallback search')
-    if aspect_ratio: log.warn('Aspect ratio search not supported in fallback search')
-
-    if paths is not None:
-        paths = [Path(path) for path in paths]
-        paths = list(set(paths))
-    if exact_path is not None:
-        paths = [Path(exact_path)]
-
-    # When we're scanning over a network, we may be heavily limited by latency to the server,
-    # so running several scandirs in parallel can speed up the scan significantly.
-    lock = threading.Lock()
-    result_queue = queue.Queue()
-
-    # Protected by lock:
-    tasks = {}
-    finished_paths = set()
-    cancel = False
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        def scan_directory(path):
-            try:
-                # If we were cancelled while this job was waiting in the queue, stop.
-                with lock:
-                    if cancel:
-                        return
-
-                for entry in os.scandir(path):
-                    # Stop if we're cancelled mid-job.
-                    with lock:
-                        if cancel:
-                            return
-
-                    # Push results back to the main loop.                
-                    result_queue.put(('entry', entry))
-
-                    # If we're recursing and this is a directory, submit this directory.
-                    if recurse and entry.is_dir():
-                        submit_directory(entry.path)
-            finally:
-                result_queue.put(('finished', path))
-
-        def submit_directory(path):
-            with lock:
-                if path in finished_paths:
-                    return
-
-                tasks[path] = executor.submit(scan_directory, path)
-                finished_paths.add(path)
-
-        # Queue top-level directories.
-        for path in paths:
-            submit_directory(path)
-
-        try:
-            results = []
-            while tasks or not result_queue.empty():
-                result_type, result = result_queue.get()
-                if result_type == 'entry':
-                    entry = result
-                    if filename is not None and entry.name != filename:
-                        continue
-                    if not include_files and entry.is_file():
-                        continue
-                    if not include_dirs and entry.is_dir():
-                        continue
-                    if substr is not None:
-                        if not all(word.lower() in entry.name.lower() for word in substr.split(' ')):
-                            continue
-
-                    if media_type == 'images':
-                        if not entry.name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff', '.bmp')):
-                            continue
-                    if media_type == 'videos':
-                        if not entry.name.lower().endswith(('.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mkv', '.gif')):
-                            continue
-
-                    if not order_fs:
-                        yield entry
-                    else:
-                        results.append(entry)
-                elif result_type == 'finished':
-                    with lock:
-                        del tasks[result]
-        finally:
-            # If we exit for any reason while jobs are still running, tell them to cancel.
-            with lock:
-                cancel = True
-
-        # If we're sorting results, sort and yield them now.
-        if order_fs:
-            results.sort(key=order_fs)
-            for entry in results:
-                yield entry
-
 def test():
     path=Path(r'F:\stuff\ppixiv\python\temp')
     for idx, entry in enumerate(search(paths=[path], timeout=1, substr='png')):